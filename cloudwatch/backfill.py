@@ -0,0 +1,152 @@
+"""
+Re-downloads the log events of a time range, e.g. the day of an incident.
+
+The range is split into time shards that are fetched in parallel and handed to the
+consumers one shard at a time, oldest first, so every stream is written in timestamp order.
+Progress is checkpointed after every shard so an interrupted backfill resumes where it stopped
+
+usage: python -m cloudwatch.backfill --group /ecs/api --streams 'api/*' \\
+           --start 2020-05-01T10:00 --end 2020-05-01T12:00
+"""
+import argparse
+import hashlib
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from cloudwatch.checkpoint import JsonCheckpointStore
+from cloudwatch.config import *
+from cloudwatch.consumer_abstract import flush_consumers
+from cloudwatch.cwl import CloudWatchLogs
+from cloudwatch.decoding import DecodeStage
+from cloudwatch.main import build_consumers, configure_logging
+from cloudwatch.utils import glob_match, glob_prefix, parse_time
+
+BACKFILL_SHARD_SECONDS = 600
+BACKFILL_WORKERS = 8
+BACKFILL_CHECKPOINT_LOCATION = 'cwl.backfill.state'
+
+
+def split_range(start_time, end_time, shard_ms):
+    """
+    returns: list of (shard start, shard end) covering [start_time, end_time)
+    """
+    return [(shard_start, min(shard_start + shard_ms, end_time))
+            for shard_start in range(start_time, end_time, shard_ms)]
+
+
+class Backfill(object):
+    """
+    Backfills the streams of a log group matching a glob over a time range
+    """
+
+    def __init__(self, client, consumers, log_group_name, log_stream_glob, start_time, end_time,
+                 shard_seconds=BACKFILL_SHARD_SECONDS, workers=BACKFILL_WORKERS,
+                 checkpoint_location=BACKFILL_CHECKPOINT_LOCATION):
+        self.client = client
+        self.consumers = consumers
+        self.decode_stage = DecodeStage(consumers)
+        self.log_group_name = log_group_name
+        self.log_stream_glob = log_stream_glob
+        self.start_time = start_time
+        self.end_time = end_time
+        self.shard_ms = shard_seconds * 1000
+        self.workers = workers
+        self.store = JsonCheckpointStore(checkpoint_location)
+        self.job_id = hashlib.sha1("{}|{}|{}|{}|{}".format(
+            log_group_name, log_stream_glob, start_time, end_time, self.shard_ms).encode('utf-8')).hexdigest()
+
+    def _select_streams(self):
+        """
+        returns: names of the streams matching the glob that may have events in the range
+        """
+        log_streams = self.client.list_log_streams(self.log_group_name, glob_prefix(self.log_stream_glob))
+        selected = []
+        for log_stream in log_streams:
+            if not glob_match(log_stream['logStreamName'], self.log_stream_glob):
+                continue
+            first_event = log_stream.get('firstEventTimestamp', log_stream.get('creationTime', 0))
+            # lastEventTimestamp can lag behind, the last ingestion time is more reliable
+            last_event = max(log_stream.get('lastEventTimestamp', 0), log_stream.get('lastIngestionTime', 0))
+            if first_event < self.end_time and last_event >= self.start_time:
+                selected.append(log_stream['logStreamName'])
+        return sorted(selected)
+
+    def _load_progress(self):
+        progress = self.store.load().get(self.job_id)
+        if progress:
+            logging.info("Resuming backfill {} after {} shards".format(self.job_id, progress['completed']))
+            return progress
+        # the stream selection is saved so that a resumed backfill walks the same shards
+        return {'streams': self._select_streams(), 'completed': 0}
+
+    def _fetch(self, log_stream_name, shard):
+        return self.client.get_log_events_range(self.log_group_name, log_stream_name, shard[0], shard[1])
+
+    def run(self):
+        """
+        Runs (or resumes) the backfill
+        returns: the number of log events written
+        """
+        progress = self._load_progress()
+        shards = [(log_stream_name, shard)
+                  for shard in split_range(self.start_time, self.end_time, self.shard_ms)
+                  for log_stream_name in progress['streams']]
+        logging.info("Backfilling {} streams of {} in {} shards".format(
+            len(progress['streams']), self.log_group_name, len(shards)))
+
+        written = 0
+        pending = deque()
+        remaining = iter(shards[progress['completed']:])
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # keep a bounded number of shards in flight, consume them in order
+            for log_stream_name, shard in remaining:
+                pending.append((log_stream_name, executor.submit(self._fetch, log_stream_name, shard)))
+                if len(pending) >= self.workers * 2:
+                    written += self._consume(pending.popleft(), progress)
+            while pending:
+                written += self._consume(pending.popleft(), progress)
+        logging.info("Backfill {} done, {} log events written".format(self.job_id, written))
+        return written
+
+    def _consume(self, pending_shard, progress):
+        log_stream_name, future = pending_shard
+        log_events = future.result()
+        if log_events:
+            self.decode_stage.dispatch(log_events, self.log_group_name, log_stream_name)
+        progress['completed'] += 1
+        if flush_consumers(self.consumers, CHECKPOINT_FLUSH_TIMEOUT):
+            self.store.save({self.job_id: progress})
+        else:
+            logging.warning("The consumers did not flush shard {} within {}s, not saving the progress".format(
+                progress['completed'], CHECKPOINT_FLUSH_TIMEOUT))
+        return len(log_events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the log events of a time range")
+    parser.add_argument('--group', required=True, help="log group name")
+    parser.add_argument('--streams', default='*', help="glob of the log stream names (default: all)")
+    parser.add_argument('--start', required=True, help="range start, epoch ms or ISO 8601 (UTC)")
+    parser.add_argument('--end', required=True, help="range end, epoch ms or ISO 8601 (UTC)")
+    parser.add_argument('--shard-seconds', type=int, default=BACKFILL_SHARD_SECONDS)
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    parser.add_argument('--checkpoint', default=BACKFILL_CHECKPOINT_LOCATION)
+    args = parser.parse_args()
+
+    configure_logging()
+    client = CloudWatchLogs(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, AWS_SESSION_TOKEN,
+                            max_concurrent_fetches=args.workers)
+    consumers = build_consumers()
+    backfill = Backfill(
+        client, consumers, args.group, args.streams, parse_time(args.start), parse_time(args.end),
+        shard_seconds=args.shard_seconds, workers=args.workers, checkpoint_location=args.checkpoint)
+    try:
+        backfill.run()
+    finally:
+        for consumer in consumers:
+            consumer.close()
+
+
+if __name__ == '__main__':
+    main()
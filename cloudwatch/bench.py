@@ -0,0 +1,180 @@
+"""
+Benchmarks the daemon end to end against the in-process fake CloudWatch Logs and a local fake Mixpanel sink:
+discovery, fetching, the FileSystemConsumer and the MixpanelConsumer. Reports the events/sec, p50/p99
+ingest lag, CPU time and peak RSS as one JSON line, so runs can be compared with each other
+
+usage: python -m cloudwatch.bench --groups 2 --streams 50 --rate 200 --duration 30
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from cloudwatch.consumer_abstract import BaseConsumer
+
+
+class FakeMixpanelHandler(BaseHTTPRequestHandler):
+    """
+    Accepts the Mixpanel /track and /import batches and counts their events
+    """
+    events = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+        # the client posts a form body: data=<json batch>&verbose=1&ip=0
+        try:
+            count = len(json.loads(parse_qs(body)['data'][0]))
+        except (KeyError, ValueError):
+            count = 0
+        with FakeMixpanelHandler.lock:
+            FakeMixpanelHandler.events += count
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"status": 1, "error": null}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CountingConsumer(BaseConsumer):
+    """
+    Counts the events handed to the consumers. Added after the real consumers, so a page is only
+    counted once every one of them got it
+    """
+
+    def __init__(self):
+        self.events = 0
+        self.lock = threading.Lock()
+
+    def process_batch(self, log_lines, log_group, log_stream):
+        with self.lock:
+            self.events += len(log_lines)
+
+
+def start_fake_mixpanel():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeMixpanelHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='fake-mixpanel')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the daemon against a fake CloudWatch Logs")
+    parser.add_argument('--groups', type=int, default=1, help="log groups")
+    parser.add_argument('--streams', type=int, default=20, help="log streams per group")
+    parser.add_argument('--rate', type=float, default=100, help="events per second per stream")
+    parser.add_argument('--payload-bytes', type=int, default=300, help="approximate size of a log message")
+    parser.add_argument('--page-size', type=int, default=10000, help="cap on the events per page")
+    parser.add_argument('--latency', type=float, default=0.02, help="seconds per fake API call")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="share of the calls throttled")
+    parser.add_argument('--backlog', type=float, default=0, help="seconds of events already in the streams")
+    parser.add_argument('--duration', type=float, default=30, help="seconds to run")
+    parser.add_argument('--no-mixpanel', action='store_true', help="leave out the MixpanelConsumer")
+    parser.add_argument('--output', help="also append the report to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sink = start_fake_mixpanel()
+    logs_directory = tempfile.mkdtemp(prefix='cwl-bench-')
+
+    # the configuration is read on import, so it is set up before importing the daemon
+    os.environ.setdefault('AWS_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_SECRET_KEY', 'bench')
+    os.environ.setdefault('AWS_SESSION_TOKEN', 'bench')
+    os.environ['LOG_GROUP_NAMES'] = '/ecs/bench-*'
+    os.environ['STREAM_LOOKBACK_COUNT'] = str(args.streams)
+    os.environ['AWS_LOGS_DIRECTORY'] = logs_directory
+    os.environ['TIME_DAEMON_SLEEP'] = os.environ.get('TIME_DAEMON_SLEEP') or '1'
+    os.environ['TIME_LOG_POLL_SLEEP'] = os.environ.get('TIME_LOG_POLL_SLEEP') or '1'
+    os.environ['GET_LOG_EVENTS_TPS'] = os.environ.get('GET_LOG_EVENTS_TPS') or '1000'
+    os.environ['DESCRIBE_LOG_STREAMS_TPS'] = os.environ.get('DESCRIBE_LOG_STREAMS_TPS') or '1000'
+    os.environ['MIXPANEL_API_URL'] = 'http://127.0.0.1:{}'.format(sink.server_port)
+    if args.no_mixpanel:
+        os.environ.pop('MIXPANEL_TOKEN', None)
+    else:
+        os.environ['MIXPANEL_TOKEN'] = 'bench'
+
+    from cloudwatch import main as daemon
+    from cloudwatch.config import DEDUP
+    from cloudwatch.cwl import CloudWatchLogs
+    from cloudwatch.dedup import EventDeduplicator
+    from cloudwatch.fake import FakeCloudWatchLogsClient
+    from cloudwatch.metrics import EVENTS
+
+    fake = FakeCloudWatchLogsClient(
+        groups=args.groups, streams_per_group=args.streams, events_per_second=args.rate,
+        payload_bytes=args.payload_bytes, page_size=args.page_size, latency=args.latency,
+        throttle_rate=args.throttle_rate, backlog_seconds=args.backlog)
+    client = CloudWatchLogs(client=fake)
+    consumers = daemon.build_consumers()
+    counter = CountingConsumer()
+    handler = daemon.LogStreamHandler(client, consumers + [counter], dedup=EventDeduplicator() if DEDUP else None)
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    for target in (handler.discover_log_streams, handler.sync_new_logs):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    lags = []
+    while time.monotonic() - started < args.duration:
+        time.sleep(0.5)
+        lags.extend(lag for _, lag in handler.scheduler.lags())
+    fetched = sum(value for _, value in EVENTS.samples())
+    # the clock stops once the pages already fetched are consumed
+    handler.pipeline.close(timeout=10)
+    elapsed = time.monotonic() - started
+    events = counter.events
+
+    for consumer in consumers:
+        consumer.close()
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    report = {
+        'groups': args.groups,
+        'streams': args.groups * args.streams,
+        'rate_per_stream': args.rate,
+        'payload_bytes': args.payload_bytes,
+        'duration': round(elapsed, 2),
+        'events': events,
+        'fetched_events': fetched,
+        'events_per_sec': round(events / elapsed, 1),
+        'offered_events_per_sec': args.groups * args.streams * args.rate,
+        'lag_p50': percentile(lags, .5),
+        'lag_p99': percentile(lags, .99),
+        'cpu_seconds': round((usage_after.ru_utime - usage_before.ru_utime) +
+                             (usage_after.ru_stime - usage_before.ru_stime), 2),
+        'peak_rss_mb': round(usage_after.ru_maxrss / 1024.0, 1),  # ru_maxrss is in KB on Linux
+        'api_calls': fake.calls,
+        'mixpanel_events': FakeMixpanelHandler.events,
+    }
+    line = json.dumps(report)
+    print(line)
+    if args.output:
+        with open(args.output, 'a') as fhandle:
+            fhandle.write(line + '\n')
+    shutil.rmtree(logs_directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Module to persist the stream checkpoints (key = stream, value = next token to be fetched)
+"""
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from threading import Lock
+
+
+class CheckpointStore(object):
+    """
+    This class sets the blueprint for all the checkpoint backends. Backends only get
+    handed the keys that changed since the last save
+    """
+
+    def load(self):
+        """
+        returns: the saved checkpoints [dict], the least recently saved first
+        """
+        raise NotImplementedError
+
+    def save(self, changes):
+        """
+        Durably saves the changed checkpoints
+        @param changes: dict of the checkpoints that changed since the last save, a None value deletes the key
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class JsonCheckpointStore(CheckpointStore):
+    """
+    Keeps the checkpoints in a JSON file. Every save writes a temp file, fsyncs it and
+    renames it over the previous one so a crash never leaves a half written checkpoint
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.state = {}
+
+    def load(self):
+        try:
+            with open(self.location, 'r') as fhandle:
+                state = json.load(fhandle)
+        except (IOError, ValueError) as ex:
+            logging.warning("No checkpoint found at {}: {}".format(self.location, repr(ex)))
+            return {}
+        state.pop('modified_time', None)
+        self.state = state
+        return dict(state)
+
+    def save(self, changes):
+        if not changes:
+            return
+        for key, value in changes.items():
+            # re-inserted so the file keeps the keys in the order they were last saved
+            self.state.pop(key, None)
+            if value is not None:
+                self.state[key] = value
+        state = dict(self.state)
+        state['modified_time'] = time.asctime()
+
+        dir_path = os.path.dirname(os.path.abspath(self.location))
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.{}.'.format(os.path.basename(self.location)))
+        try:
+            with os.fdopen(fd, 'w') as fhandle:
+                json.dump(state, fhandle)
+                fhandle.flush()
+                os.fsync(fhandle.fileno())
+            os.replace(tmp_path, self.location)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        # make the rename itself durable
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class SqliteCheckpointStore(CheckpointStore):
+    """
+    Keeps the checkpoints in a SQLite database in WAL mode, a save only upserts the changed rows
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.lock = Lock()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoint (key TEXT PRIMARY KEY, value TEXT, modified_time REAL)')
+        self.connection.commit()
+
+    def load(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM checkpoint ORDER BY modified_time').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def save(self, changes):
+        if not changes:
+            return
+        now = time.time()
+        rows = [(key, json.dumps(value), now) for key, value in changes.items() if value is not None]
+        deleted = [(key,) for key, value in changes.items() if value is None]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO checkpoint (key, value, modified_time) VALUES (?, ?, ?)', rows)
+            self.connection.executemany('DELETE FROM checkpoint WHERE key = ?', deleted)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+CHECKPOINT_BACKENDS = {
+    'json': JsonCheckpointStore,
+    'sqlite': SqliteCheckpointStore,
+}
+
+
+def get_checkpoint_store(backend, location):
+    """
+    Builds the checkpoint store for the configured backend
+    @param backend: one of CHECKPOINT_BACKENDS
+    @param location: the file the checkpoints are kept in
+    """
+    try:
+        return CHECKPOINT_BACKENDS[backend](location)
+    except KeyError:
+        raise ValueError("Unknown checkpoint backend {}, expected one of {}".format(
+            backend, sorted(CHECKPOINT_BACKENDS)))
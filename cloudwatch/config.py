@@ -1,9 +1,10 @@
 import logging
 import os
 
-AWS_ACCESS_KEY = os.environ['AWS_ACCESS_KEY']
-AWS_SECRET_KEY = os.environ['AWS_SECRET_KEY']
-AWS_SESSION_TOKEN = os.environ['AWS_SESSION_TOKEN']
+# required by the daemon, checked by validate_config so the tools that do not need them can still import this module
+AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY')
+AWS_SECRET_KEY = os.environ.get('AWS_SECRET_KEY')
+AWS_SESSION_TOKEN = os.environ.get('AWS_SESSION_TOKEN')
 AWS_REGION = os.environ.get('AWS_REGION') or 'us-east-1'
 
 
@@ -11,14 +12,116 @@ LOG_FILE = 'cwl.log'
 LOG_LEVEL = logging.INFO
 LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
-TIME_DAEMON_SLEEP = 10  # seconds
-TIME_LOG_POLL_SLEEP = 4
+TIME_DAEMON_SLEEP = float(os.environ.get('TIME_DAEMON_SLEEP') or 10)  # seconds
+TIME_LOG_POLL_SLEEP = float(os.environ.get('TIME_LOG_POLL_SLEEP') or 4)  # wait after a partial page
+TIME_LOG_POLL_MAX_SLEEP = float(os.environ.get('TIME_LOG_POLL_MAX_SLEEP') or 60)  # backoff cap for idle streams
 
-LOG_GROUP_NAME = os.environ['LOG_GROUP_NAME']
-BATCH_SIZE = os.environ.get('BATCH_SIZE') or 100
+LOG_GROUP_NAME = os.environ.get('LOG_GROUP_NAME')
+# comma separated log group names or globs, each optionally followed by :<stream lookback count>
+LOG_GROUP_NAMES = os.environ.get('LOG_GROUP_NAMES') or LOG_GROUP_NAME
+LOG_GROUP_REFRESH_INTERVAL = int(os.environ.get('LOG_GROUP_REFRESH_INTERVAL') or 300)  # seconds between glob lookups
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE') or 100)
 STREAM_LOOKBACK_COUNT = int(os.environ.get('STREAM_LOOKBACK_COUNT') or 1)
+STREAM_LOOKBACK_SECONDS = int(os.environ.get('STREAM_LOOKBACK_SECONDS') or 0)  # ignore streams idle longer, 0 = no cutoff
+# list the streams newest first and stop paging early, set to false to list (and sort) every stream of the group
+STREAM_DISCOVERY_ORDERED = (os.environ.get('STREAM_DISCOVERY_ORDERED') or 'true').lower() == 'true'
+FILTER_LOG_EVENTS_TPS = float(os.environ.get('FILTER_LOG_EVENTS_TPS') or 5)  # account wide FilterLogEvents quota
+# poll: GetLogEvents per stream, filter: FilterLogEvents per group with the filter patterns of the consumers
+INGESTION_MODE = os.environ.get('INGESTION_MODE') or 'poll'  # poll, filter or push
+FILTER_OVERLAP_SECONDS = int(os.environ.get('FILTER_OVERLAP_SECONDS') or 10)  # re-read window for late events
+DESCRIBE_LOG_STREAMS_TPS = float(os.environ.get('DESCRIBE_LOG_STREAMS_TPS') or 5)  # account wide DescribeLogStreams quota
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY') or 8)  # max GetLogEvents calls in flight
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS') or FETCH_CONCURRENCY)  # threads polling the tracked streams
+INGESTION_PROCESSES = int(os.environ.get('INGESTION_PROCESSES') or 1)  # > 1 shards the streams over worker processes
+STREAM_IDLE_RETIRE_SECONDS = int(os.environ.get('STREAM_IDLE_RETIRE_SECONDS') or 3600)  # stop polling a quiet stream
+GET_LOG_EVENTS_TPS = float(os.environ.get('GET_LOG_EVENTS_TPS') or 25)  # account wide GetLogEvents quota
+THROTTLE_RETRY_BASE = 0.5  # seconds
+THROTTLE_RETRY_MAX = 20  # seconds
+
+# Checkpoint
+CHECKPOINT_BACKEND = os.environ.get('CHECKPOINT_BACKEND') or 'json'  # json or sqlite
+CHECKPOINT_LOCATION = os.environ.get('CHECKPOINT_LOCATION') or (
+    'cwl.state.db' if CHECKPOINT_BACKEND == 'sqlite' else 'cwl.state')
+CHECKPOINT_COMMIT_INTERVAL = float(os.environ.get('CHECKPOINT_COMMIT_INTERVAL') or 1)  # seconds between saves
+CHECKPOINT_FLUSH_TIMEOUT = float(os.environ.get('CHECKPOINT_FLUSH_TIMEOUT') or 30)  # seconds a save waits on the consumers
+DEDUP = (os.environ.get('DEDUP') or 'true').lower() == 'true'  # drop the events replayed from an older position
+DEDUP_WINDOW_SECONDS = int(os.environ.get('DEDUP_WINDOW_SECONDS') or 300)  # per stream, behind its newest event
+DEDUP_MAX_EVENTS = int(os.environ.get('DEDUP_MAX_EVENTS') or 1000)  # cap on the event fingerprints kept per stream
+
+# Instrumentation
+METRICS_HOST = os.environ.get('METRICS_HOST') or '127.0.0.1'
+METRICS_PORT = int(os.environ.get('METRICS_PORT') or 0)  # serve /metrics and /metrics.json when set
+RECEIVER_HOST = os.environ.get('RECEIVER_HOST') or '127.0.0.1'  # subscription deliveries, in the push ingestion mode
+RECEIVER_PORT = int(os.environ.get('RECEIVER_PORT') or 8081)
+RECEIVER_ACCESS_KEY = os.environ.get('RECEIVER_ACCESS_KEY')  # the access key the Firehose HTTP endpoint is set up with
+RECEIVER_ACK_TIMEOUT = float(os.environ.get('RECEIVER_ACK_TIMEOUT') or 30)  # seconds a delivery waits for the consumers
+METRICS_SNAPSHOT_FILE = os.environ.get('METRICS_SNAPSHOT_FILE')  # write periodic JSON snapshots when set
+METRICS_SNAPSHOT_INTERVAL = int(os.environ.get('METRICS_SNAPSHOT_INTERVAL') or 60)  # seconds
 
 # Consumption
+PIPELINE_DECODE_WORKERS = int(os.environ.get('PIPELINE_DECODE_WORKERS') or 2)
+PIPELINE_CONSUME_WORKERS = int(os.environ.get('PIPELINE_CONSUME_WORKERS') or 2)
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE') or 50)  # pages queued per worker before fetching waits
+JSON_BACKEND = os.environ.get('JSON_BACKEND') or 'auto'  # auto (orjson when installed), orjson or json
 MIXPANEL_TOKEN = os.environ.get("MIXPANEL_TOKEN")
+MIXPANEL_API_SECRET = os.environ.get("MIXPANEL_API_SECRET")  # send through the batch import endpoint when set
+MIXPANEL_API_URL = os.environ.get("MIXPANEL_API_URL") or 'https://api.mixpanel.com'
+MIXPANEL_QUEUE_SIZE = int(os.environ.get('MIXPANEL_QUEUE_SIZE') or 10000)  # events waiting to be sent
+MIXPANEL_SENDER_WORKERS = int(os.environ.get('MIXPANEL_SENDER_WORKERS') or 2)
+MIXPANEL_MAX_RETRIES = int(os.environ.get('MIXPANEL_MAX_RETRIES') or 5)
+MIXPANEL_ENQUEUE_TIMEOUT = float(os.environ.get('MIXPANEL_ENQUEUE_TIMEOUT') or 60)  # seconds a full queue blocks the consumer
 AWS_LOGS_DIRECTORY = os.environ.get("AWS_LOGS_DIRECTORY") or '/var/log/cloudwatchlogs' # if you want to write the logs to local file system
+FS_MAX_OPEN_FILES = int(os.environ.get('FS_MAX_OPEN_FILES') or 128)  # cap on the log file handles kept open
+FS_FLUSH_BYTES = int(os.environ.get('FS_FLUSH_BYTES') or 64 * 1024)  # flush a log file once this much is buffered
+# legacy: one ever growing <stream>.log, segments: <stream>/ directory of rotating compressed NDJSON segments
+FS_OUTPUT_FORMAT = os.environ.get('FS_OUTPUT_FORMAT') or 'legacy'
+FS_SEGMENT_MAX_BYTES = int(os.environ.get('FS_SEGMENT_MAX_BYTES') or 64 * 1024 * 1024)
+FS_SEGMENT_MAX_SECONDS = int(os.environ.get('FS_SEGMENT_MAX_SECONDS') or 3600)
+FS_SEGMENT_COMPRESSION = os.environ.get('FS_SEGMENT_COMPRESSION') or 'auto'  # auto, zstd, gzip or none
+FS_FLUSH_INTERVAL = float(os.environ.get('FS_FLUSH_INTERVAL') or 1)  # seconds, flush all the log files at least this often
+FS_INDEX = (os.environ.get('FS_INDEX') or 'false').lower() == 'true'  # <stream>.log.idx sidecars for cloudwatch.query
+FS_INDEX_BLOCK_BYTES = int(os.environ.get('FS_INDEX_BLOCK_BYTES') or 64 * 1024)  # log file bytes covered by an index entry
+FS_INDEX_FIELDS = [field for field in (os.environ.get('FS_INDEX_FIELDS') or '').split(',') if field]  # e.g. app_id,templatized_url
+CONSOLE_OUTPUT = (os.environ.get('CONSOLE_OUTPUT') or 'false').lower() == 'true'  # merged feed of the streams on stdout
+TAIL_REORDER_WINDOW = float(os.environ.get('TAIL_REORDER_WINDOW') or 2)  # seconds the console holds events to order them
+S3_ARCHIVE_BUCKET = os.environ.get('S3_ARCHIVE_BUCKET')  # archive the events to this bucket when set
+S3_ARCHIVE_PREFIX = os.environ.get('S3_ARCHIVE_PREFIX') or 'cloudwatchlogs'
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # for S3 compatible stores, e.g. http://minio:9000
+S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')  # the AWS credentials are used when not set
+S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+S3_ARCHIVE_WINDOW_SECONDS = int(os.environ.get('S3_ARCHIVE_WINDOW_SECONDS') or 300)  # event time covered by an object
+S3_ARCHIVE_MAX_BYTES = int(os.environ.get('S3_ARCHIVE_MAX_BYTES') or 64 * 1024 * 1024)  # compressed, seal an object early
+S3_UPLOAD_WORKERS = int(os.environ.get('S3_UPLOAD_WORKERS') or 4)  # objects uploaded at a time
+S3_MULTIPART_CHUNK_BYTES = int(os.environ.get('S3_MULTIPART_CHUNK_BYTES') or 8 * 1024 * 1024)
+S3_MULTIPART_CONCURRENCY = int(os.environ.get('S3_MULTIPART_CONCURRENCY') or 4)  # parts of an object uploaded at a time
+S3_SPILL_DIRECTORY = os.environ.get('S3_SPILL_DIRECTORY') or '/var/spool/cloudwatchlogs'  # objects waiting to be uploaded
+S3_SPILL_MAX_BYTES = int(os.environ.get('S3_SPILL_MAX_BYTES') or 1024 * 1024 * 1024)  # block the consumer past this
+S3_CLOSE_TIMEOUT = float(os.environ.get('S3_CLOSE_TIMEOUT') or 30)  # seconds the uploads are waited for on shutdown
 CWL_ENV = os.environ.get('CWL_ENV') or "local"
+
+
+def validate_config():
+    """
+    Checks the settings the daemon cannot run without
+    raises: ValueError naming the missing settings
+    """
+    if INGESTION_MODE not in ('poll', 'filter', 'push'):
+        raise ValueError("INGESTION_MODE must be poll, filter or push, got {}".format(INGESTION_MODE))
+    if INGESTION_MODE == 'push':
+        # the events are delivered to the receiver, nothing is read from the AWS API
+        required = []
+        if not is_loopback(RECEIVER_HOST):
+            required.append(('RECEIVER_ACCESS_KEY (RECEIVER_HOST is not a loopback address)', RECEIVER_ACCESS_KEY))
+    else:
+        required = [('AWS_ACCESS_KEY', AWS_ACCESS_KEY), ('AWS_SECRET_KEY', AWS_SECRET_KEY),
+                    ('AWS_SESSION_TOKEN', AWS_SESSION_TOKEN), ('LOG_GROUP_NAMES or LOG_GROUP_NAME', LOG_GROUP_NAMES)]
+    missing = [name for name, value in required if not value]
+    if missing:
+        raise ValueError("Missing required settings: {}".format(', '.join(missing)))
+
+
+def is_loopback(host):
+    """
+    returns: whether the address is only reachable from this host
+    """
+    return host == 'localhost' or host == '::1' or host.startswith('127.')
@@ -1,8 +1,63 @@
+import time
+
+
 class BaseConsumer(object):
     """
     This class sets the blueprint for all the log event consumers
     """
 
+    # CloudWatch filter pattern of the events the consumer wants, None for every event.
+    # In the filter ingestion mode only the matching events are fetched for the consumer
+    filter_pattern = None
+    # strings the raw message must contain for the consumer to want the event, checked before any decoding
+    required_fields = ()
+    # whether the consumer reads the decoded message (cloudwatch.decoding.decode_message) of its events
+    needs_decoding = False
+
     @staticmethod
     def process(log_line, log_group, log_stream):
         pass
+
+    def process_batch(self, log_lines, log_group, log_stream):
+        """
+        Consumes a page of log events from a single log stream. Falls back to processing
+        the events one at a time, consumers override it to amortize their work over the page
+        @param log_lines: list of log events, in the order they were fetched
+        @param log_group: the log group name
+        @param log_stream: the log stream name
+        """
+        for log_line in log_lines:
+            self.process(log_line, log_group, log_stream)
+
+    def flush(self, timeout=None):
+        """
+        Makes the events handed to the consumer so far durable (written out, delivered), it is called
+        before their checkpoint is saved. Consumers buffering events override it
+        @param timeout: seconds to wait at most, None to wait until done
+        returns: whether every event got out in time
+        """
+        return True
+
+    def stats(self):
+        """
+        Returns a dict of the consumer counters, for monitoring
+        """
+        return {}
+
+    def close(self):
+        """
+        Releases the resources held by the consumer (buffers, files, connections) on shutdown
+        """
+        pass
+
+
+def flush_consumers(consumers, timeout=None):
+    """
+    Flushes the consumers one after the other, within timeout seconds for all of them
+    returns: whether every consumer flushed in time
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for consumer in consumers:
+        if not consumer.flush(None if deadline is None else max(0, deadline - time.monotonic())):
+            return False
+    return True
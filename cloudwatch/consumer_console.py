@@ -0,0 +1,171 @@
+"""
+Module to write the log events of every tracked stream to the console as a single feed ordered by event timestamp
+"""
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from threading import Condition
+
+from cloudwatch.consumer_abstract import BaseConsumer
+from cloudwatch.config import *
+
+
+class _StreamBuffer(object):
+
+    def __init__(self):
+        self.events = deque()  # entries of (log event, arrival time)
+        self.high = None  # newest event timestamp (ms) received from the stream
+        self.last_push = time.monotonic()
+
+
+class TimestampMerger(object):
+    """
+    k-way merge of the per stream feeds of log events (each in timestamp order) into one feed in timestamp order.
+    A heap holds the head event of every stream with buffered events. The head is released once the watermark,
+    the oldest of the newest timestamps received from the streams active within the reorder window, passed it,
+    or once it has been held for the reorder window, so a lagging stream delays the feed by that much at most
+    """
+
+    def __init__(self, reorder_window=TAIL_REORDER_WINDOW):
+        """
+        @param reorder_window: seconds an event is held back waiting for the events of the other streams
+        """
+        self.reorder_window = reorder_window
+        self.condition = Condition()
+        self._streams = {}  # key = (log group name, log stream name), value = _StreamBuffer
+        self._heap = []  # entries of (head event timestamp, sequence, stream key), one per non empty stream
+        self._sequence = itertools.count()
+        self._last_released = None  # timestamp of the last event released
+        self.counters = {'received': 0, 'released': 0, 'late': 0}
+
+    def push(self, key, log_events):
+        """
+        Adds a page of log events of a stream, in timestamp order
+        @param key: the stream key
+        @param log_events: list of log events
+        """
+        if not log_events:
+            return
+        now = time.monotonic()
+        with self.condition:
+            buffer = self._streams.get(key)
+            if buffer is None:
+                buffer = self._streams[key] = _StreamBuffer()
+            was_empty = not buffer.events
+            buffer.events.extend((log_event, now) for log_event in log_events)
+            buffer.high = max(buffer.high or 0, log_events[-1]['timestamp'])
+            buffer.last_push = now
+            if was_empty:
+                heapq.heappush(self._heap, (log_events[0]['timestamp'], next(self._sequence), key))
+            self.counters['received'] += len(log_events)
+            self.condition.notify()
+
+    def _watermark(self, now):
+        highs = []
+        for key, buffer in list(self._streams.items()):
+            if now - buffer.last_push < self.reorder_window:
+                highs.append(buffer.high)
+            elif not buffer.events:
+                del self._streams[key]  # idle and drained
+        return min(highs) if highs else float('inf')
+
+    def pop_ready(self):
+        """
+        returns: list of tuples of (stream key, log event) that can be released, in timestamp order
+        """
+        now = time.monotonic()
+        ready = []
+        with self.condition:
+            watermark = self._watermark(now)
+            while self._heap:
+                timestamp, _, key = self._heap[0]
+                buffer = self._streams[key]
+                log_event, arrival = buffer.events[0]
+                if timestamp > watermark and now - arrival < self.reorder_window:
+                    break
+                heapq.heappop(self._heap)
+                buffer.events.popleft()
+                if buffer.events:
+                    heapq.heappush(self._heap, (buffer.events[0][0]['timestamp'], next(self._sequence), key))
+                if self._last_released is not None and timestamp < self._last_released:
+                    self.counters['late'] += 1  # came in after the reorder window
+                else:
+                    self._last_released = timestamp
+                ready.append((key, log_event))
+            self.counters['released'] += len(ready)
+        return ready
+
+    def wait(self, timeout):
+        with self.condition:
+            self.condition.wait(timeout)
+
+    def pending(self):
+        with self.condition:
+            return sum(len(buffer.events) for buffer in self._streams.values())
+
+
+def format_line(log_group, log_stream, log_event):
+    """
+    returns: the console line of a log event: time, log group/log stream and the message
+    """
+    when = datetime.fromtimestamp(log_event['timestamp'] / 1000.0, tz=timezone.utc)
+    return "{}Z {}/{} {}".format(
+        when.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3], log_group, log_stream, log_event['message'].rstrip('\n'))
+
+
+class ConsoleConsumer(BaseConsumer):
+    """
+    Writes the log events of all the tracked streams to the console, merged in timestamp order
+    """
+
+    def __init__(self, reorder_window=TAIL_REORDER_WINDOW, output=None):
+        """
+        @param reorder_window: seconds an event is held back to be ordered with the events of the other streams
+        @param output: file object the lines are written to, sys.stdout by default
+        """
+        self.merger = TimestampMerger(reorder_window)
+        self.output = output or sys.stdout
+        self._stopped = threading.Event()
+        self._emitter = threading.Thread(target=self._emit, name='console-emitter')
+        self._emitter.daemon = True
+        self._emitter.start()
+
+    def process(self, log_line, log_group, log_stream):
+        self.process_batch([log_line], log_group, log_stream)
+
+    def process_batch(self, log_lines, log_group, log_stream):
+        self.merger.push((log_group, log_stream), log_lines)
+
+    def _write(self, ready):
+        if ready:
+            self.output.write(''.join(
+                format_line(log_group, log_stream, log_event) + '\n'
+                for (log_group, log_stream), log_event in ready))
+            self.output.flush()
+
+    def _emit(self):
+        # wake up on every page and a few times per reorder window to release the events held back
+        tick = max(0.01, self.merger.reorder_window / 4)
+        while not self._stopped.is_set():
+            self.merger.wait(tick)
+            try:
+                self._write(self.merger.pop_ready())
+            except Exception as ex:
+                logging.exception("Failed writing to the console: {}".format(ex))
+
+    def stats(self):
+        with self.merger.condition:
+            stats = dict(self.merger.counters)
+        stats['pending'] = self.merger.pending()
+        return stats
+
+    def close(self):
+        self._stopped.set()
+        self._emitter.join()
+        self.merger.reorder_window = 0  # release everything still held back
+        self._write(self.merger.pop_ready())
@@ -1,40 +1,73 @@
 from cloudwatch.consumer_abstract import BaseConsumer
 from slugify import slugify
-from cloudwatch.utils import create_file_if_does_not_exist
+from cloudwatch.decoding import raw_event
+from cloudwatch.file_writer import BufferedFileWriter
+from cloudwatch.index import LogIndexer
+from cloudwatch.segments import SegmentedOutput
 from cloudwatch.config import *
 
-seen_before = set()
-
 
 class FileSystemConsumer(BaseConsumer):
 
+    def __init__(self, max_open_files=FS_MAX_OPEN_FILES, flush_bytes=FS_FLUSH_BYTES,
+                 flush_interval=FS_FLUSH_INTERVAL, output_format=FS_OUTPUT_FORMAT, index=FS_INDEX):
+        self.writer = BufferedFileWriter(
+            max_open_files=max_open_files, flush_bytes=flush_bytes, flush_interval=flush_interval)
+        self.segments = None
+        if output_format == 'segments':
+            self.segments = SegmentedOutput(
+                self.writer, compression=FS_SEGMENT_COMPRESSION, max_bytes=FS_SEGMENT_MAX_BYTES,
+                max_seconds=FS_SEGMENT_MAX_SECONDS)
+        self.indexer = None
+        if index and not self.segments:
+            self.indexer = LogIndexer(block_bytes=FS_INDEX_BLOCK_BYTES, fields=FS_INDEX_FIELDS)
+            self.needs_decoding = bool(FS_INDEX_FIELDS)  # the indexed field values come from the decoded message
+        self._file_names = {}  # key = (log group name, log stream name), value = sanitized file name
+
     @staticmethod
     def _get_log_dir_name(log_group_name):
         return slugify(log_group_name)
 
-    @staticmethod
-    def _get_file_name(log_group_name, log_stream_name):
+    def _get_file_name(self, log_group_name, log_stream_name):
         """
         Given a log group and a log stream name, generates the sanitized
-        file name to be written to. Cleans any special characters
+        file name to be written to. Cleans any special characters.
+        In the segments output format this is the directory of the stream segments
         @param log_group_name: The log group name
         @param log_stream_name: The log stream name
         """
+        key = (log_group_name, log_stream_name)
+        file_name = self._file_names.get(key)
+        if file_name is None:
+            sanitized_log_group_name = FileSystemConsumer._get_log_dir_name(log_group_name)
+            sanitized_log_stream_name = slugify(log_stream_name)
+            file_name = self._file_names[key] = "{0}/{1}/{2}{3}".format(
+                AWS_LOGS_DIRECTORY, sanitized_log_group_name, sanitized_log_stream_name,
+                '' if self.segments else '.log')
+        return file_name
 
-        sanitized_log_group_name = FileSystemConsumer._get_log_dir_name(log_group_name)
-        sanitized_log_stream_name = slugify(log_stream_name)
-        dir_path = os.path.join(AWS_LOGS_DIRECTORY, sanitized_log_group_name)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-        return "{0}/{1}/{2}.log".format(
-            AWS_LOGS_DIRECTORY, sanitized_log_group_name, sanitized_log_stream_name)
+    def process(self, log_line, log_group, log_stream):
+        self.process_batch([log_line], log_group, log_stream)
 
-    @staticmethod
-    def process(log_line, log_group, log_stream):
-        file_name = FileSystemConsumer._get_file_name(log_group, log_stream)
-        create_file_if_does_not_exist(file_name)
-        fhandle = open(file_name, 'a+')
-        fhandle.write(str(log_line) + '\n')
-        fhandle.flush()
-        fhandle.close()
+    def process_batch(self, log_lines, log_group, log_stream):
+        if not log_lines:
+            return
+        if self.segments:
+            self.segments.write(self._get_file_name(log_group, log_stream), log_lines)
+        else:
+            file_name = self._get_file_name(log_group, log_stream)
+            data = ''.join(str(raw_event(log_line)) + '\n' for log_line in log_lines)
+            if self.indexer:
+                self.indexer.add(file_name, log_lines, len(data.encode('utf-8')))
+            self.writer.write(file_name, data)
+
+    def flush(self, timeout=None):
+        self.writer.flush()
+        return True
 
+    def close(self):
+        if self.segments:
+            self.segments.close()
+        self.writer.close()
+        if self.indexer:
+            self.indexer.close()
@@ -1,13 +1,176 @@
 from cloudwatch.consumer_abstract import BaseConsumer
+import hashlib
 import json
-from cloudwatch.config import MIXPANEL_TOKEN, CWL_ENV
-from mixpanel import Mixpanel
+import time
+from cloudwatch.config import (
+    MIXPANEL_TOKEN, MIXPANEL_API_SECRET, MIXPANEL_API_URL, MIXPANEL_QUEUE_SIZE, MIXPANEL_SENDER_WORKERS,
+    MIXPANEL_MAX_RETRIES, MIXPANEL_ENQUEUE_TIMEOUT, CWL_ENV
+)
+from cloudwatch.decoding import decode_message
+from cloudwatch.dedup import fingerprint
+from cloudwatch.ratelimit import backoff_delay
+from mixpanel import Consumer
 import logging
+import threading
+from queue import Empty, Full, Queue
+from threading import Condition
+
+MIXPANEL_TRACK_BATCH_SIZE = 50  # max events per /track request
+MIXPANEL_IMPORT_BATCH_SIZE = 2000  # max events per /import request
+
+
+class MixpanelSender(object):
+    """
+    Delivers Mixpanel events from a bounded queue on background worker threads,
+    grouping them into batch payloads and retrying failed batches with backoff.
+    A full queue blocks the caller, events are dropped (and counted) when it stays full for
+    enqueue_timeout seconds or a batch runs out of retries
+    """
+
+    def __init__(self, token, api_secret=None, api_url=MIXPANEL_API_URL, queue_size=MIXPANEL_QUEUE_SIZE,
+                 workers=MIXPANEL_SENDER_WORKERS, max_retries=MIXPANEL_MAX_RETRIES,
+                 enqueue_timeout=MIXPANEL_ENQUEUE_TIMEOUT, retry_base=1):
+        """
+        @param enqueue_timeout: seconds enqueue waits for room in a full queue before dropping the event
+        @param retry_base: delay (in seconds) before the first retry of a failed batch
+        """
+        self.token = token
+        self.api_secret = api_secret
+        # the import endpoint takes bigger batches but needs the project secret
+        self.endpoint = 'imports' if api_secret else 'events'
+        self.batch_size = MIXPANEL_IMPORT_BATCH_SIZE if api_secret else MIXPANEL_TRACK_BATCH_SIZE
+        self.max_retries = max_retries
+        self.enqueue_timeout = enqueue_timeout
+        self.retry_base = retry_base
+        self.mp_consumer = Consumer(events_url=api_url + '/track', import_url=api_url + '/import')
+        self.queue = Queue(maxsize=queue_size)
+        self.lock = Condition()
+        self.counters = {'queued': 0, 'sent': 0, 'dropped': 0, 'retried': 0}
+        # the events are queued tagged with the epoch, flush starts a new one and waits out the older ones
+        self._epoch = 0
+        self._unsent = {}  # key = epoch, value = its events queued and not sent (nor dropped) yet
+        self._closed = False
+        self._workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self._send_forever, name='mixpanel-sender-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['queue_depth'] = self.queue.qsize()
+        return stats
+
+    def enqueue(self, event):
+        """
+        Queues an event for delivery. Blocks while the queue is full, so the pipeline (and the fetching)
+        slows down to the pace of Mixpanel, and drops the event if there is still no room after enqueue_timeout
+        """
+        with self.lock:
+            epoch = self._epoch
+            self._unsent[epoch] = self._unsent.get(epoch, 0) + 1
+        try:
+            self.queue.put((epoch, event), timeout=self.enqueue_timeout)
+            self._count('queued')
+        except Full:
+            logging.warning("Mixpanel queue full for {}s, dropping an event".format(self.enqueue_timeout))
+            self._count('dropped')
+            self._settle([epoch])
+
+    def _settle(self, epochs):
+        """
+        Counts the events of the epochs as sent or dropped, for flush
+        """
+        with self.lock:
+            for epoch in epochs:
+                self._unsent[epoch] -= 1
+                if not self._unsent[epoch]:
+                    del self._unsent[epoch]
+            self.lock.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Waits for the events queued so far to be sent, or dropped
+        returns: whether they all were within timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            epoch = self._epoch
+            self._epoch += 1
+            while any(unsent_epoch <= epoch for unsent_epoch in self._unsent):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+        return True
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _send_forever(self):
+        while True:
+            batch = self._next_batch()
+            items = [item for item in batch if item is not None]
+            if items:
+                try:
+                    self._send([event for _, event in items])
+                finally:
+                    self._settle([epoch for epoch, _ in items])
+            if len(items) < len(batch):
+                return  # got the stop signal
+
+    def _send(self, events):
+        json_message = json.dumps(events, separators=(',', ':'))
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.api_secret:
+                    self.mp_consumer.send(self.endpoint, json_message, api_secret=self.api_secret)
+                else:
+                    self.mp_consumer.send(self.endpoint, json_message)
+                self._count('sent', len(events))
+                return
+            except Exception as ex:
+                if attempt == self.max_retries or self._closed:
+                    logging.exception("Dropping {} Mixpanel events after {} attempts: {}".format(
+                        len(events), attempt + 1, ex))
+                    break
+                self._count('retried')
+                time.sleep(backoff_delay(attempt, self.retry_base, 30))
+        self._count('dropped', len(events))
+
+    def close(self, timeout=10):
+        """
+        Stops the workers once they have drained the queue, waiting at most timeout seconds
+        """
+        for _ in self._workers:
+            self.queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.monotonic()))
+        self._closed = True
+        logging.info("Mixpanel sender stopped: {}".format(self.stats()))
 
 
 class MixpanelConsumer(BaseConsumer):
+    # only the API request logs carry a templatized url
+    filter_pattern = '"templatized_url"'
+    required_fields = ('templatized_url',)
+    needs_decoding = True
+
     def __init__(self):
-        self.mp = Mixpanel(MIXPANEL_TOKEN)
+        self.sender = MixpanelSender(MIXPANEL_TOKEN, api_secret=MIXPANEL_API_SECRET)
 
     @staticmethod
     def should_report(url, app_id=None):
@@ -19,33 +182,73 @@ class MixpanelConsumer(BaseConsumer):
             return False
         return True
 
+    @staticmethod
+    def _get_event(log_line):
+        """
+        Parses the log line into the Mixpanel event to report
+        returns: tuple of (distinct id, properties) or None if the log line should not be reported
+        """
+        timestamp = log_line['timestamp']/1000  # epoch (in second)
+        message = decode_message(log_line)
+        if message is None:
+            return None
+        message = message.get('message')
+        if not isinstance(message, dict) or 'templatized_url' not in message:
+            return None
+        request_url = message.get('request_url')
+        templatized_url = message.get('templatized_url')
+        if templatized_url == "/":
+            return None
+        app_id = message.get('app_id')
+        payload = {
+            'url': templatized_url,
+            'full_url': request_url,
+            'app_id': app_id,
+            'env': CWL_ENV,
+            'time': timestamp
+        }
+        if not MixpanelConsumer.should_report(templatized_url, app_id=app_id):
+            return None
+        return app_id, payload
+
+    @staticmethod
+    def _insert_id(log_line, log_group, log_stream):
+        """
+        returns: the same id for every delivery of the log event, so Mixpanel drops the replayed ones
+        (at most 36 characters, an eventId is longer)
+        """
+        key = '{}|{}|{:016x}'.format(log_group, log_stream, fingerprint(log_line))
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+    def _build_event(self, distinct_id, properties, insert_id):
+        # same shape as the events built by Mixpanel.track
+        all_properties = {
+            'token': MIXPANEL_TOKEN,
+            'distinct_id': distinct_id,
+            '$insert_id': insert_id,
+            'mp_lib': 'python',
+        }
+        all_properties.update(properties)
+        return {'event': 'API Request', 'properties': all_properties}
+
     def process(self, log_line, log_group, log_stream):
+        self.process_batch([log_line], log_group, log_stream)
 
-        try:
-            message = log_line['message']
-            timestamp = log_line['timestamp']/1000  # epoch (in second)
+    def process_batch(self, log_lines, log_group, log_stream):
+        for log_line in log_lines:
             try:
-                message = json.loads(message)
-            except:
-                return
-            message = message.get('message')
-            if 'templatized_url' not in message:
-                return
-            message = json.loads(message)
-            request_url = message.get('request_url')
-            templatized_url = message.get('templatized_url')
-            if templatized_url == "/":
-                return
-            app_id = message.get('app_id')
-            payload = {
-                'url': templatized_url,
-                'full_url': request_url,
-                'app_id': app_id,
-                'env': CWL_ENV,
-                'time': timestamp
-            }
-            if MixpanelConsumer.should_report(templatized_url, app_id=app_id):
-                self.mp.track(app_id, 'API Request', payload)
-
-        except Exception as ex:
-            logging.exception("Exception parsing log line {} with exception {}".format(log_line, ex))
+                event = MixpanelConsumer._get_event(log_line)
+                if event:
+                    self.sender.enqueue(self._build_event(
+                        *event, insert_id=MixpanelConsumer._insert_id(log_line, log_group, log_stream)))
+            except Exception as ex:
+                logging.exception("Exception parsing log line {} with exception {}".format(log_line, ex))
+
+    def flush(self, timeout=None):
+        return self.sender.flush(timeout)
+
+    def stats(self):
+        return self.sender.stats()
+
+    def close(self):
+        self.sender.close()
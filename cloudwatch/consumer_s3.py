@@ -0,0 +1,346 @@
+"""
+Module to archive the log events to S3 (or an S3 compatible store such as MinIO).
+
+Events are collected per (log group, log stream, time window) into gzipped newline delimited JSON objects.
+The open objects are spill files on local disk, written a gzip member per page, so memory use does not grow
+with the volume. An object is sealed when its stream moves on to a later window, when it has not been written
+to for a window, or when it reaches a size, and is then uploaded (multipart for big objects) by a pool of
+uploaders sharing one pooled client. Every partition (the objects of a stream for an hour) gets a manifest.json
+listing its objects with their time range and event count.
+
+When the store is slow the sealed objects wait on disk, up to spill_max_bytes, after which the consumer blocks
+(and the fetches slow down). Objects not uploaded on shutdown or on a crash are uploaded by the next run
+"""
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from threading import Condition, Lock
+
+from slugify import slugify
+
+from cloudwatch.consumer_abstract import BaseConsumer
+from cloudwatch.config import *
+from cloudwatch.decoding import raw_event
+from cloudwatch.ratelimit import backoff_delay
+
+MANIFEST_FILE_NAME = 'manifest.json'
+META_SUFFIX = '.json'
+OPEN_SUFFIX = '.ndjson.gz.open'
+SEALED_SUFFIX = '.ndjson.gz'
+
+
+class Partition(object):
+    """
+    An archive object being filled, spilled to disk
+    """
+
+    def __init__(self, spill_path, key, window_start):
+        self.spill_path = spill_path  # without suffix
+        self.key = key
+        self.window_start = window_start
+        self.last_write = time.monotonic()
+        self.size = 0  # compressed bytes on disk
+        self.raw_size = 0
+        self.count = 0
+        self.start_time = None
+        self.end_time = None
+
+    def add(self, log_events, raw_size, size):
+        start_time = log_events[0]['timestamp']
+        end_time = log_events[-1]['timestamp']
+        if self.start_time is None or start_time < self.start_time:
+            self.start_time = start_time
+        if self.end_time is None or end_time > self.end_time:
+            self.end_time = end_time
+        self.count += len(log_events)
+        self.raw_size += raw_size
+        self.size += size
+        self.last_write = time.monotonic()
+
+    def to_json(self):
+        return {'key': self.key, 'window_start': self.window_start, 'start_time': self.start_time,
+                'end_time': self.end_time, 'count': self.count, 'bytes': self.raw_size}
+
+    @staticmethod
+    def recover(spill_path):
+        """
+        Rebuilds a partition left on disk by a previous run, reading back the open spill file when there is one
+        """
+        with open(spill_path + META_SUFFIX, 'r') as fhandle:
+            meta = json.load(fhandle)
+        partition = Partition(spill_path, meta['key'], meta['window_start'])
+        if os.path.exists(spill_path + OPEN_SUFFIX):
+            with open(spill_path + OPEN_SUFFIX, 'rb') as fhandle:
+                data = fhandle.read()
+            valid = 0
+            # a member at a time, the last one may have been cut short
+            while valid < len(data):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                try:
+                    lines = decompressor.decompress(data[valid:]).splitlines()
+                except zlib.error:
+                    break
+                if not decompressor.eof:
+                    break
+                member_size = len(data) - valid - len(decompressor.unused_data)
+                log_events = [{'timestamp': json.loads(line)['timestamp']} for line in lines]
+                if log_events:
+                    partition.add(sorted(log_events, key=lambda log_event: log_event['timestamp']),
+                                  sum(len(line) + 1 for line in lines), member_size)
+                valid += member_size
+            with open(spill_path + OPEN_SUFFIX, 'r+b') as fhandle:
+                fhandle.truncate(valid)
+        else:
+            partition.start_time, partition.end_time = meta['start_time'], meta['end_time']
+            partition.count, partition.raw_size = meta['count'], meta['bytes']
+            partition.size = os.path.getsize(spill_path + SEALED_SUFFIX)
+        return partition
+
+
+def get_s3_client(endpoint_url=S3_ENDPOINT_URL, max_pool_connections=10):
+    """
+    returns: a boto3 S3 client, with S3_ACCESS_KEY/S3_SECRET_KEY when set or else the AWS credentials
+    """
+    import boto3
+    from botocore.config import Config
+    if S3_ACCESS_KEY:
+        credentials = dict(aws_access_key_id=S3_ACCESS_KEY, aws_secret_access_key=S3_SECRET_KEY)
+    else:
+        credentials = dict(aws_access_key_id=AWS_ACCESS_KEY, aws_secret_access_key=AWS_SECRET_KEY,
+                           aws_session_token=AWS_SESSION_TOKEN)
+    return boto3.client('s3', endpoint_url=endpoint_url, region_name=AWS_REGION,
+                        config=Config(max_pool_connections=max_pool_connections), **credentials)
+
+
+class S3ArchiveConsumer(BaseConsumer):
+    """
+    Archives the log events to S3 as gzipped NDJSON objects per stream and time window
+    """
+
+    def __init__(self, bucket=S3_ARCHIVE_BUCKET, prefix=S3_ARCHIVE_PREFIX, window_seconds=S3_ARCHIVE_WINDOW_SECONDS,
+                 max_bytes=S3_ARCHIVE_MAX_BYTES, spill_directory=S3_SPILL_DIRECTORY, spill_max_bytes=S3_SPILL_MAX_BYTES,
+                 upload_workers=S3_UPLOAD_WORKERS, multipart_chunk_bytes=S3_MULTIPART_CHUNK_BYTES,
+                 multipart_concurrency=S3_MULTIPART_CONCURRENCY, client=None):
+        """
+        @param bucket: the bucket the objects are uploaded to
+        @param prefix: key prefix of the objects
+        @param window_seconds: time window (of the event timestamps) of an object
+        @param max_bytes: seal an object once it holds that many compressed bytes
+        @param spill_directory: where the objects are kept until they are uploaded
+        @param spill_max_bytes: block the consumer while that many bytes wait on disk
+        @param upload_workers: objects uploaded at a time
+        @param multipart_chunk_bytes: part size of the multipart uploads, smaller objects are put in one request
+        @param multipart_concurrency: parts of an object uploaded at a time
+        @param client: a ready made S3 client, built from the configuration when not given
+        """
+        from boto3.s3.transfer import TransferConfig
+
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.window_ms = window_seconds * 1000
+        self.window_seconds = window_seconds
+        self.max_bytes = max_bytes
+        self.spill_directory = spill_directory
+        self.spill_max_bytes = spill_max_bytes
+        self.client = client or get_s3_client(max_pool_connections=upload_workers * multipart_concurrency)
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_chunk_bytes, multipart_chunksize=multipart_chunk_bytes,
+            max_concurrency=multipart_concurrency)
+        self.condition = Condition()
+        self._open = {}  # key = (log group name, log stream name), value = dict of window start to Partition
+        self._spilled = 0  # bytes on disk, open and sealed
+        self._manifest_locks = {}  # key = partition prefix, value = Lock
+        self._manifest_locks_lock = Lock()
+        self.counters = {'events': 0, 'uploaded': 0, 'uploaded_bytes': 0, 'upload_failures': 0, 'pending': 0}
+        self._closed = False
+        self._uploader = ThreadPoolExecutor(max_workers=upload_workers)
+        os.makedirs(spill_directory, exist_ok=True)
+        self._recover()
+        timer = threading.Thread(target=self._seal_idle_periodically, name='s3-archive-sealer')
+        timer.daemon = True
+        timer.start()
+
+    def _object_key(self, log_group, log_stream, window_start):
+        when = datetime.fromtimestamp(window_start / 1000.0, tz=timezone.utc)
+        return '{}/{}/{}/{}/{}-{}{}'.format(
+            self.prefix, slugify(log_group), slugify(log_stream), when.strftime('%Y/%m/%d/%H'),
+            window_start, uuid.uuid4().hex[:12], SEALED_SUFFIX)
+
+    def _recover(self):
+        """
+        Queues the uploads of the objects a previous run left on disk
+        """
+        for file_name in sorted(os.listdir(self.spill_directory)):
+            if not file_name.endswith(META_SUFFIX):
+                continue
+            spill_path = os.path.join(self.spill_directory, file_name[:-len(META_SUFFIX)])
+            try:
+                partition = Partition.recover(spill_path)
+            except (IOError, ValueError, KeyError) as ex:
+                logging.error("Could not recover the archive object {}: {}".format(spill_path, ex))
+                continue
+            logging.info("Uploading archive object {} left by a previous run".format(partition.key))
+            self._spilled += partition.size
+            self._seal_partition(partition)
+
+    def process(self, log_line, log_group, log_stream):
+        self.process_batch([log_line], log_group, log_stream)
+
+    def process_batch(self, log_lines, log_group, log_stream):
+        if not log_lines:
+            return
+        # the events of a stream come in timestamp order, split them by window
+        runs = []
+        for log_line in log_lines:
+            window_start = log_line['timestamp'] - log_line['timestamp'] % self.window_ms
+            if not runs or runs[-1][0] != window_start:
+                runs.append((window_start, []))
+            runs[-1][1].append(log_line)
+
+        with self.condition:
+            while self._spilled >= self.spill_max_bytes and not self._closed:
+                logging.warning("S3 archive spill directory is full ({} bytes), waiting on the uploads".format(
+                    self._spilled))
+                self.condition.wait(1)
+            for window_start, log_events in runs:
+                data = ''.join(json.dumps(raw_event(log_event)) + '\n' for log_event in log_events).encode('utf-8')
+                compressed = gzip.compress(data, compresslevel=6)
+                partition = self._get_partition(log_group, log_stream, window_start)
+                with open(partition.spill_path + OPEN_SUFFIX, 'ab') as fhandle:
+                    fhandle.write(compressed)
+                partition.add(log_events, len(data), len(compressed))
+                self._spilled += len(compressed)
+                self.counters['events'] += len(log_events)
+                if partition.size >= self.max_bytes:
+                    self._seal(log_group, log_stream, window_start)
+
+    def _get_partition(self, log_group, log_stream, window_start):
+        partition = self._open.get((log_group, log_stream), {}).get(window_start)
+        if partition is None:
+            # the stream moved on to another window, the objects of the previous ones are complete
+            for previous in [start for start in self._open.get((log_group, log_stream), ()) if start < window_start]:
+                self._seal(log_group, log_stream, previous)
+            partitions = self._open.setdefault((log_group, log_stream), {})
+            spill_path = os.path.join(self.spill_directory, uuid.uuid4().hex)
+            partition = partitions[window_start] = Partition(
+                spill_path, self._object_key(log_group, log_stream, window_start), window_start)
+            with open(spill_path + META_SUFFIX, 'w') as fhandle:
+                json.dump(partition.to_json(), fhandle)
+        return partition
+
+    def _seal(self, log_group, log_stream, window_start):
+        partitions = self._open[(log_group, log_stream)]
+        partition = partitions.pop(window_start)
+        if not partitions:
+            del self._open[(log_group, log_stream)]
+        self._seal_partition(partition)
+
+    def _seal_partition(self, partition):
+        with open(partition.spill_path + META_SUFFIX + '.tmp', 'w') as fhandle:
+            json.dump(partition.to_json(), fhandle)
+        os.replace(partition.spill_path + META_SUFFIX + '.tmp', partition.spill_path + META_SUFFIX)
+        if os.path.exists(partition.spill_path + OPEN_SUFFIX):
+            os.replace(partition.spill_path + OPEN_SUFFIX, partition.spill_path + SEALED_SUFFIX)
+        self.counters['pending'] += 1
+        self._uploader.submit(self._upload, partition)
+
+    def _upload(self, partition):
+        attempt = 0
+        while True:
+            try:
+                if partition.count:
+                    with open(partition.spill_path + SEALED_SUFFIX, 'rb') as fhandle:
+                        self.client.upload_fileobj(
+                            fhandle, self.bucket, partition.key, Config=self.transfer_config,
+                            ExtraArgs={'ContentType': 'application/x-ndjson', 'ContentEncoding': 'gzip'})
+                    self._record(partition)
+                break
+            except Exception as ex:
+                with self.condition:
+                    self.counters['upload_failures'] += 1
+                    closed = self._closed
+                if closed:
+                    logging.error("Failed uploading {}, left for the next run: {}".format(partition.key, ex))
+                    return
+                delay = backoff_delay(attempt, THROTTLE_RETRY_BASE, THROTTLE_RETRY_MAX)
+                logging.warning("Failed uploading {}, retrying in {:.1f}s: {}".format(partition.key, delay, ex))
+                attempt += 1
+                time.sleep(delay)
+        for suffix in (SEALED_SUFFIX, META_SUFFIX):
+            if os.path.exists(partition.spill_path + suffix):
+                os.unlink(partition.spill_path + suffix)
+        with self.condition:
+            self._spilled -= partition.size
+            self.counters['pending'] -= 1
+            if partition.count:
+                self.counters['uploaded'] += 1
+                self.counters['uploaded_bytes'] += partition.size
+            self.condition.notify_all()
+
+    def _record(self, partition):
+        """
+        Adds the uploaded object to the manifest of its partition
+        """
+        partition_prefix = partition.key.rsplit('/', 1)[0]
+        with self._manifest_locks_lock:
+            lock = self._manifest_locks.setdefault(partition_prefix, Lock())
+        manifest_key = '{}/{}'.format(partition_prefix, MANIFEST_FILE_NAME)
+        with lock:
+            try:
+                manifest = json.loads(self.client.get_object(Bucket=self.bucket, Key=manifest_key)['Body'].read())
+            except self.client.exceptions.NoSuchKey:
+                manifest = {'objects': []}
+            entry = partition.to_json()
+            entry['compressed_bytes'] = partition.size
+            manifest['objects'].append(entry)
+            self.client.put_object(Bucket=self.bucket, Key=manifest_key, Body=json.dumps(manifest).encode('utf-8'),
+                                   ContentType='application/json')
+
+    def seal_idle(self):
+        """
+        Seals the objects not written to for a window
+        """
+        now = time.monotonic()
+        with self.condition:
+            for (log_group, log_stream), partitions in list(self._open.items()):
+                for window_start, partition in list(partitions.items()):
+                    if now - partition.last_write >= self.window_seconds:
+                        self._seal(log_group, log_stream, window_start)
+
+    def _seal_idle_periodically(self):
+        while not self._closed:
+            time.sleep(min(self.window_seconds, 10))
+            try:
+                self.seal_idle()
+            except Exception as ex:
+                logging.exception("Failed sealing idle archive objects: {}".format(ex))
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats['spilled_bytes'] = self._spilled
+            stats['open'] = sum(len(partitions) for partitions in self._open.values())
+        return stats
+
+    def close(self, timeout=S3_CLOSE_TIMEOUT):
+        """
+        Seals every object and waits (up to timeout seconds) for the uploads, the rest is uploaded by the next run
+        """
+        with self.condition:
+            for (log_group, log_stream), partitions in list(self._open.items()):
+                for window_start in list(partitions):
+                    self._seal(log_group, log_stream, window_start)
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while self.counters['pending'] and time.monotonic() < deadline:
+                self.condition.wait(max(0, deadline - time.monotonic()))
+            self._closed = True
+            self.condition.notify_all()
+        self._uploader.shutdown(wait=False)
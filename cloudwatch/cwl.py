@@ -3,143 +3,302 @@ Module to interact with the cloudwatch logs
 """
 import time
 import logging
+from contextlib import contextmanager
 
-import boto3
-seen_tokens = set()
-from threading import Lock
+from botocore.exceptions import ClientError
+from threading import BoundedSemaphore, Lock
 
 
 from cloudwatch.config import *
+from cloudwatch.metrics import API_LATENCY, THROTTLES
+from cloudwatch.ratelimit import TokenBucket, backoff_delay
+from cloudwatch.utils import glob_match, glob_prefix, is_glob
+
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException', 'RequestLimitExceeded')
+
+# shared by every stream (and every CloudWatchLogs instance) so that the process as a whole
+# stays under the account wide GetLogEvents quota
+get_log_events_limiter = TokenBucket(GET_LOG_EVENTS_TPS)
+describe_log_streams_limiter = TokenBucket(DESCRIBE_LOG_STREAMS_TPS)
+filter_log_events_limiter = TokenBucket(FILTER_LOG_EVENTS_TPS)
+
+
+def is_throttling_error(ex):
+    return isinstance(ex, ClientError) and ex.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
 
 
 class CloudWatchLogs(object):
 
     @staticmethod
     def _get_client(aws_access_key, aws_secret_key, aws_region, aws_session_token):
+        # boto3 is slow to import, it is only loaded once the first call needs the client
+        import boto3
+        from botocore.config import Config
         return boto3.client(
             'logs',
             aws_access_key_id=aws_access_key,
             aws_secret_access_key=aws_secret_key,
             region_name=aws_region,
-            aws_session_token=aws_session_token
+            aws_session_token=aws_session_token,
+            # enough pooled connections for every concurrent fetch to get its own
+            config=Config(max_pool_connections=max(FETCH_CONCURRENCY, 10))
         )
 
-    def __init__(self, aws_access_key, aws_secret_key, aws_region, aws_session_token):
-        # injecting the AWS connection dependency
-        if not (aws_access_key and aws_secret_key):
-            raise Exception("Needs an AWS Connection string")
-        self.client = CloudWatchLogs._get_client(aws_access_key, aws_secret_key, aws_region, aws_session_token)
+    def __init__(self, aws_access_key=None, aws_secret_key=None, aws_region=None, aws_session_token=None,
+                 max_concurrent_fetches=FETCH_CONCURRENCY, client=None):
+        """
+        @param client: a ready made CloudWatch Logs client (anything with the boto3 'logs' client methods used here,
+        e.g. cloudwatch.fake.FakeCloudWatchLogsClient), built from the AWS credentials when not given
+        """
+        if client is None:
+            # injecting the AWS connection dependency
+            if not (aws_access_key and aws_secret_key):
+                raise Exception("Needs an AWS Connection string")
+        self._client = client
+        self._credentials = (aws_access_key, aws_secret_key, aws_region, aws_session_token)
         self.start_time = int(time.time()) * 1000
+        # guards the per stream lock map only, never held across an API call
         self.lock = Lock()
+        # one lock per (log group, log stream) so a polled stream only ever has a single request in flight
+        # and its tokens are consumed in order, while different streams fetch in parallel. An entry is
+        # list of [Lock, number of fetches using it], dropped once unused so retired streams leave nothing behind
+        self._stream_locks = {}
+        # caps the number of GetLogEvents calls in flight across all the streams
+        self._fetch_slots = BoundedSemaphore(max_concurrent_fetches)
 
         logging.info("Getting logs from time: {}".format(self.start_time))
 
+    @property
+    def client(self):
+        """
+        The boto3 'logs' client, built on first use
+        """
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    self._client = CloudWatchLogs._get_client(*self._credentials)
+        return self._client
+
     def get_log_groups(self, log_group_name_prefix=None):
         """
         For a given AWS cloudwatch connection, gets the CloudWatch Log Groups
         """
         log_groups = []
-        next_token = ''
+        kwargs = {}
+        if log_group_name_prefix:
+            kwargs['logGroupNamePrefix'] = log_group_name_prefix
         while True:
-            if not next_token:
-                # first attempt
-                response = self.client.describe_log_groups(logGroupNamePrefix=log_group_name_prefix)
-            else:
-                response = self.client.describe_log_groups(logGroupNamePrefix=log_group_name_prefix,
-                                                           nextToken=next_token)
-            logging.info("Log groups for prefix {}: {}".format(log_group_name_prefix, response['logGroups']))
+            response = self.client.describe_log_groups(**kwargs)
+            logging.info("Log groups for prefix {}: {}".format(
+                log_group_name_prefix, [log_group['logGroupName'] for log_group in response['logGroups']]))
             log_groups.extend(response['logGroups'])
-            next_token = response.get('nextToken')
-            if not next_token:
+            kwargs['nextToken'] = response.get('nextToken')
+            if not kwargs['nextToken']:
                 break  # nothing more to fetch
         return log_groups
 
-    def get_log_streams(self, log_group_name=None, stream_lookback_count=2):
+    def resolve_log_groups(self, pattern):
+        """
+        Returns the names of the log groups matching a log group name or glob. Plain names are
+        returned as is, globs are listed by their literal prefix and then matched
+        @param pattern: log group name or glob
+        """
+        if not is_glob(pattern):
+            return [pattern]
+        log_groups = self.get_log_groups(glob_prefix(pattern))
+        return [log_group['logGroupName'] for log_group in log_groups
+                if glob_match(log_group['logGroupName'], pattern)]
+
+    @staticmethod
+    def _call_with_retry(operation, limiter, description, **kwargs):
+        """
+        Calls the API operation once the limiter allows it, retrying throttled calls with jittered backoff
+        @param operation: the client method to call
+        @param limiter: the TokenBucket pacing the operation
+        @param description: what is being called, for the logs
+        """
+        labels = dict(
+            operation=operation.__name__.lstrip('_'),
+            log_group=kwargs.get('logGroupName', ''),
+            log_stream=kwargs.get('logStreamName', '')
+        )
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                with API_LATENCY.time(**labels):
+                    return operation(**kwargs)
+            except Exception as ex:
+                if not is_throttling_error(ex):
+                    raise
+                THROTTLES.inc(**labels)
+                delay = backoff_delay(attempt, THROTTLE_RETRY_BASE, THROTTLE_RETRY_MAX)
+                logging.warning("Throttled {}, retrying in {:.2f}s".format(description, delay))
+                attempt += 1
+                time.sleep(delay)
+
+    def get_log_streams(self, log_group_name=None, stream_lookback_count=2, ordered=STREAM_DISCOVERY_ORDERED,
+                        lookback_seconds=STREAM_LOOKBACK_SECONDS):
         """
         Given a log group name, return the log streams
         @param log_group_name: Name of the log group
         @:param stream_lookback_count: Number of streams to lookback (descending sorted)
+        @param ordered: ask for the streams by last event time and stop paging once enough are found,
+        instead of listing every stream of the group
+        @param lookback_seconds: when set, skip the streams without an event in that many seconds
         returns: log streams[list] in the group
         """
 
-        next_token = ''
+        cutoff = (time.time() - lookback_seconds) * 1000 if lookback_seconds else float('-inf')
+        kwargs = dict(logGroupName=log_group_name)
+        if ordered:
+            kwargs.update(orderBy='LastEventTime', descending=True, limit=50)
         log_streams = []
 
         while True:
-            if not next_token:
-                # first attempt
-                response = self.client.describe_log_streams(
-                    logGroupName=log_group_name
-
-                )
-            else:
-                response = self.client.describe_log_streams(
-                    logGroupName=log_group_name,
-                    nextToken=next_token
-                )
+            response = self._call_with_retry(
+                self.client.describe_log_streams, describe_log_streams_limiter,
+                "describing the streams of {}".format(log_group_name), **kwargs)
             log_streams.extend(response['logStreams'])
-            next_token = response.get('nextToken')
-            if not next_token:
+            kwargs['nextToken'] = response.get('nextToken')
+            if not kwargs['nextToken']:
                 break  # nothing more to fetch
+            if ordered and (len(log_streams) >= stream_lookback_count or
+                            log_streams[-1].get('lastEventTimestamp', float('-inf')) < cutoff):
+                break  # the remaining pages only hold older streams
 
         log_streams = sorted(log_streams, key=lambda x: x.get('lastEventTimestamp', float('-inf')), reverse=True)  # sort by event time desc
-        return log_streams[:stream_lookback_count]  # only the latest streams
+        log_streams = [
+            log_stream for log_stream in log_streams[:stream_lookback_count]  # only the latest streams
+            if log_stream.get('lastEventTimestamp', float('-inf')) >= cutoff
+        ]
+        return log_streams
 
-    def get_log_events(self, log_group_name, log_stream_name, gb, batch_limit=BATCH_SIZE, poll_sleep_time=6):
+    @contextmanager
+    def _stream_lock(self, log_group_name, log_stream_name):
         """
-        Gets the log events for the log group and log stream combination
+        Holds the lock serializing the fetches of a single log stream
+        """
+        key = (log_group_name, log_stream_name)
+        with self.lock:
+            entry = self._stream_locks.get(key)
+            if entry is None:
+                entry = self._stream_locks[key] = [Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._stream_locks[key]
+
+    def fetch_log_events(self, log_group_name, log_stream_name, next_token=None, batch_limit=BATCH_SIZE,
+                         start_time=None, end_time=None, start_from_head=False, exclusive=True):
+        """
+        Fetches a single page of log events. Waits on the shared rate limiter before every call
+        and retries throttled calls with jittered backoff instead of failing
         @param log_group_name: the log group name
         @param log_stream_name: the log stream in the group
-        @param gb: global manager object to get/set globals
+        @param next_token: the token to resume from, fetches the tail of the stream when empty
         @param batch_limit: the max number of log events returned
-        @param poll_sleep_time: time to sleep (in seconds) between polling for logs, to avoid rate limit
-        returns: log events [list]
+        @param start_time: only events at or after this time (epoch ms)
+        @param end_time: only events before this time (epoch ms)
+        @param start_from_head: read forward from start_time instead of back from the tail
+        @param exclusive: wait for the other fetches of the stream, so its tokens are consumed in order. The
+        fetches of a bounded time range follow their own tokens and run alongside the others
+        returns: the GetLogEvents response
         """
+        kwargs = dict(
+            logGroupName=log_group_name,
+            logStreamName=log_stream_name,
+            startFromHead=start_from_head,
+            limit=batch_limit
+        )
+        if next_token:
+            kwargs['nextToken'] = next_token
+        if start_time is not None:
+            kwargs['startTime'] = start_time
+        if end_time is not None:
+            kwargs['endTime'] = end_time
+
+        description = "fetching {}/{}".format(log_group_name, log_stream_name)
+        if not exclusive:
+            return self._call_with_retry(self._get_log_events, get_log_events_limiter, description, **kwargs)
+        with self._stream_lock(log_group_name, log_stream_name):
+            return self._call_with_retry(self._get_log_events, get_log_events_limiter, description, **kwargs)
 
-        # TODO: get only the logs from the starting time of the app. maybe maintain the state later
+    def filter_log_events(self, log_group_name, filter_pattern='', start_time=None, log_stream_names=None,
+                          next_token=None, batch_limit=BATCH_SIZE):
+        """
+        Fetches a single page of the log events matching the filter pattern, interleaved across the streams
+        of the group (oldest first). Only the matching events are transferred
+        @param log_group_name: the log group name
+        @param filter_pattern: CloudWatch filter pattern, empty matches every event
+        @param start_time: only events at or after this time (epoch ms)
+        @param log_stream_names: only these streams (up to 100), every stream of the group when empty
+        @param next_token: the token of the next page of a previous call
+        @param batch_limit: the max number of log events returned
+        returns: the FilterLogEvents response
+        """
+        kwargs = dict(logGroupName=log_group_name, limit=batch_limit)
+        if filter_pattern:
+            kwargs['filterPattern'] = filter_pattern
+        if start_time is not None:
+            kwargs['startTime'] = start_time
+        if log_stream_names:
+            kwargs['logStreamNames'] = log_stream_names
+        if next_token:
+            kwargs['nextToken'] = next_token
+        return self._call_with_retry(
+            self.client.filter_log_events, filter_log_events_limiter,
+            "filtering {} for {}".format(log_group_name, filter_pattern), **kwargs)
 
-        next_token = ''
+    def get_log_events_range(self, log_group_name, log_stream_name, start_time, end_time, batch_limit=10000):
+        """
+        Gets all the log events of the stream in a time range, oldest first. The ranges of a stream
+        (e.g. the time shards of a backfill) are fetched in parallel
+        @param log_group_name: the log group name
+        @param log_stream_name: the log stream in the group
+        @param start_time: range start (epoch ms), inclusive
+        @param end_time: range end (epoch ms), exclusive
+        @param batch_limit: the max number of log events per page
+        returns: log events [list]
+        """
         log_events = []
-        try:
-            while True:
-                self.lock.acquire()
-
-                next_token = gb.get_checkpoint().get(log_stream_name) or ""
-
-                # if next_token in seen_tokens:
-                #     raise Exception("next token {} already seen".format(next_token))
-                # seen_tokens.add(next_token)
-
-                if not next_token:
-                    # first attempt, try to load the checkpoint and find the next token
-                    response = self.client.get_log_events(
-                        logGroupName=log_group_name,
-                        logStreamName=log_stream_name,
-                        startFromHead=False,
-                        limit=batch_limit
-                    )
-                else:
-                    response = self.client.get_log_events(
-                        logGroupName=log_group_name,
-                        logStreamName=log_stream_name,
-                        nextToken=next_token,
-                        startFromHead=False,
-                        limit=batch_limit
-                    )
-
-                next_forward_token = response['nextForwardToken']
-
-                gb.set_checkpoint(log_stream_name, next_forward_token)
-
-                self.lock.release()
-
-                yield response['events']
-                time.sleep(poll_sleep_time)
-
-                if not next_forward_token:
-                    break
-
-        except Exception as ex:
-            logging.exception(ex)
-            # reraising
-            raise ex
+        next_token = None
+        while True:
+            response = self.fetch_log_events(
+                log_group_name, log_stream_name, next_token, batch_limit,
+                start_time=start_time, end_time=end_time, start_from_head=True, exclusive=False)
+            log_events.extend(response['events'])
+            # the forward token stays the same once the end of the range is reached,
+            # a page can come back empty before that
+            if response['nextForwardToken'] == next_token:
+                break
+            next_token = response['nextForwardToken']
+        return log_events
+
+    def list_log_streams(self, log_group_name, log_stream_name_prefix=None):
+        """
+        Lists every stream of the log group, optionally only the ones starting with the prefix
+        returns: log streams[list] in the group
+        """
+        kwargs = dict(logGroupName=log_group_name)
+        if log_stream_name_prefix:
+            kwargs['logStreamNamePrefix'] = log_stream_name_prefix
+        log_streams = []
+        while True:
+            response = self._call_with_retry(
+                self.client.describe_log_streams, describe_log_streams_limiter,
+                "listing the streams of {}".format(log_group_name), **kwargs)
+            log_streams.extend(response['logStreams'])
+            kwargs['nextToken'] = response.get('nextToken')
+            if not kwargs['nextToken']:
+                break  # nothing more to fetch
+        return log_streams
+
+    def _get_log_events(self, **kwargs):
+        with self._fetch_slots:
+            return self.client.get_log_events(**kwargs)
@@ -0,0 +1,101 @@
+"""
+Module to decode the JSON log messages once per event, shared by all the consumers
+"""
+import json
+
+from cloudwatch.config import JSON_BACKEND
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DECODED_KEY = '_decoded'  # where the decoded message is cached on the log event
+NOT_JSON = object()  # cached for messages that are not JSON, so they are not parsed twice
+
+
+def get_json_loads(backend=JSON_BACKEND):
+    """
+    Picks the JSON decoder
+    @param backend: 'orjson', 'json' or 'auto' (orjson when it is installed)
+    """
+    if backend == 'orjson' or (backend == 'auto' and orjson is not None):
+        if orjson is None:
+            raise ImportError("JSON_BACKEND is orjson but orjson is not installed")
+        return orjson.loads
+    return json.loads
+
+
+json_loads = get_json_loads()
+
+
+def decode_message(log_event):
+    """
+    Decodes the JSON message of the log event, once: the result is cached on the event.
+    Our ECS containers wrap the application log in a JSON envelope whose 'message' is itself
+    a JSON string, that inner message is decoded too and replaces the string in the result
+    returns: the decoded message [dict], or None if the message is not a JSON object
+    """
+    decoded = log_event.get(DECODED_KEY)
+    if decoded is None:
+        decoded = NOT_JSON
+        message = log_event['message']
+        if message[:1] == '{':
+            try:
+                decoded = json_loads(message)
+            except ValueError:
+                pass
+        if isinstance(decoded, dict):
+            inner = decoded.get('message')
+            if isinstance(inner, str) and inner[:1] == '{':
+                try:
+                    decoded['message'] = json_loads(inner)
+                except ValueError:
+                    pass
+        else:
+            decoded = NOT_JSON
+        log_event[DECODED_KEY] = decoded
+    return None if decoded is NOT_JSON else decoded
+
+
+def raw_event(log_event):
+    """
+    returns: the log event as fetched from CloudWatch, without the decoding cache
+    """
+    if DECODED_KEY not in log_event:
+        return log_event
+    return dict((key, value) for key, value in log_event.items() if key != DECODED_KEY)
+
+
+class DecodeStage(object):
+    """
+    Hands pages of log events to the consumers. A consumer only gets the events whose raw message
+    contains all of its required_fields, so the other events are skipped without being decoded, and
+    the events of consumers that need_decoding are decoded once up front for all of them
+    """
+
+    def __init__(self, consumers):
+        self.consumers = consumers
+
+    @staticmethod
+    def select(consumer, log_events):
+        """
+        returns: the log events the consumer wants, decoded if it needs them decoded
+        """
+        required_fields = consumer.required_fields
+        if required_fields:
+            log_events = [log_event for log_event in log_events
+                          if all(field in log_event['message'] for field in required_fields)]
+        if consumer.needs_decoding:
+            for log_event in log_events:
+                decode_message(log_event)
+        return log_events
+
+    def dispatch(self, log_events, log_group, log_stream):
+        """
+        Hands a page of log events of a stream to every consumer
+        """
+        for consumer in self.consumers:
+            selected = DecodeStage.select(consumer, log_events)
+            if selected:
+                consumer.process_batch(selected, log_group, log_stream)
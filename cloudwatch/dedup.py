@@ -0,0 +1,256 @@
+"""
+Module to drop the log events already handed to the consumers, when a stream is read again from an older
+position: a restart resuming from a checkpoint saved before the last pages were consumed, a filter sweep
+overlapping the previous one or a subscription delivery retried after a partial failure.
+
+Every stream has a sliding window of the fingerprints of its newest events (at most window_seconds behind its
+newest event and max_events long). An event with an event id (FilterLogEvents, subscriptions) is a duplicate when
+its id is in the window. GetLogEvents has no event ids, so identical lines of the same PutLogEvents batch (e.g. the
+closing braces of a multi-line JSON) share a fingerprint: the window counts the events of a fingerprint and such an
+event is a duplicate while a stream resumed from its checkpoint is read again over events of that fingerprint the
+window holds. GetLogEvents reads a stream in timestamp order, so its events older than the window were handed out
+before and are duplicates too. The events with an id can arrive out of order, only their id is checked.
+The windows are saved with the checkpoint when new events are consumed, under '@dedup:' keys, so they survive
+restarts. The key of a stream no longer read, or not read for a while, is deleted
+"""
+import base64
+import hashlib
+import struct
+import time
+from collections import deque
+from threading import Lock
+
+from cloudwatch.config import DEDUP_MAX_EVENTS, DEDUP_WINDOW_SECONDS
+
+DEDUP_KEY_PREFIX = '@dedup:'
+ENTRY = struct.Struct('>qQ')  # event timestamp, fingerprint
+
+
+def fingerprint(log_event):
+    """
+    returns: 64 bit fingerprint of the event, from its eventId (FilterLogEvents and subscriptions) or
+    from its timestamp, ingestion time and message (GetLogEvents has no event ids)
+    """
+    event_id = log_event.get('eventId')
+    if event_id is None:
+        event_id = '{}:{}:{}'.format(log_event['timestamp'], log_event.get('ingestionTime'), log_event['message'])
+    return int.from_bytes(hashlib.blake2b(event_id.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class _Window(object):
+
+    def __init__(self):
+        self.entries = deque()  # (timestamp, fingerprint) in the order the events were seen
+        self.counts = {}  # key = fingerprint, value = its entries in the window
+        self.matched = {}  # key = fingerprint, value = its entries the stream has been read past since the load
+        self.newest = None
+        self.floor = None  # events without an id before this timestamp are duplicates
+        self.uncommitted = 0  # entries at the end of the window whose page is not consumed yet
+        self.uncommitted_matches = []  # fingerprints matched by the page not consumed yet
+        self.last_used = time.monotonic()
+
+    def is_duplicate(self, timestamp, event_fingerprint, unique):
+        """
+        @param unique: whether the fingerprint is an event id, which any repeat of the event has
+        """
+        if unique:
+            # pushed and filtered events come out of timestamp order, only their ids tell the repeats apart
+            return event_fingerprint in self.counts
+        if self.floor is not None and timestamp < self.floor:
+            return True
+        matched = self.matched.get(event_fingerprint, 0)
+        if matched < self.counts.get(event_fingerprint, 0):
+            # read again over an event of the window, e.g. resuming from an older checkpoint
+            self.matched[event_fingerprint] = matched + 1
+            self.uncommitted_matches.append(event_fingerprint)
+            return True
+        return False
+
+    def add(self, timestamp, event_fingerprint):
+        self.entries.append((timestamp, event_fingerprint))
+        count = self.counts[event_fingerprint] = self.counts.get(event_fingerprint, 0) + 1
+        self.matched[event_fingerprint] = count
+
+    def commit(self, count):
+        """
+        returns: the number of entries committed
+        """
+        count = min(count, self.uncommitted)
+        for i in range(len(self.entries) - self.uncommitted, len(self.entries) - self.uncommitted + count):
+            timestamp = self.entries[i][0]
+            self.newest = timestamp if self.newest is None else max(self.newest, timestamp)
+        self.uncommitted -= count
+        self.uncommitted_matches = []
+        return count
+
+    def rollback(self):
+        """
+        Takes the entries and the matches of the page not consumed out of the window
+        """
+        for _ in range(self.uncommitted):
+            _, event_fingerprint = self.entries.pop()
+            self._discard(event_fingerprint)
+        for event_fingerprint in self.uncommitted_matches:
+            if self.matched.get(event_fingerprint):
+                self.matched[event_fingerprint] -= 1
+        self.uncommitted = 0
+        self.uncommitted_matches = []
+
+    def _discard(self, event_fingerprint):
+        count = self.counts[event_fingerprint] - 1
+        if count:
+            self.counts[event_fingerprint] = count
+            self.matched[event_fingerprint] = min(self.matched.get(event_fingerprint, 0), count)
+        else:
+            del self.counts[event_fingerprint]
+            self.matched.pop(event_fingerprint, None)
+
+    def trim(self, window_ms, max_events):
+        while self.entries and (len(self.entries) > max_events or self.entries[0][0] < self.newest - window_ms):
+            timestamp, event_fingerprint = self.entries.popleft()
+            self._discard(event_fingerprint)
+            # the other events of the same millisecond may not have been seen, only the older ones are dropped
+            self.floor = timestamp if self.floor is None else max(self.floor, timestamp)
+        self.uncommitted = min(self.uncommitted, len(self.entries))
+
+
+class EventDeduplicator(object):
+    """
+    Filters the duplicate events out of the pages of the streams, with a bounded window per stream
+    """
+
+    def __init__(self, window_seconds=DEDUP_WINDOW_SECONDS, max_events=DEDUP_MAX_EVENTS):
+        """
+        @param window_seconds: how far behind the newest event of a stream its fingerprints are kept
+        @param max_events: cap on the fingerprints kept per stream
+        """
+        self.window_ms = window_seconds * 1000
+        self.max_events = max_events
+        self.lock = Lock()
+        self._windows = {}  # key = stream key, value = _Window
+        self._dirty = set()  # stream keys with new events consumed since the last save
+        self._forgotten = set()  # stream keys whose saved window is deleted with the next save
+        self.counters = {'events': 0, 'duplicates': 0}
+
+    def filter(self, key, log_events):
+        """
+        Drops the events of the page already seen and adds the others to the window of the stream,
+        the page is then committed once consumed or rolled back if it failed
+        @param key: the stream key (its checkpoint key)
+        @param log_events: the page of log events
+        returns: the new log events, in order
+        """
+        new_events = []
+        with self.lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = _Window()
+                self._forgotten.discard(key)
+            window.last_used = time.monotonic()
+            for log_event in log_events:
+                timestamp = log_event['timestamp']
+                event_fingerprint = fingerprint(log_event)
+                if window.is_duplicate(timestamp, event_fingerprint, 'eventId' in log_event):
+                    continue
+                window.add(timestamp, event_fingerprint)
+                window.uncommitted += 1
+                new_events.append(log_event)
+            self.counters['events'] += len(log_events)
+            self.counters['duplicates'] += len(log_events) - len(new_events)
+        return new_events
+
+    def commit(self, key, count):
+        """
+        Marks the events of a filtered page as consumed, they are saved with the next checkpoint
+        @param key: the stream key
+        @param count: the number of new events filter returned for the page
+        """
+        with self.lock:
+            window = self._windows.get(key)
+            if window is not None and window.commit(count):
+                # only the pages with new events change what is saved of the window
+                window.trim(self.window_ms, self.max_events)
+                self._dirty.add(key)
+
+    def rollback(self, key):
+        """
+        Forgets the events of a filtered page that failed to be consumed, so they are new when read again
+        @param key: the stream key
+        """
+        with self.lock:
+            window = self._windows.get(key)
+            if window is not None:
+                window.rollback()
+
+    def forget(self, key):
+        """
+        Drops the window of a stream that is no longer read, its saved window is deleted with the next save
+        """
+        with self.lock:
+            if self._windows.pop(key, None) is not None:
+                self._forgotten.add(key)
+            self._dirty.discard(key)
+
+    def expire(self, max_age):
+        """
+        Forgets the windows of the streams not read for max_age seconds, the pushed and filtered streams
+        are never retired
+        returns: the number of windows forgotten
+        """
+        cutoff = time.monotonic() - max_age
+        with self.lock:
+            expired = [key for key, window in self._windows.items()
+                       if window.last_used < cutoff and not window.uncommitted]
+            for key in expired:
+                del self._windows[key]
+                self._forgotten.add(key)
+                self._dirty.discard(key)
+        return len(expired)
+
+    def _encode(self, window):
+        committed = list(window.entries)[:len(window.entries) - window.uncommitted]
+        return {'floor': window.floor,
+                'entries': base64.b64encode(b''.join(ENTRY.pack(*entry) for entry in committed)).decode('ascii')}
+
+    def save_to(self, gb):
+        """
+        Sets the windows changed since the last call as checkpoints, to be saved with them,
+        and deletes the ones of the streams forgotten
+        @param gb: global manager object holding the checkpoint
+        """
+        with self.lock:
+            changes = dict((DEDUP_KEY_PREFIX + key, self._encode(self._windows[key]))
+                           for key in self._dirty if key in self._windows)
+            forgotten = [DEDUP_KEY_PREFIX + key for key in self._forgotten]
+            self._dirty = set()
+            self._forgotten = set()
+        for key, value in changes.items():
+            gb.set_checkpoint(key, value)
+        for key in forgotten:
+            gb.delete_checkpoint(key)
+
+    def load(self, checkpoint):
+        """
+        Restores the windows saved with the checkpoint
+        @param checkpoint: dict of the saved checkpoints
+        """
+        with self.lock:
+            for key, value in checkpoint.items():
+                if not key.startswith(DEDUP_KEY_PREFIX) or not isinstance(value, dict):
+                    continue
+                window = _Window()
+                window.floor = value.get('floor')
+                data = base64.b64decode(value.get('entries') or '')
+                for timestamp, event_fingerprint in ENTRY.iter_unpack(data):
+                    window.add(timestamp, event_fingerprint)
+                window.matched = {}  # the stream is read again from its checkpoint
+                window.newest = max((timestamp for timestamp, _ in window.entries), default=None)
+                self._windows[key[len(DEDUP_KEY_PREFIX):]] = window
+                self._forgotten.discard(key[len(DEDUP_KEY_PREFIX):])
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['streams'] = len(self._windows)
+            stats['fingerprints'] = sum(len(window.entries) for window in self._windows.values())
+        return stats
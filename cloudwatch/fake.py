@@ -0,0 +1,230 @@
+"""
+An in-process stand-in for the boto3 CloudWatch Logs client, to benchmark the daemon without AWS.
+
+Every stream produces events at a fixed rate from the time the client is created (minus an optional
+backlog). The events are computed from their index rather than stored, so large groups and high rates
+cost no memory. Paging, page size caps, latency and throttling can be configured
+"""
+import heapq
+import json
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+MAX_GET_LOG_EVENTS_LIMIT = 10000
+MAX_DESCRIBE_LIMIT = 50
+
+
+def throttling_error(operation_name):
+    return ClientError(
+        {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation_name)
+
+
+class FakeLogStream(object):
+
+    def __init__(self, log_group_name, log_stream_name, events_per_second, start_time):
+        self.log_group_name = log_group_name
+        self.log_stream_name = log_stream_name
+        self.events_per_second = events_per_second
+        self.start_time = start_time  # epoch ms of the first event
+
+    def count(self, now_ms):
+        """
+        returns: the number of events produced by now_ms
+        """
+        if now_ms <= self.start_time or not self.events_per_second:
+            return 0
+        return int((now_ms - self.start_time) * self.events_per_second / 1000)
+
+    def timestamp(self, index):
+        return self.start_time + int(index * 1000 / self.events_per_second)
+
+    def index_at(self, timestamp):
+        """
+        returns: the index of the first event at or after the timestamp
+        """
+        if timestamp <= self.start_time:
+            return 0
+        index = int((timestamp - self.start_time) * self.events_per_second / 1000)
+        while self.timestamp(index) < timestamp:
+            index += 1
+        return index
+
+
+class FakeCloudWatchLogsClient(object):
+    """
+    Implements the CloudWatch Logs client calls the daemon makes
+    """
+
+    def __init__(self, groups=1, streams_per_group=10, events_per_second=10, payload_bytes=200,
+                 api_request_ratio=0.2, page_size=MAX_GET_LOG_EVENTS_LIMIT, latency=0.0, throttle_rate=0.0,
+                 backlog_seconds=0, group_prefix='/ecs/bench-', seed=0):
+        """
+        @param groups: number of log groups
+        @param streams_per_group: number of log streams per group
+        @param events_per_second: events produced per stream per second
+        @param payload_bytes: approximate size of the log messages
+        @param api_request_ratio: share of the events that are API request logs (the ones Mixpanel reports)
+        @param page_size: cap on the events per page, below the limit asked for
+        @param latency: seconds every call takes
+        @param throttle_rate: share of the calls failing with a ThrottlingException
+        @param backlog_seconds: how long the streams have been producing events when the client is created
+        """
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.api_request_ratio = api_request_ratio
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}  # key = operation name, value = number of calls
+        self.padding = 'x' * max(0, payload_bytes - 150)
+        start_time = int((time.time() - backlog_seconds) * 1000)
+        self.groups = {}
+        for g in range(groups):
+            log_group_name = '{}{}'.format(group_prefix, g)
+            self.groups[log_group_name] = [
+                FakeLogStream(log_group_name, 'app/app/{:08x}'.format(s), events_per_second, start_time)
+                for s in range(streams_per_group)
+            ]
+        self.streams = dict(((stream.log_group_name, stream.log_stream_name), stream)
+                            for streams in self.groups.values() for stream in streams)
+
+    def _call(self, operation_name):
+        with self.lock:
+            self.calls[operation_name] = self.calls.get(operation_name, 0) + 1
+            throttled = self.throttle_rate and self.random.random() < self.throttle_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise throttling_error(operation_name)
+
+    def _message(self, stream, index):
+        if (index * 7919) % 1000 < self.api_request_ratio * 1000:
+            inner = json.dumps({
+                'templatized_url': '/api/v1/items/{id}',
+                'request_url': '/api/v1/items/{}'.format(index),
+                'app_id': 'app-{}'.format(index % 50),
+                'padding': self.padding,
+            })
+        else:
+            inner = 'health check ok {} {}'.format(index, self.padding)
+        return json.dumps({'message': inner, 'container': stream.log_stream_name})
+
+    def _event(self, stream, index):
+        timestamp = stream.timestamp(index)
+        return {
+            'timestamp': timestamp,
+            'message': self._message(stream, index),
+            'ingestionTime': timestamp,
+        }
+
+    @staticmethod
+    def _page(items, next_token, limit):
+        start = int(next_token or 0)
+        page = items[start:start + limit]
+        response = {}
+        if start + limit < len(items):
+            response['nextToken'] = str(start + limit)
+        return page, response
+
+    def describe_log_groups(self, logGroupNamePrefix='', nextToken=None, limit=MAX_DESCRIBE_LIMIT):
+        self._call('describe_log_groups')
+        names = sorted(name for name in self.groups if name.startswith(logGroupNamePrefix or ''))
+        page, response = self._page(names, nextToken, limit)
+        response['logGroups'] = [{'logGroupName': name} for name in page]
+        return response
+
+    def _describe(self, stream, now_ms):
+        count = stream.count(now_ms)
+        description = {'logStreamName': stream.log_stream_name, 'creationTime': stream.start_time}
+        if count:
+            description.update(
+                firstEventTimestamp=stream.start_time,
+                lastEventTimestamp=stream.timestamp(count - 1),
+                lastIngestionTime=stream.timestamp(count - 1),
+            )
+        return description
+
+    def describe_log_streams(self, logGroupName, logStreamNamePrefix=None, orderBy='LogStreamName',
+                             descending=False, nextToken=None, limit=MAX_DESCRIBE_LIMIT):
+        self._call('describe_log_streams')
+        now_ms = int(time.time() * 1000)
+        streams = [self._describe(stream, now_ms) for stream in self.groups[logGroupName]
+                   if stream.log_stream_name.startswith(logStreamNamePrefix or '')]
+        if orderBy == 'LastEventTime':
+            streams.sort(key=lambda stream: stream.get('lastEventTimestamp', 0), reverse=descending)
+        else:
+            streams.sort(key=lambda stream: stream['logStreamName'], reverse=descending)
+        page, response = self._page(streams, nextToken, min(limit, MAX_DESCRIBE_LIMIT))
+        response['logStreams'] = page
+        return response
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead=False, limit=MAX_GET_LOG_EVENTS_LIMIT,
+                       nextToken=None, startTime=None, endTime=None):
+        self._call('get_log_events')
+        stream = self.streams[(logGroupName, logStreamName)]
+        limit = min(limit, self.page_size, MAX_GET_LOG_EVENTS_LIMIT)
+        end = stream.count(int(time.time() * 1000))
+        if endTime is not None:
+            end = min(end, stream.index_at(endTime))
+        if nextToken:
+            start = int(nextToken[2:])
+        elif startFromHead:
+            start = stream.index_at(startTime) if startTime is not None else 0
+        else:
+            # the tail of the stream
+            start = max(stream.index_at(startTime) if startTime is not None else 0, end - limit)
+        stop = max(start, min(end, start + limit))
+        return {
+            'events': [self._event(stream, index) for index in range(start, stop)],
+            'nextForwardToken': 'f/{}'.format(stop),
+            'nextBackwardToken': 'b/{}'.format(start),
+        }
+
+    def filter_log_events(self, logGroupName, logStreamNames=None, startTime=None, endTime=None,
+                          filterPattern=None, nextToken=None, limit=MAX_GET_LOG_EVENTS_LIMIT):
+        self._call('filter_log_events')
+        # only term patterns ('"term"' or 'term') are supported
+        term = (filterPattern or '').strip('"')
+        now_ms = int(time.time() * 1000)
+        end_time = min(now_ms, endTime) if endTime is not None else now_ms
+        limit = min(limit, self.page_size, MAX_GET_LOG_EVENTS_LIMIT)
+        # the token is the (timestamp, stream, index) position of the last event scanned
+        last = tuple(int(part) for part in nextToken.split('/')) if nextToken else None
+        streams = [stream for stream in self.groups[logGroupName]
+                   if not logStreamNames or stream.log_stream_name in logStreamNames]
+        counts = [stream.count(now_ms) for stream in streams]
+
+        # merge the streams by timestamp
+        heads = []
+        for i, stream in enumerate(streams):
+            if last:
+                index = stream.index_at(last[0])
+                while index < counts[i] and (stream.timestamp(index), i, index) <= last:
+                    index += 1
+            else:
+                index = stream.index_at(startTime or 0)
+            if index < counts[i] and stream.timestamp(index) < end_time:
+                heapq.heappush(heads, (stream.timestamp(index), i, index))
+
+        log_events = []
+        scanned = 0
+        # like the real API, a page can stop short (even empty) once enough events were scanned
+        while heads and len(log_events) < limit and scanned < limit * 10:
+            timestamp, i, index = last = heapq.heappop(heads)
+            scanned += 1
+            stream = streams[i]
+            event = self._event(stream, index)
+            if term in event['message']:
+                event.update(logStreamName=stream.log_stream_name,
+                             eventId='{}-{}'.format(stream.log_stream_name, index))
+                log_events.append(event)
+            if index + 1 < counts[i] and stream.timestamp(index + 1) < end_time:
+                heapq.heappush(heads, (stream.timestamp(index + 1), i, index + 1))
+
+        response = {'events': log_events, 'searchedLogStreams': []}
+        if heads:
+            response['nextToken'] = '/'.join(str(part) for part in last)
+        return response
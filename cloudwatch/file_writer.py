@@ -0,0 +1,119 @@
+"""
+Module to write to many log files without paying for an open/write/close per line
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class BufferedFileWriter(object):
+    """
+    Appends data to files through a bounded LRU of open file handles. Writes are
+    buffered per file and flushed once a file has `flush_bytes` pending, once
+    `flush_interval` seconds have passed, or on close
+    """
+
+    def __init__(self, max_open_files=128, flush_bytes=64 * 1024, flush_interval=1.0):
+        self.max_open_files = max_open_files
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.lock = Lock()
+        self._handles = OrderedDict()  # key = path, value = open file handle, least recently used first
+        self._buffers = {}  # key = path, value = list of pending chunks
+        self._buffered_bytes = {}  # key = path, value = size of the pending chunks
+        self._last_flush = time.monotonic()
+        self._flusher = None
+        self._closed = False
+
+    def _start_flusher(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_periodically, name='file-writer-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._closed:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as ex:
+                logging.exception("Failed flushing buffered log files: {}".format(ex))
+
+    def _get_handle(self, path):
+        fhandle = self._handles.get(path)
+        if fhandle is not None:
+            self._handles.move_to_end(path)
+            return fhandle
+        while len(self._handles) >= self.max_open_files:
+            lru_path = next(iter(self._handles))
+            self._flush_path(lru_path)
+            self._handles.pop(lru_path).close()
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        fhandle = self._handles[path] = open(path, 'a', encoding='utf-8')
+        return fhandle
+
+    def _flush_path(self, path):
+        chunks = self._buffers.pop(path, None)
+        self._buffered_bytes.pop(path, None)
+        if not chunks:
+            return
+        fhandle = self._get_handle(path)
+        fhandle.write(''.join(chunks))
+        fhandle.flush()
+
+    def write(self, path, data):
+        """
+        Buffers the data to be appended to the file at path
+        @param path: the file to append to, its directory is created if needed
+        @param data: the string to append
+        """
+        with self.lock:
+            if self._closed:
+                raise ValueError("Write to a closed BufferedFileWriter")
+            self._start_flusher()
+            self._buffers.setdefault(path, []).append(data)
+            pending = self._buffered_bytes[path] = self._buffered_bytes.get(path, 0) + len(data)
+            if pending >= self.flush_bytes:
+                self._flush_path(path)
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush_all()
+
+    def _flush_all(self):
+        for path in list(self._buffers):
+            self._flush_path(path)
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        """
+        Writes out everything that is buffered
+        """
+        with self.lock:
+            self._flush_all()
+
+    def close_file(self, path):
+        """
+        Flushes the buffer of a single file and closes its handle
+        """
+        with self.lock:
+            self._flush_path(path)
+            fhandle = self._handles.pop(path, None)
+            if fhandle is not None:
+                fhandle.close()
+
+    def close(self):
+        """
+        Flushes the buffers and closes all the file handles
+        """
+        with self.lock:
+            if self._closed:
+                return
+            self._flush_all()
+            for fhandle in self._handles.values():
+                fhandle.close()
+            self._handles.clear()
+            self._closed = True
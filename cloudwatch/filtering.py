@@ -0,0 +1,134 @@
+"""
+Module to ingest log events through FilterLogEvents: the matching events of all the streams of a group,
+filtered server side, instead of every event of every stream through GetLogEvents
+"""
+import logging
+import time
+from collections import OrderedDict
+
+from cloudwatch.config import *
+from cloudwatch.cwl import is_throttling_error
+from cloudwatch.decoding import DecodeStage
+from cloudwatch.metrics import INGEST_LAG, record_events
+from cloudwatch.ratelimit import AdaptivePoller
+from cloudwatch.utils import filter_checkpoint_key
+
+MAX_FILTER_LOG_STREAM_NAMES = 100  # FilterLogEvents takes at most 100 stream names
+
+
+class LogEventFilter(object):
+    """
+    Repeatedly sweeps a log group for the events matching a filter pattern and hands them
+    to the consumers, grouped by stream. Checkpoints the sweep start time and page token.
+    Every sweep starts overlap_seconds before the newest event seen, to pick up events
+    ingested late, and skips the event ids it has already handed out
+    """
+
+    def __init__(self, client, gb, log_group_name, filter_pattern, consumers, get_log_stream_names=None,
+                 batch_limit=BATCH_SIZE, overlap_seconds=FILTER_OVERLAP_SECONDS, dedup=None):
+        """
+        @param client: the CloudWatchLogs client
+        @param gb: global manager object to get/set the checkpoints
+        @param log_group_name: the log group to sweep
+        @param filter_pattern: CloudWatch filter pattern, empty matches every event
+        @param consumers: consumers of type BaseConsumer getting the matching events
+        @param get_log_stream_names: returns the streams to sweep, every stream of the group when it returns none
+        @param batch_limit: the max number of log events per page
+        @param overlap_seconds: how far back from the newest event seen a sweep starts
+        @param dedup: EventDeduplicator keeping the overlap of the sweeps from being handed out again after a restart
+        """
+        self.client = client
+        self.gb = gb
+        self.log_group_name = log_group_name
+        self.filter_pattern = filter_pattern
+        self.decode_stage = DecodeStage(consumers)
+        self.get_log_stream_names = get_log_stream_names
+        self.batch_limit = batch_limit
+        self.overlap_ms = overlap_seconds * 1000
+        self.key = filter_checkpoint_key(log_group_name, filter_pattern)
+        self.poller = AdaptivePoller(TIME_LOG_POLL_SLEEP, TIME_LOG_POLL_MAX_SLEEP)
+        self.dedup = dedup
+        self._seen = {}  # key = event id, value = timestamp, for the events in the overlap window
+
+    def _log_stream_names(self):
+        if not self.get_log_stream_names:
+            return None
+        log_stream_names = sorted(self.get_log_stream_names())
+        if len(log_stream_names) > MAX_FILTER_LOG_STREAM_NAMES:
+            return None  # too many to list, sweep the whole group
+        return log_stream_names
+
+    def _hand_out(self, log_events):
+        by_stream = OrderedDict()
+        for log_event in log_events:
+            by_stream.setdefault(log_event['logStreamName'], []).append(log_event)
+        for log_stream_name, stream_events in by_stream.items():
+            record_events(self.log_group_name, log_stream_name, stream_events)
+            INGEST_LAG.set(time.time() - stream_events[-1]['timestamp'] / 1000,
+                           log_group=self.log_group_name, log_stream=log_stream_name)
+            dedup_key = '{}:{}'.format(self.key, log_stream_name)
+            if self.dedup is not None:
+                stream_events = self.dedup.filter(dedup_key, stream_events)
+            try:
+                self.decode_stage.dispatch(stream_events, self.log_group_name, log_stream_name)
+            except Exception:
+                if self.dedup is not None:
+                    self.dedup.rollback(dedup_key)
+                raise
+            if self.dedup is not None:
+                self.dedup.commit(dedup_key, len(stream_events))
+
+    def sweep(self):
+        """
+        Pages through the events matching the filter since the last sweep
+        returns: the number of new events handed out
+        """
+        state = self.gb.get_checkpoint().get(self.key) or {'start_time': self.client.start_time}
+        start_time = state['start_time']
+        next_token = state.get('next_token')
+        log_stream_names = self._log_stream_names()
+        newest = start_time
+        count = 0
+        while True:
+            try:
+                response = self.client.filter_log_events(
+                    self.log_group_name, self.filter_pattern, start_time, log_stream_names, next_token,
+                    self.batch_limit)
+            except Exception as ex:
+                if not next_token or is_throttling_error(ex):
+                    raise
+                # tokens expire, start the sweep over and let the seen event ids skip the repeats
+                logging.warning("Dropping the filter token of {}: {}".format(self.key, ex))
+                next_token = None
+                continue
+
+            log_events = [log_event for log_event in response['events'] if log_event['eventId'] not in self._seen]
+            for log_event in log_events:
+                self._seen[log_event['eventId']] = log_event['timestamp']
+                newest = max(newest, log_event['timestamp'])
+            if log_events:
+                self._hand_out(log_events)
+                count += len(log_events)
+
+            next_token = response.get('nextToken')
+            if not next_token:
+                break
+            self.gb.set_checkpoint(self.key, {'start_time': start_time, 'next_token': next_token})
+
+        next_start_time = max(start_time, newest - self.overlap_ms)
+        self._seen = dict((event_id, timestamp) for event_id, timestamp in self._seen.items()
+                          if timestamp >= next_start_time)
+        self.gb.set_checkpoint(self.key, {'start_time': next_start_time, 'next_token': None})
+        return count
+
+    def run(self):
+        """
+        Sweeps forever, right away while sweeps come back full and backing off while they are empty
+        """
+        while True:
+            try:
+                delay = self.poller.next_delay(self.sweep(), self.batch_limit)
+            except Exception as ex:
+                logging.exception("Failed filtering {}: {}".format(self.key, ex))
+                delay = TIME_LOG_POLL_MAX_SLEEP
+            time.sleep(delay)
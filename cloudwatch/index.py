@@ -0,0 +1,214 @@
+"""
+Module to index the log files written by the FileSystemConsumer and query them.
+
+Next to every <stream>.log a <stream>.log.idx sidecar gets one JSON line per block of the log
+file (a block is a run of pages of about block_bytes): its byte range, the time range of its
+events and, optionally, the names of the indexed JSON fields and the field=value tokens found in it.
+A query reads the (small) index, keeps the blocks overlapping the time range that hold every
+token asked for of the fields they index, and only reads those byte ranges of the log file through mmap.
+The values of the fields a block does not index are checked on its lines.
+The end of the file not covered by the index yet is always scanned
+
+usage: python -m cloudwatch.query --group /ecs/api --stream 'api/api/1234' \\
+           --start 2020-05-01T10:00 --end 2020-05-01T10:05 --where app_id=X
+"""
+import ast
+import json
+import mmap
+import os
+import re
+from threading import Lock
+
+from cloudwatch.decoding import decode_message
+
+INDEX_SUFFIX = '.idx'
+TIMESTAMP_PATTERN = re.compile(rb"""['"]timestamp['"]:\s*(\d+)""")
+
+
+def field_values(decoded, fields):
+    """
+    returns: the field=value tokens of the fields found in the decoded message or in the JSON message nested in it
+    """
+    tokens = set()
+    if decoded is None:
+        return tokens
+    nested = decoded.get('message')
+    for source in (decoded, nested if isinstance(nested, dict) else None):
+        if source is None:
+            continue
+        for field in fields:
+            value = source.get(field)
+            if value is not None and not isinstance(value, (dict, list)):
+                tokens.add('{}={}'.format(field, value))
+    return tokens
+
+
+def token_field(token):
+    return token.split('=', 1)[0]
+
+
+class Block(object):
+
+    def __init__(self, offset, fields=()):
+        self.offset = offset
+        self.end = offset
+        self.start_time = None
+        self.end_time = None
+        self.fields = fields
+        self.tokens = set()
+
+    def to_json(self):
+        entry = {'offset': self.offset, 'end': self.end, 'start_time': self.start_time, 'end_time': self.end_time}
+        if self.fields:
+            # a block without a token of an indexed field holds no event with that field
+            entry['fields'] = sorted(self.fields)
+        if self.tokens:
+            entry['tokens'] = sorted(self.tokens)
+        return json.dumps(entry)
+
+
+class LogIndexer(object):
+    """
+    Builds the sidecar indexes of the log files as pages are appended to them
+    """
+
+    def __init__(self, block_bytes=64 * 1024, fields=()):
+        """
+        @param block_bytes: size of the log file covered by an index entry
+        @param fields: JSON fields whose values are indexed as field=value tokens
+        """
+        self.block_bytes = block_bytes
+        self.fields = tuple(fields)
+        self.lock = Lock()
+        self._sizes = {}  # key = log file path, value = size of the log file once the buffered writes land
+        self._blocks = {}  # key = log file path, value = the Block being filled
+
+    def add(self, path, log_events, size):
+        """
+        Indexes a page appended to the log file
+        @param path: the log file
+        @param log_events: the events of the page, in the order they were written
+        @param size: the size in bytes of the page as written
+        """
+        with self.lock:
+            offset = self._sizes.get(path)
+            if offset is None:
+                offset = os.path.getsize(path) if os.path.exists(path) else 0
+            self._sizes[path] = offset + size
+
+            block = self._blocks.get(path)
+            if block is None:
+                block = self._blocks[path] = Block(offset, self.fields)
+            block.end = offset + size
+            start_time = min(log_event['timestamp'] for log_event in log_events)
+            end_time = max(log_event['timestamp'] for log_event in log_events)
+            block.start_time = start_time if block.start_time is None else min(block.start_time, start_time)
+            block.end_time = end_time if block.end_time is None else max(block.end_time, end_time)
+            if self.fields:
+                for log_event in log_events:
+                    block.tokens.update(field_values(decode_message(log_event), self.fields))
+            if block.end - block.offset >= self.block_bytes:
+                self._write_block(path)
+
+    def _write_block(self, path):
+        block = self._blocks.pop(path)
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        with open(path + INDEX_SUFFIX, 'a') as fhandle:
+            fhandle.write(block.to_json() + '\n')
+
+    def close(self):
+        """
+        Writes out the partially filled blocks, call it once the log files are flushed
+        """
+        with self.lock:
+            for path in list(self._blocks):
+                self._write_block(path)
+
+
+def read_index(path):
+    """
+    returns: the index entries [list of dict] of the log file
+    """
+    entries = []
+    try:
+        with open(path + INDEX_SUFFIX, 'r') as fhandle:
+            for line in fhandle:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass  # a line cut short by a crash
+    except IOError:
+        pass
+    return entries
+
+
+def _parse_line(line):
+    """
+    Parses a log file line back into the log event (written as NDJSON or as a Python dict repr)
+    """
+    text = line.decode('utf-8')
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+
+def _matches(line, where):
+    try:
+        log_event = _parse_line(line)
+    except (ValueError, SyntaxError):
+        return False
+    return where <= field_values(decode_message(log_event), [token_field(token) for token in where])
+
+
+def query(path, start_time=None, end_time=None, where=()):
+    """
+    Reads the lines of the log file with events in [start_time, end_time] having every field=value of where
+    @param path: the log file
+    @param start_time: epoch ms, inclusive
+    @param end_time: epoch ms, inclusive
+    @param where: field=value tokens the events must all have
+    returns: generator of the matching lines [str]
+    """
+    where = set(where)
+    start_time = float('-inf') if start_time is None else start_time
+    end_time = float('inf') if end_time is None else end_time
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if not size:
+        return
+
+    ranges = []
+    indexed_end = 0
+    for entry in read_index(path):
+        indexed_end = max(indexed_end, entry['end'])
+        if entry['end_time'] < start_time or entry['start_time'] > end_time:
+            continue
+        # only the tokens of the fields the block indexes rule it out, the others are checked on its lines
+        indexed = set(entry.get('fields', ()))
+        if not set(token for token in where if token_field(token) in indexed) <= set(entry.get('tokens', ())):
+            continue
+        ranges.append((entry['offset'], min(entry['end'], size)))
+    if indexed_end < size:
+        ranges.append((indexed_end, size))  # not indexed yet
+
+    with open(path, 'rb') as fhandle:
+        data = mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for range_start, range_end in ranges:
+                position = range_start
+                while position < range_end:
+                    line_end = data.find(b'\n', position, range_end)
+                    if line_end == -1:
+                        line_end = range_end
+                    line = data[position:line_end]
+                    position = line_end + 1
+                    match = TIMESTAMP_PATTERN.search(line)
+                    if not match or not start_time <= int(match.group(1)) <= end_time:
+                        continue
+                    if where and not _matches(line, where):
+                        continue
+                    yield line.decode('utf-8')
+        finally:
+            data.close()
@@ -1,30 +1,44 @@
-import json
-import threading
 import time
-from threading import Lock
+
+IMPORT_STARTED = time.monotonic()  # the startup timing includes the imports
+
+import os
+import signal
+import sys
+import threading
+from threading import Event, Lock
 from cloudwatch.config import *
-import boto3
+from cloudwatch.checkpoint import get_checkpoint_store
+from cloudwatch.consumer_abstract import flush_consumers
 from cloudwatch.cwl import CloudWatchLogs
-from cloudwatch.consumer_mixpanel import MixpanelConsumer
+from cloudwatch.dedup import EventDeduplicator
+from cloudwatch.consumer_console import ConsoleConsumer
 from cloudwatch.consumer_filesystem import FileSystemConsumer
-from cloudwatch.utils import create_file_if_does_not_exist
+from cloudwatch.filtering import LogEventFilter
+from cloudwatch.metrics import (
+    CHECKPOINT_LATENCY, CONSUMER_QUEUE_DEPTH, INGEST_LAG, POOL, REGISTRY, STARTUP, expire_stream_series,
+    forget_stream, record_startup_phase, start_metrics_server, write_snapshots
+)
+from cloudwatch.pipeline import Page, Pipeline
+from cloudwatch.receiver import PushReceiver, start_receiver_server
+from cloudwatch.scheduler import StreamScheduler
+from cloudwatch.sharding import ShardRouter
+from cloudwatch.utils import checkpoint_key, glob_match, is_glob, parse_log_group_selectors, split_checkpoint_key
 
 """
 GLOBALS GO HERE
 
 
 the log stream map is a log stream discovery mechanism that lets the main process
-know which threads are working on which log streams
-Key: Tuple(log group name, log stream name), value: the thread id (optional for now)
+know which scheduler tasks are working on which log streams
+Key: Tuple(log group name, log stream name), value: the StreamTask (None until it is scheduled)
 
 Basically we want a set of the log streams currently being processed so that later they
 can be reaped from this map when the thread is "Done" or more threads can be added to it
 as we discover more log streams
 """
 LOG_STREAM_MAP = {}
-LOG_STREAM_CHECKPOINT = {}  # key = stream id, value = next token to be fetched
-
-s3_client = boto3.client('s3')
+LOG_STREAM_CHECKPOINT = {}  # key = checkpoint_key(log group name, log stream name), value = next token to be fetched
 
 
 class GlobalManager(object):
@@ -34,6 +48,7 @@ class GlobalManager(object):
 
     def __init__(self):
         self.lock = Lock()
+        self._dirty_checkpoints = {}  # checkpoints changed since the last save
 
     def get_log_stream_map(self):
 
@@ -70,7 +85,52 @@ class GlobalManager(object):
     def set_checkpoint(self, key, value):
         self.lock.acquire()
         try:
-            LOG_STREAM_CHECKPOINT[key] = value
+            if LOG_STREAM_CHECKPOINT.get(key) != value:
+                LOG_STREAM_CHECKPOINT[key] = value
+                self._dirty_checkpoints[key] = value
+        finally:
+            self.lock.release()
+
+    def delete_checkpoint(self, key):
+        """
+        Removes a checkpoint, the store deletes it with the next save
+        """
+        self.lock.acquire()
+        try:
+            LOG_STREAM_CHECKPOINT.pop(key, None)
+            self._dirty_checkpoints[key] = None
+        finally:
+            self.lock.release()
+
+    def load_checkpoint(self, checkpoint):
+        """
+        Loads saved checkpoints without marking them as changed
+        """
+        self.lock.acquire()
+        try:
+            LOG_STREAM_CHECKPOINT.update(checkpoint)
+        finally:
+            self.lock.release()
+
+    def pop_dirty_checkpoints(self):
+        """
+        Returns the checkpoints changed since the last call and resets the change set
+        """
+        self.lock.acquire()
+        try:
+            dirty, self._dirty_checkpoints = self._dirty_checkpoints, {}
+            return dirty
+        finally:
+            self.lock.release()
+
+    def restore_dirty_checkpoints(self, dirty):
+        """
+        Puts back checkpoints that failed to save, unless they have changed again since
+        """
+        self.lock.acquire()
+        try:
+            for key, value in dirty.items():
+                self._dirty_checkpoints.setdefault(key, value)
         finally:
             self.lock.release()
 
@@ -80,60 +140,121 @@ gb = GlobalManager()
 
 class LogStreamHandler(object):
 
-    def __init__(self, client):
+    def __init__(self, client, consumers=(), log_group_selectors=None, scheduler=None, dedup=None):
+        """
+        @param scheduler: what the discovered streams are added to, a StreamScheduler fetching them
+        in this process by default (the sharded mode hands them to worker processes instead)
+        @param dedup: EventDeduplicator dropping the events replayed to the consumers, saved with the checkpoint
+        """
         self.aws_client = client
+        self.consumers = consumers
+        self.dedup = dedup
+        self.pipeline = Pipeline(consumers, on_ack=gb.set_checkpoint, dedup=dedup, on_failure=self._page_failed)
         self.lock = Lock()
-
-    def write_log(self, log_group_name, log_stream_name, consumers):
+        self.scheduler = scheduler or StreamScheduler(
+            client, gb, on_events=self.write_log, on_retire=self._retire_stream)
+        if scheduler is not None:
+            scheduler.on_retire = self._retire_stream
+        self._filters = {}  # key = (log group name, filter pattern), value = thread running the LogEventFilter
+        # list of tuples of (log group name or glob, stream lookback count)
+        self.log_group_selectors = log_group_selectors or parse_log_group_selectors(
+            LOG_GROUP_NAMES, STREAM_LOOKBACK_COUNT)
+        self._log_groups = []  # list of tuples of (log group name, stream lookback count)
+        self._log_groups_resolved_at = None
+        self._streams_discovered = Event()  # wakes up sync_new_logs when discovery found new streams
+
+    def write_log(self, log_group_name, log_stream_name, log_events, checkpoint=None, generation=None):
         """
-        Writes the log to the log file
-        @param file_name: The log file name to be written to
+        Queues a page of log events on the decode/consume pipeline, blocks while the consumers are behind
         @param log_group_name: The log group name
         @param log_stream_name: The log stream name
-        @param consumers: List of consumers of type BaseConsumer
+        @param log_events: the page of log events, as returned by fetch_log_events
+        @param checkpoint: tuple of (checkpoint key, token) to save once every consumer got the page
+        @param generation: the generation of the stream task the page was fetched by
         """
+        self.pipeline.submit(Page(log_group_name, log_stream_name, log_events, checkpoint, generation))
 
-        # get the data from the log group
-        for _logs in self.aws_client.get_log_events(log_group_name, log_stream_name, gb):
-            # handle the log events
-            for _log in _logs:
-                for consumer in consumers:
-                    consumer.process(_log, log_group_name, log_stream_name)
+    def _page_failed(self, page):
+        # the page is not acked, fetch it again rather than letting the next page move the checkpoint past it
+        if page.generation is not None:
+            self.scheduler.rewind(page.log_group_name, page.log_stream_name, page.generation)
 
     def _wanted_log_stream(self, log_stream_name):
         return True
 
-    def _remove_old_streams(self, streams):
+    def _remove_old_streams(self, log_group_name, streams):
         """
-        Removes any old streams from the LOG_STREAM_MAP
+        Removes the streams of the log group that fell out of the lookback window
+        from the LOG_STREAM_MAP and stops polling them
         """
-
-        for stream in streams:
-            if not gb.get_log_stream_map().get(LOG_GROUP_NAME, stream):
-                logging.warning("CLEANING UP LOG STREAM: {}/{}".format(LOG_GROUP_NAME, stream))
-                k = (LOG_GROUP_NAME, stream)
-                gb.delete_stream_from_map(k)
+        discovered = set(log_stream['logStreamName'] for log_stream in streams)
+        for group, stream in list(gb.get_log_stream_map()):
+            if group == log_group_name and stream not in discovered:
+                logging.warning("CLEANING UP LOG STREAM: {}/{}".format(group, stream))
+                self.scheduler.remove(group, stream)
+                gb.delete_stream_from_map((group, stream))
+                if self.dedup is not None:
+                    self.dedup.forget(checkpoint_key(group, stream))
+                forget_stream(group, stream)
+
+    def _retire_stream(self, log_group_name, log_stream_name):
+        # the stream went idle, discovery will track it again if it is still in the lookback window
+        gb.delete_stream_from_map((log_group_name, log_stream_name))
+        if self.dedup is not None:
+            # read again from its checkpoint in memory, nothing is replayed
+            self.dedup.forget(checkpoint_key(log_group_name, log_stream_name))
+        forget_stream(log_group_name, log_stream_name)
+
+    def _resolve_log_groups(self):
+        """
+        Expands the log group selectors into log group names. Globs need a DescribeLogGroups
+        lookup so they are only resolved every LOG_GROUP_REFRESH_INTERVAL
+        returns: list of tuples of (log group name, stream lookback count)
+        """
+        now = time.monotonic()
+        if self._log_groups_resolved_at is not None and \
+                now - self._log_groups_resolved_at < LOG_GROUP_REFRESH_INTERVAL:
+            return self._log_groups
+
+        log_groups = {}
+        for pattern, stream_lookback_count in self.log_group_selectors:
+            for log_group_name in self.aws_client.resolve_log_groups(pattern):
+                # the first selector matching a group sets its lookback count
+                log_groups.setdefault(log_group_name, stream_lookback_count)
+        if log_groups != dict(self._log_groups):
+            logging.info("Tracking log groups: {}".format(log_groups))
+        self._log_groups = list(log_groups.items())
+        self._log_groups_resolved_at = now
+        return self._log_groups
 
     def _discover_log_streams(self):
         """
         This method is used by the main process to discover new log streams
         and keep a shared state(map) of the log streams being worked on.
         """
+        for log_group_name, stream_lookback_count in self._resolve_log_groups():
+            try:
+                self._discover_group_log_streams(log_group_name, stream_lookback_count)
+            except Exception as ex:
+                logging.exception("Failed discovering the streams of {}: {}".format(log_group_name, ex))
+        logging.info("Log stream map: {}".format(gb.get_log_stream_map()))
+
+    def _discover_group_log_streams(self, log_group_name, stream_lookback_count):
         log_streams = self.aws_client.get_log_streams(
-            log_group_name=LOG_GROUP_NAME, stream_lookback_count=STREAM_LOOKBACK_COUNT)
+            log_group_name=log_group_name, stream_lookback_count=stream_lookback_count)
 
-        self._remove_old_streams(log_streams)
+        self._remove_old_streams(log_group_name, log_streams)
 
         for log_stream in log_streams:
             lsn = log_stream['logStreamName']
-            if not gb.get_log_stream_map().get((LOG_GROUP_NAME, lsn)):
+            if not gb.get_log_stream_map().get((log_group_name, lsn)):
                 # setting the value to None is an indication that no thread is working on the log stream
                 if self._wanted_log_stream(lsn):
-                    logging.info("Log stream {} not tracked - starting to track".format(lsn))
-                    gb.set_log_stream_map((LOG_GROUP_NAME, lsn), None)
+                    logging.info("Log stream {}/{} not tracked - starting to track".format(log_group_name, lsn))
+                    gb.set_log_stream_map((log_group_name, lsn), None)
+                    self._streams_discovered.set()
             else:
-                logging.info("Stream {} already being processed".format(log_stream['logStreamName']))
-        logging.info("Log stream map: {}".format(gb.get_log_stream_map()))
+                logging.info("Stream {}/{} already being processed".format(log_group_name, lsn))
 
     def discover_log_streams(self):
         """
@@ -165,53 +286,80 @@ class LogStreamHandler(object):
 
     def sync_new_logs(self):
         """
-        Syncs the newly discovered log streams to the file system by starting off
-        a thread that consumes those logs. Also marks the MAP for those streams as being processed
+        Syncs the newly discovered log streams by scheduling them on the fetch worker pool.
+        Also marks the MAP for those streams as being processed
         """
 
+        self.scheduler.start()
         while True:
 
             new_streams = self._get_new_log_streams()
 
-            self.lock.acquire()
-            logging.info("New streams: {}".format(new_streams))
-
-            if not new_streams:
-                time.sleep(TIME_DAEMON_SLEEP)
-
             for log_group_name, log_stream_name in new_streams:
-                log_getter = threading.Thread(
-                    target=self.write_log, args=(log_group_name, log_stream_name, consumers))
-                logging.info("Consuming log stream: %s, %s %s", log_group_name, log_stream_name, log_getter)
-                gb.set_log_stream_map((log_group_name, log_stream_name), log_getter)
-                log_getter.start()
+                task = self.scheduler.add(log_group_name, log_stream_name)
+                logging.info("Consuming log stream: %s, %s %s", log_group_name, log_stream_name, task)
+                gb.set_log_stream_map((log_group_name, log_stream_name), task)
 
-            self.lock.release()
+            self._streams_discovered.wait(TIME_DAEMON_SLEEP)
+            self._streams_discovered.clear()
 
-    def persist_state(self, location='cwl.state'):
+    def resume_checkpointed_streams(self):
+        """
+        Schedules the streams of the tracked log groups found in the checkpoint right away, without
+        waiting for the first discovery pass: up to the stream lookback count of every group, the most
+        recently checkpointed first. Discovery stops the ones out of the lookback window later
+        returns: the number of streams resumed
+        """
+        self.scheduler.start()
+        resumed = {}  # key = log group name, value = number of its streams resumed
+        # the stores load the checkpoints least recently saved first
+        for key in reversed(list(gb.get_checkpoint())):
+            if key.startswith('@'):
+                continue  # filter sweeps, pushes and dedup windows
+            log_group_name, log_stream_name = split_checkpoint_key(key)
+            # the first selector matching a group sets its lookback count
+            stream_lookback_count = next((count for pattern, count in self.log_group_selectors
+                                          if glob_match(log_group_name, pattern)), None)
+            if stream_lookback_count is None or resumed.get(log_group_name, 0) >= stream_lookback_count:
+                continue
+            if not self._wanted_log_stream(log_stream_name) or gb.get_log_stream_map().get(
+                    (log_group_name, log_stream_name)):
+                continue
+            task = self.scheduler.add(log_group_name, log_stream_name)
+            gb.set_log_stream_map((log_group_name, log_stream_name), task)
+            resumed[log_group_name] = resumed.get(log_group_name, 0) + 1
+        return sum(resumed.values())
+
+    def _tracked_log_stream_names(self, log_group_name):
+        return [stream for group, stream in list(gb.get_log_stream_map()) if group == log_group_name]
+
+    def sync_filtered_logs(self):
         """
-        Persist the checkpoint state in a specific location
-        :param state: Dictionary of key = stream (id), value = next token  
-        :param location: location of file. #TODO save to s3 or dynamo later
+        The FilterLogEvents alternative to sync_new_logs: sweeps every tracked log group once per distinct
+        filter pattern of the consumers, so only the events a consumer wants are fetched for it
         """
 
-        state = {}
+        consumers_by_pattern = {}
+        for consumer in self.consumers:
+            consumers_by_pattern.setdefault(consumer.filter_pattern or '', []).append(consumer)
 
         while True:
-            state['modified_time'] = time.asctime()
-            state.update(gb.get_checkpoint())
-            state_json = json.dumps(state)
-            create_file_if_does_not_exist(location)
+            for log_group_name, _ in self._resolve_log_groups():
+                for filter_pattern, pattern_consumers in consumers_by_pattern.items():
+                    key = (log_group_name, filter_pattern)
+                    if key in self._filters and self._filters[key].is_alive():
+                        continue
+                    log_event_filter = LogEventFilter(
+                        self.aws_client, gb, log_group_name, filter_pattern, pattern_consumers,
+                        get_log_stream_names=lambda group=log_group_name: self._tracked_log_stream_names(group),
+                        dedup=self.dedup)
+                    log_getter = threading.Thread(target=log_event_filter.run, name='filter-{}'.format(log_group_name))
+                    log_getter.daemon = True
+                    logging.info("Filtering log group: %s for %r", log_group_name, filter_pattern)
+                    self._filters[key] = log_getter
+                    log_getter.start()
 
-            fhandle = open(location, 'w')
-            # handle the log events
-            fhandle.write(state_json)
-            fhandle.flush()
-            fhandle.close()
-
-            # with open(location, 'rb') as data:
-            #     s3_client.upload_fileobj(data, 'cloudwatch.mixpanel.state', "{}-state".format(CWL_ENV))
-            time.sleep(1)
+            time.sleep(TIME_DAEMON_SLEEP)
 
 
 def configure_logging():
@@ -230,8 +378,11 @@ class LogProcessMonitor(object):
     Monitors the processes that write to the logs
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, consumers=(), scheduler=None, pipeline=None, dedup=None):
+        self.consumers = consumers
+        self.scheduler = scheduler
+        self.pipeline = pipeline
+        self.dedup = dedup
 
     def log_status(self):
         """
@@ -244,55 +395,211 @@ class LogProcessMonitor(object):
                     "Log Group: {0}, Stream: {1} is processed by: {2}".format(
                         _log_group_stream[0], _log_group_stream[1], _processing_thread)
                 )
+            if self.scheduler is not None:
+                logging.info("Fetch workers: {}".format(self.scheduler.stats()))
+            if self.pipeline is not None:
+                logging.info("Pipeline: {}".format(self.pipeline.stats()))
+            for consumer in self.consumers:
+                stats = consumer.stats()
+                if stats:
+                    logging.info("Consumer {0}: {1}".format(type(consumer).__name__, stats))
+            # the polled streams drop their series when retired, the filtered and pushed ones once quiet
+            expire_stream_series(STREAM_IDLE_RETIRE_SECONDS)
+            if self.dedup is not None:
+                # and their dedup windows, deleted from the checkpoint with the next save
+                self.dedup.expire(STREAM_IDLE_RETIRE_SECONDS)
             time.sleep(TIME_DAEMON_SLEEP)
 
 
-def load_checkpoint():
-    try:
-        f = open('cwl.state', 'r')
-        checkpoint = f.read()
-        logging.info("checkpoint found")
-        checkpoint = json.loads(checkpoint)
+def load_checkpoint(store):
+    checkpoint = store.load()
+    if checkpoint:
         logging.info("parsed checkpoint is %s", checkpoint)
-        del checkpoint['modified_time']
-        for key, value in checkpoint.items():
-            gb.set_checkpoint(key, value)
-    except Exception as ex:
-        logging.warning("No checkpoint found {}".format(repr(ex)))
+    # checkpoints used to be keyed by the stream name alone, they belong to the single LOG_GROUP_NAME
+    legacy_keys = [key for key in checkpoint if ':' not in key]
+    legacy_checkpoint = dict((key, checkpoint.pop(key)) for key in legacy_keys)
+    gb.load_checkpoint(checkpoint)
+    if LOG_GROUP_NAME and not is_glob(LOG_GROUP_NAME):
+        for key, value in legacy_checkpoint.items():
+            # a scoped key was saved after the migration, it is newer than the legacy one
+            if checkpoint_key(LOG_GROUP_NAME, key) not in checkpoint:
+                gb.set_checkpoint(checkpoint_key(LOG_GROUP_NAME, key), value)
+            gb.delete_checkpoint(key)
+
+
+def save_state(store, dedup=None, consumers=()):
+    """
+    Saves the checkpoints changed since the last save, once the consumers flushed the pages acked before them
+    @param dedup: the EventDeduplicator whose windows are saved with them
+    @param consumers: the consumers to flush, the checkpoints are kept for the next save if one does not in time
+    """
+    if dedup is not None:
+        dedup.save_to(gb)
+    dirty = gb.pop_dirty_checkpoints()
+    if not dirty:
+        return
+    try:
+        if not flush_consumers(consumers, CHECKPOINT_FLUSH_TIMEOUT):
+            raise RuntimeError("the consumers did not flush within {}s".format(CHECKPOINT_FLUSH_TIMEOUT))
+        with CHECKPOINT_LATENCY.time():
+            store.save(dirty)
+    except Exception:
+        gb.restore_dirty_checkpoints(dirty)
+        raise
 
 
-if __name__ == '__main__':
-    try:
+def persist_state(store, dedup=None, interval=CHECKPOINT_COMMIT_INTERVAL, consumers=()):
+    """
+    Persist the checkpoint state, batching the changes of every interval into one save
+    :param store: the CheckpointStore to save to. #TODO save to s3 or dynamo later
+    :param dedup: the EventDeduplicator whose windows are saved with them
+    :param interval: time (in seconds) between saves
+    :param consumers: the consumers flushed before each save
+    """
 
-        configure_logging()
-        client = CloudWatchLogs(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, AWS_SESSION_TOKEN)
+    while True:
+        time.sleep(interval)
+        try:
+            save_state(store, dedup, consumers)
+        except Exception as ex:
+            logging.exception("Failed saving the checkpoint: {}".format(ex))
 
-        logstreamhandler = LogStreamHandler(client)
 
-        load_checkpoint()
+def register_metrics(consumers, scheduler=None, pipeline=None):
+    """
+    Points the gauges computed on collection at the running scheduler, pipeline and consumers
+    """
 
-        mp_consumer = MixpanelConsumer()
-        fs_consumer = FileSystemConsumer()
-        consumers = []
-        if MIXPANEL_TOKEN:
-            consumers.append(mp_consumer)
-        if AWS_LOGS_DIRECTORY:
-            consumers.append(fs_consumer)
+    def queue_depths():
+        depths = [({'consumer': 'pipeline_' + stage}, depth)
+                  for stage, depth in pipeline.stats().items()] if pipeline is not None else []
+        for consumer in consumers:
+            depth = consumer.stats().get('queue_depth')
+            if depth is not None:
+                depths.append(({'consumer': type(consumer).__name__}, depth))
+        return depths
+
+    if scheduler is not None:
+        if INGESTION_MODE == 'poll':
+            # the filter sweeps set the lag themselves
+            REGISTRY.set_gauge_callback(INGEST_LAG.name, scheduler.lags)
+        REGISTRY.set_gauge_callback(
+            POOL.name, lambda: [({'stat': stat}, value) for stat, value in scheduler.stats().items()])
+    REGISTRY.set_gauge_callback(CONSUMER_QUEUE_DEPTH.name, queue_depths)
+
+
+def build_consumers(worker_id=None):
+    """
+    Builds the consumers enabled by the configuration
+    @param worker_id: the number of the shard worker process building them, None in a single process
+    """
+    consumers = []
+    if MIXPANEL_TOKEN:
+        # only imported when reporting to Mixpanel
+        from cloudwatch.consumer_mixpanel import MixpanelConsumer
+        consumers.append(MixpanelConsumer())
+    if AWS_LOGS_DIRECTORY:
+        consumers.append(FileSystemConsumer())
+    if CONSOLE_OUTPUT:
+        consumers.append(ConsoleConsumer())
+    if S3_ARCHIVE_BUCKET:
+        # only imported when archiving, it needs boto3's S3 transfer manager
+        from cloudwatch.consumer_s3 import S3ArchiveConsumer
+        spill_directory = S3_SPILL_DIRECTORY
+        if worker_id is not None:
+            # a process uploads what a previous run left in its spill directory, the workers must not share one
+            spill_directory = os.path.join(S3_SPILL_DIRECTORY, 'worker-{}'.format(worker_id))
+        consumers.append(S3ArchiveConsumer(spill_directory=spill_directory))
+    return consumers
+
+
+def handle_sigterm(signum, frame):
+    # turn a SIGTERM into a regular exit so the consumers get to flush their buffers
+    sys.exit(0)
 
-        discover_log_streams_thread = threading.Thread(target=logstreamhandler.discover_log_streams, args=())
 
-        logs_getter_thread = threading.Thread(target=logstreamhandler.sync_new_logs, args=())
+if __name__ == '__main__':
+    consumers = []
+    logstreamhandler = None
+    router = None
+    receiver = None
+    checkpoint_store = None
+    dedup = None
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+
+        configure_logging()
+        validate_config()
+        phase_started = record_startup_phase('imports', IMPORT_STARTED)
+
+        checkpoint_store = get_checkpoint_store(CHECKPOINT_BACKEND, CHECKPOINT_LOCATION)
+        load_checkpoint(checkpoint_store)
+        if DEDUP:
+            dedup = EventDeduplicator()
+            dedup.load(gb.get_checkpoint())
+        phase_started = record_startup_phase('checkpoint', phase_started)
+
+        if INGESTION_MODE == 'push':
+            # the events come in through the subscription deliveries, nothing is discovered nor polled
+            consumers.extend(build_consumers())
+            receiver = PushReceiver(consumers, gb, dedup=dedup)
+            phase_started = record_startup_phase('consumers', phase_started)
+            register_metrics(consumers, pipeline=receiver.pipeline)
+            if METRICS_PORT:
+                start_metrics_server(METRICS_HOST, METRICS_PORT)
+            start_receiver_server(receiver, RECEIVER_HOST, RECEIVER_PORT)
+            process_monitor_thread = threading.Thread(target=LogProcessMonitor(
+                consumers, pipeline=receiver.pipeline, dedup=dedup).log_status, args=())
+            persist_stream_checkpoint = threading.Thread(
+                target=persist_state, args=(checkpoint_store, dedup), kwargs={'consumers': consumers})
+            workers = [process_monitor_thread, persist_stream_checkpoint]
+        else:
+            # the AWS client connects on its first call
+            client = CloudWatchLogs(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, AWS_SESSION_TOKEN)
+            if INGESTION_PROCESSES > 1 and INGESTION_MODE == 'poll':
+                # the worker processes build their own client and consumers, this process only coordinates
+                router = ShardRouter(INGESTION_PROCESSES, gb)
+                logstreamhandler = LogStreamHandler(client, scheduler=router)
+                dedup = None  # the workers deduplicate, their windows come back with their checkpoints
+            else:
+                consumers.extend(build_consumers())
+                logstreamhandler = LogStreamHandler(client, consumers, dedup=dedup)
+            phase_started = record_startup_phase('consumers', phase_started)
+            register_metrics(consumers, logstreamhandler.scheduler, logstreamhandler.pipeline)
+            if METRICS_PORT:
+                start_metrics_server(METRICS_HOST, METRICS_PORT)
+
+            persist_stream_checkpoint = threading.Thread(
+                target=persist_state, args=(checkpoint_store, dedup), kwargs={'consumers': consumers})
+            discover_log_streams_thread = threading.Thread(target=logstreamhandler.discover_log_streams, args=())
+
+            if INGESTION_MODE == 'filter':
+                logs_getter_thread = threading.Thread(target=logstreamhandler.sync_filtered_logs, args=())
+            else:
+                logs_getter_thread = threading.Thread(target=logstreamhandler.sync_new_logs, args=())
 
-        process_monitor_thread = threading.Thread(target=LogProcessMonitor().log_status, args=())
+            process_monitor_thread = threading.Thread(target=LogProcessMonitor(
+                consumers, logstreamhandler.scheduler, logstreamhandler.pipeline, dedup).log_status, args=())
 
-        persist_stream_checkpoint = threading.Thread(target=logstreamhandler.persist_state, args=())
+            workers = [discover_log_streams_thread, logs_getter_thread, process_monitor_thread,
+                       persist_stream_checkpoint]
 
-        workers = [discover_log_streams_thread, logs_getter_thread, process_monitor_thread, persist_stream_checkpoint]
+            if INGESTION_MODE == 'poll':
+                # the fetch workers pick them up in parallel while discovery runs
+                resumed = logstreamhandler.resume_checkpointed_streams()
+                logging.info("Resumed {} streams from the checkpoint".format(resumed))
+                phase_started = record_startup_phase('resume', phase_started)
+        if METRICS_SNAPSHOT_FILE:
+            workers.append(threading.Thread(
+                target=write_snapshots, args=(METRICS_SNAPSHOT_FILE, METRICS_SNAPSHOT_INTERVAL)))
 
         logging.info("Log stream map %s", gb.get_log_stream_map())
         for worker in workers:
             worker.daemon = True
             worker.start()
+        record_startup_phase('total', IMPORT_STARTED)
+        logging.info("Started in {}".format(
+            ', '.join('{}: {:.3f}s'.format(phase, value) for (phase,), value in STARTUP.samples())))
         while True:
             logging.info("Heartbeat")
             time.sleep(TIME_DAEMON_SLEEP)
@@ -307,3 +614,17 @@ if __name__ == '__main__':
 
     except KeyboardInterrupt as ex:
         logging.error("Keyboard interrupt received..")
+    finally:
+        if logstreamhandler is not None:
+            # let the consumers get the pages already fetched before they flush
+            logstreamhandler.pipeline.close(timeout=TIME_DAEMON_SLEEP)
+        if receiver is not None:
+            receiver.close(timeout=TIME_DAEMON_SLEEP)
+        if router is not None:
+            # the workers consume what they fetched and report their last checkpoints
+            router.close(timeout=TIME_DAEMON_SLEEP * 2)
+        for consumer in consumers:
+            consumer.close()
+        if checkpoint_store is not None:
+            save_state(checkpoint_store, dedup)
+            checkpoint_store.close()
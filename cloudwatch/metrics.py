@@ -0,0 +1,395 @@
+"""
+Module to instrument the daemon: counters, gauges and histograms exposed in the Prometheus text
+format over HTTP and as periodic JSON snapshots
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs) + '}'
+
+
+class Metric(object):
+    """
+    A metric and its values per label values
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = Lock()
+        self._values = {}  # key = tuple of label values
+        self._updated = {}  # key = tuple of label values, value = time.monotonic() of the last update
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def remove(self, **labels):
+        """
+        Drops the series matching the label values given, e.g. every series of a stream
+        """
+        match = [(self.labelnames.index(name), value) for name, value in labels.items()]
+        with self.lock:
+            for key in [key for key in self._values if all(key[i] == value for i, value in match)]:
+                del self._values[key]
+                self._updated.pop(key, None)
+
+    def expire(self, max_age):
+        """
+        Drops the series not updated for max_age seconds
+        """
+        cutoff = time.monotonic() - max_age
+        with self.lock:
+            for key in [key for key in self._values if self._updated[key] < cutoff]:
+                del self._values[key]
+                self._updated.pop(key, None)
+
+    def samples(self):
+        """
+        returns: list of tuples of (label values, value)
+        """
+        with self.lock:
+            return list(self._values.items())
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + value
+            self._updated[key] = time.monotonic()
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        """
+        @param callback: when set, called on collection and returns list of tuples of (labels dict, value)
+        """
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self._values[key] = value
+            self._updated[key] = time.monotonic()
+
+    def samples(self):
+        if self.callback is None:
+            return super(Gauge, self).samples()
+        try:
+            return [(self._key(labels), value) for labels, value in self.callback()]
+        except Exception as ex:
+            logging.exception("Failed collecting {}: {}".format(self.name, ex))
+            return []
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            values = self._values.get(key)
+            if values is None:
+                # counts per bucket (the last one is +Inf), sum
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            values[0][bisect.bisect_left(self.buckets, value)] += 1
+            values[1] += value
+            self._updated[key] = time.monotonic()
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            return [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+
+    def quantile(self, q, counts):
+        """
+        Estimates a quantile from the bucket counts, interpolating inside the bucket
+        """
+        count = sum(counts)
+        if not count:
+            return None
+        rank = q * count
+        cumulative = 0
+        for i, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0
+                if i == len(self.buckets):
+                    return lower  # in the +Inf bucket, the best bound we have
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+
+class _Timer(object):
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.start, **self.labels)
+
+
+class Registry(object):
+    """
+    The metrics of the process
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.metrics = {}
+        self._merged = {}  # key = worker, value = the samples it exported, by metric name
+
+    def _register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def set_gauge_callback(self, name, callback):
+        """
+        Points a callback gauge at the objects that compute it, once they exist
+        """
+        self.metrics[name].callback = callback
+
+    def export(self, exclude=()):
+        """
+        returns: the samples of the metrics by name, to be merged into the registry of another process
+        @param exclude: names of the metrics not to export, e.g. the ones the other process collects itself
+        """
+        return dict((metric.name, metric.samples()) for metric in self.metrics.values() if metric.name not in exclude)
+
+    def merge(self, worker, samples):
+        """
+        Replaces the samples merged from a worker process (see export), they are collected with a worker label
+        """
+        with self.lock:
+            self._merged[worker] = samples
+
+    def _collect(self, metric):
+        """
+        returns: list of tuples of (label names, label values, value) of the metric and of its merged samples
+        """
+        with self.lock:
+            merged = [(worker, samples.get(metric.name, ())) for worker, samples in self._merged.items()]
+        collected = [(metric.labelnames, labelvalues, value) for labelvalues, value in metric.samples()]
+        for worker, samples in merged:
+            collected.extend((metric.labelnames + ('worker',), tuple(labelvalues) + (worker,), value)
+                             for labelvalues, value in samples)
+        return collected
+
+    def render_prometheus(self):
+        """
+        returns: the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in sorted(self.metrics.values(), key=lambda metric: metric.name):
+            lines.append('# HELP {} {}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for labelnames, labelvalues, value in self._collect(metric):
+                if metric.kind != 'histogram':
+                    lines.append('{}{} {}'.format(metric.name, _format_labels(labelnames, labelvalues), value))
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        metric.name, _format_labels(labelnames, labelvalues, ('le', bound)), cumulative))
+                labels = _format_labels(labelnames, labelvalues)
+                lines.append('{}_sum{} {}'.format(metric.name, labels, total))
+                lines.append('{}_count{} {}'.format(metric.name, labels, cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        returns: the metrics as a dict, histograms summarized by count, sum, p50 and p99
+        """
+        snapshot = {}
+        for metric in self.metrics.values():
+            samples = []
+            for labelnames, labelvalues, value in self._collect(metric):
+                sample = {'labels': dict(zip(labelnames, labelvalues))}
+                if metric.kind == 'histogram':
+                    counts, total = value
+                    sample.update(count=sum(counts), sum=total,
+                                  p50=metric.quantile(.5, counts), p99=metric.quantile(.99, counts))
+                else:
+                    sample['value'] = value
+                samples.append(sample)
+            snapshot[metric.name] = {'type': metric.kind, 'samples': samples}
+        return snapshot
+
+
+REGISTRY = Registry()
+
+# per stream
+EVENTS = REGISTRY.counter('cwl_events_total', "Log events fetched", ('log_group', 'log_stream'))
+BYTES = REGISTRY.counter('cwl_bytes_total', "Bytes of log messages fetched", ('log_group', 'log_stream'))
+API_LATENCY = REGISTRY.histogram(
+    'cwl_api_latency_seconds', "CloudWatch Logs API call latency", ('operation', 'log_group', 'log_stream'))
+THROTTLES = REGISTRY.counter(
+    'cwl_throttles_total', "Throttled CloudWatch Logs API calls", ('operation', 'log_group', 'log_stream'))
+INGEST_LAG = REGISTRY.gauge(
+    'cwl_ingest_lag_seconds', "Wall clock minus the newest event timestamp seen", ('log_group', 'log_stream'))
+# per consumer
+CONSUMER_LATENCY = REGISTRY.histogram(
+    'cwl_consumer_processing_seconds', "Time a consumer takes to process a page", ('consumer',))
+CONSUMER_QUEUE_DEPTH = REGISTRY.gauge(
+    'cwl_consumer_queue_depth', "Items waiting in a consumer or pipeline queue", ('consumer',))
+# process
+THREADS = REGISTRY.gauge(
+    'cwl_threads', "Live threads", callback=lambda: [({}, threading.active_count())])
+POOL = REGISTRY.gauge('cwl_fetch_pool', "Fetch worker pool stats", ('stat',))
+CHECKPOINT_LATENCY = REGISTRY.histogram('cwl_checkpoint_write_seconds', "Checkpoint save latency")
+STARTUP = REGISTRY.gauge('cwl_startup_seconds', "Time taken by the startup phases", ('phase',))
+STREAM_METRICS = (EVENTS, BYTES, API_LATENCY, THROTTLES, INGEST_LAG)  # labelled by log_group and log_stream
+
+
+def record_startup_phase(phase, started):
+    """
+    Sets the time taken by a startup phase
+    @param started: time.monotonic() at the start of the phase
+    returns: time.monotonic() now, the start of the next phase
+    """
+    now = time.monotonic()
+    STARTUP.set(now - started, phase=phase)
+    return now
+
+
+def record_events(log_group_name, log_stream_name, log_events):
+    """
+    Counts the fetched events and bytes of a stream
+    """
+    if log_events:
+        EVENTS.inc(len(log_events), log_group=log_group_name, log_stream=log_stream_name)
+        BYTES.inc(sum(len(log_event['message']) for log_event in log_events),
+                  log_group=log_group_name, log_stream=log_stream_name)
+
+
+def forget_stream(log_group_name, log_stream_name):
+    """
+    Drops the series of a stream that is no longer read, so the streams coming and going do not grow the metrics
+    """
+    for metric in STREAM_METRICS:
+        metric.remove(log_group=log_group_name, log_stream=log_stream_name)
+
+
+def expire_stream_series(max_age):
+    """
+    Drops the per stream series not updated for max_age seconds, for the streams nothing retires
+    (the filter sweeps and the push receiver label every stream of a group)
+    """
+    for metric in STREAM_METRICS:
+        metric.expire(max_age)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = self.registry.render_prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(self.registry.snapshot()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep the scrapes out of the daemon log
+
+
+def start_metrics_server(host, port, registry=REGISTRY):
+    """
+    Serves /metrics (Prometheus) and /metrics.json on a daemon thread
+    returns: the server
+    """
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    logging.info("Serving metrics on http://{}:{}/metrics".format(host, server.server_port))
+    return server
+
+
+def write_snapshots(location, interval, registry=REGISTRY):
+    """
+    Writes a JSON snapshot of the metrics every interval, with the per second rate of
+    the counters since the previous snapshot
+    """
+    previous, previous_time = {}, time.monotonic()
+    while True:
+        time.sleep(interval)
+        now = time.monotonic()
+        snapshot = registry.snapshot()
+        current = {}
+        for name, metric in snapshot.items():
+            if metric['type'] != 'counter':
+                continue
+            for sample in metric['samples']:
+                key = (name, tuple(sorted(sample['labels'].items())))
+                current[key] = sample['value']
+                sample['rate'] = (sample['value'] - previous.get(key, 0)) / (now - previous_time)
+        previous, previous_time = current, now
+        snapshot['time'] = time.time()
+        tmp_location = location + '.tmp'
+        try:
+            with open(tmp_location, 'w') as fhandle:
+                json.dump(snapshot, fhandle)
+            os.replace(tmp_location, location)
+        except Exception as ex:
+            logging.exception("Failed writing the metrics snapshot: {}".format(ex))
@@ -0,0 +1,191 @@
+"""
+Module to run the decode and consume work of the fetched pages off the fetch threads.
+
+Pages flow fetch -> decode -> consume through bounded queues. Every stage has its own worker
+threads and each worker its own queue; the pages of a stream always go to the same worker so
+they stay in order. A full queue blocks the stage feeding it, which slows down fetching when
+the consumers fall behind. The checkpoint of a page only advances once every consumer got it,
+and it is only saved once they flushed it (see BaseConsumer.flush).
+When a consumer fails on a page of a polled stream, the pages fetched after it are dropped and
+the stream is fetched again from that page
+"""
+import logging
+import threading
+import zlib
+from queue import Queue
+from threading import Lock
+
+from cloudwatch.config import PIPELINE_CONSUME_WORKERS, PIPELINE_DECODE_WORKERS, PIPELINE_QUEUE_SIZE
+from cloudwatch.decoding import DecodeStage
+from cloudwatch.metrics import CONSUMER_LATENCY
+from cloudwatch.utils import checkpoint_key
+
+STOP = object()  # queued to stop a stage worker
+
+
+class Page(object):
+    """
+    A page of log events fetched from a stream and the checkpoint to save once it is consumed
+    """
+
+    def __init__(self, log_group_name, log_stream_name, log_events, checkpoint=None, generation=None):
+        """
+        @param checkpoint: tuple of (checkpoint key, value) to set once every consumer got the page
+        @param generation: how many times the stream was fetched again after a failed page, when the page
+        was fetched. None for the pages that are not fetched again (the sender retries them)
+        """
+        self.log_group_name = log_group_name
+        self.log_stream_name = log_stream_name
+        self.log_events = log_events
+        self.checkpoint = checkpoint
+        self.generation = generation
+        self.selected = []  # list of tuples of (consumer, the log events it wants)
+
+    @property
+    def key(self):
+        return (self.log_group_name, self.log_stream_name)
+
+
+class Stage(object):
+    """
+    A pool of worker threads, each reading from its own bounded queue, running handler on the items
+    """
+
+    def __init__(self, name, handler, workers, queue_size):
+        self.name = name
+        self.handler = handler
+        self.queues = [Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        for i, queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._work, args=(queue,), name='{}-{}'.format(name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, key, item):
+        """
+        Queues the item on the worker owning the key, blocks while that worker's queue is full
+        """
+        shard = zlib.crc32(repr(key).encode('utf-8')) % len(self.queues)
+        self.queues[shard].put(item)
+
+    def _work(self, queue):
+        while True:
+            item = queue.get()
+            if item is STOP:
+                return
+            try:
+                self.handler(item)
+            except Exception as ex:
+                logging.exception("Stage {} failed on {}: {}".format(self.name, item, ex))
+
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def close(self, timeout=None):
+        """
+        Stops the workers once they have worked through their queues
+        """
+        for queue in self.queues:
+            queue.put(STOP)
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+class Pipeline(object):
+    """
+    Decodes and consumes the fetched pages on their own worker pools
+    """
+
+    def __init__(self, consumers, on_ack, decode_workers=PIPELINE_DECODE_WORKERS,
+                 consume_workers=PIPELINE_CONSUME_WORKERS, queue_size=PIPELINE_QUEUE_SIZE, dedup=None, on_failure=None):
+        """
+        @param consumers: list of consumers of type BaseConsumer
+        @param on_ack: called with (checkpoint key, value) once every consumer got a page
+        @param dedup: EventDeduplicator dropping the events the consumers already got, None to keep them all
+        @param on_failure: called with the page when a consumer failed on it, to fetch its stream again from it
+        """
+        self.consumers = consumers
+        self.on_ack = on_ack
+        self.dedup = dedup
+        self.on_failure = on_failure
+        self.lock = Lock()
+        self._failed = {}  # key = (log group name, log stream name), value = generation of the failed page
+        self.consume_stage = Stage('consume', self._consume, consume_workers, queue_size)
+        self.decode_stage = Stage('decode', self._decode, decode_workers, queue_size)
+
+    def submit(self, page):
+        """
+        Queues a fetched page, blocks while the pipeline is full
+        """
+        self.decode_stage.put(page.key, page)
+
+    def _is_stale(self, page, consuming=False):
+        """
+        returns: whether the page was fetched after a failed page of its stream, and before it is fetched again
+        """
+        if page.generation is None:
+            return False
+        with self.lock:
+            failed = self._failed.get(page.key)
+            if failed is None:
+                return False
+            if page.generation > failed:
+                if consuming:
+                    # the older pages of the stream are all consumed or dropped by now
+                    del self._failed[page.key]
+                return False
+            return True
+
+    def _decode(self, page):
+        if self._is_stale(page):
+            return
+        if page.log_events:
+            for consumer in self.consumers:
+                selected = DecodeStage.select(consumer, page.log_events)
+                if selected:
+                    page.selected.append((consumer, selected))
+        self.consume_stage.put(page.key, page)
+
+    def _consume(self, page):
+        if self._is_stale(page, consuming=True):
+            return
+        selected = page.selected
+        if self.dedup is not None and page.log_events:
+            # filtered here, where the pages of a stream are consumed one at a time, so a failed page
+            # is the only one of its stream whose events are not committed yet
+            new_events = self.dedup.filter(checkpoint_key(*page.key), page.log_events)
+            if len(new_events) < len(page.log_events):
+                kept = set(id(log_event) for log_event in new_events)
+                selected = [(consumer, [log_event for log_event in log_events if id(log_event) in kept])
+                            for consumer, log_events in selected]
+                selected = [(consumer, log_events) for consumer, log_events in selected if log_events]
+            page.log_events = new_events
+        try:
+            for consumer, log_events in selected:
+                with CONSUMER_LATENCY.time(consumer=type(consumer).__name__):
+                    consumer.process_batch(log_events, page.log_group_name, page.log_stream_name)
+        except Exception:
+            if self.dedup is not None:
+                # the events are read (or delivered) again, they must not be taken for duplicates then
+                self.dedup.rollback(checkpoint_key(*page.key))
+            if page.generation is not None:
+                with self.lock:
+                    self._failed[page.key] = page.generation
+            if self.on_failure:
+                self.on_failure(page)
+            raise
+        if self.dedup is not None:
+            self.dedup.commit(checkpoint_key(*page.key), len(page.log_events))
+        if page.checkpoint:
+            self.on_ack(*page.checkpoint)
+
+    def stats(self):
+        return {'decode_queue': self.decode_stage.depth(), 'consume_queue': self.consume_stage.depth()}
+
+    def close(self, timeout=None):
+        """
+        Works through the queued pages and stops the workers
+        """
+        self.decode_stage.close(timeout)
+        self.consume_stage.close(timeout)
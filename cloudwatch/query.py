@@ -0,0 +1,34 @@
+"""
+Queries the log files downloaded by the FileSystemConsumer by time range and indexed fields
+
+usage: python -m cloudwatch.query --group /ecs/api --stream 'api/api/1234' \\
+           --start 2020-05-01T10:00 --end 2020-05-01T10:05 --where app_id=X
+"""
+import argparse
+import os
+import sys
+
+from slugify import slugify
+
+from cloudwatch.utils import parse_time
+from cloudwatch.index import query
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the downloaded logs of a stream")
+    parser.add_argument('--group', required=True, help="log group name")
+    parser.add_argument('--stream', required=True, help="log stream name")
+    parser.add_argument('--start', help="range start, epoch ms or ISO 8601 (UTC)")
+    parser.add_argument('--end', help="range end, epoch ms or ISO 8601 (UTC)")
+    parser.add_argument('--where', action='append', default=[], help="field=value the events must have (repeatable)")
+    parser.add_argument('--directory', default=os.environ.get('AWS_LOGS_DIRECTORY') or '/var/log/cloudwatchlogs')
+    args = parser.parse_args()
+
+    path = os.path.join(args.directory, slugify(args.group), slugify(args.stream) + '.log')
+    for line in query(path, start_time=parse_time(args.start) if args.start else None,
+                      end_time=parse_time(args.end) if args.end else None, where=args.where):
+        sys.stdout.write(line + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Module to pace the calls made to the cloudwatch logs API
+"""
+import random
+import time
+from threading import Lock
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket. Tokens refill continuously at `rate` per second
+    up to `capacity`, every call to the API takes one out
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("Token bucket rate must be positive, got {}".format(rate))
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until the requested tokens are available and takes them
+        @param tokens: number of tokens to take out of the bucket
+        """
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def backoff_delay(attempt, base, cap):
+    """
+    Exponential backoff with full jitter
+    @param attempt: the retry attempt, starting at 0
+    @param base: the delay (in seconds) of the first attempt
+    @param cap: the max delay (in seconds)
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class AdaptivePoller(object):
+    """
+    Decides how long a stream should wait before its next poll based on how full
+    the last page was: full pages are fetched again right away, partial pages wait
+    the base delay and empty pages back off exponentially up to the max delay
+    """
+
+    def __init__(self, base_delay, max_delay):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.delay = base_delay
+
+    def next_delay(self, event_count, batch_limit):
+        """
+        Returns the time (in seconds) to wait before the next poll
+        @param event_count: number of events returned by the last poll
+        @param batch_limit: the max number of events a poll can return
+        """
+        if event_count >= batch_limit:
+            self.delay = self.base_delay
+            return 0
+        if event_count:
+            self.delay = self.base_delay
+        else:
+            self.delay = min(self.max_delay, self.delay * 2)
+        return self.delay
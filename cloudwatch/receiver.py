@@ -0,0 +1,258 @@
+"""
+Module to receive the log events CloudWatch Logs pushes through a subscription filter, instead of polling the streams.
+
+Subscription deliveries are gzipped JSON documents (logGroup, logStream, logEvents), base64 encoded as the data of
+Kinesis Data Firehose HTTP endpoint records or of Kinesis records. A delivery is answered once every consumer got
+its events, so a delivery that failed or timed out is retried by the sender. The newest event timestamp pushed for
+a log group is checkpointed under a '@push:' key, a backfill of a group can start from it
+
+usage (sends the lines of stdin as one delivery, to try the receiver with locally generated payloads):
+    python -m cloudwatch.receiver --url http://127.0.0.1:8081/ --group /ecs/api --stream api/1234 < lines.txt
+"""
+import argparse
+import base64
+import gzip
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from cloudwatch.config import *
+from cloudwatch.consumer_abstract import flush_consumers
+from cloudwatch.metrics import INGEST_LAG, record_events
+from cloudwatch.pipeline import Page, Pipeline
+from cloudwatch.utils import push_checkpoint_key
+
+DATA_MESSAGE = 'DATA_MESSAGE'  # CONTROL_MESSAGE deliveries only check that the destination is reachable
+
+
+def decode_record(data):
+    """
+    Decodes the data of a Firehose/Kinesis record into the subscription delivery
+    @param data: base64 string (or bytes) of the gzipped delivery
+    returns: the delivery [dict]
+    """
+    return json.loads(gzip.decompress(base64.b64decode(data)))
+
+
+def encode_record(log_group_name, log_stream_name, log_events, message_type=DATA_MESSAGE):
+    """
+    Encodes log events the way CloudWatch Logs delivers them to a subscription
+    @param log_events: list of dict with id, timestamp and message
+    returns: the base64 string of the record data
+    """
+    delivery = {
+        'messageType': message_type,
+        'owner': '000000000000',
+        'logGroup': log_group_name,
+        'logStream': log_stream_name,
+        'subscriptionFilters': ['cloudwatchlogs'],
+        'logEvents': log_events,
+    }
+    return base64.b64encode(gzip.compress(json.dumps(delivery).encode('utf-8'))).decode('ascii')
+
+
+def record_data(body):
+    """
+    returns: list of the record data of a request body, a Firehose HTTP endpoint delivery ({"records": [{"data"}]})
+    or Kinesis records ({"Records": [{"kinesis": {"data"}}]})
+    """
+    if 'records' in body:
+        return [record['data'] for record in body['records']]
+    if 'Records' in body:
+        return [record['kinesis']['data'] for record in body['Records']]
+    raise ValueError("Expected a Firehose or a Kinesis delivery")
+
+
+class Delivery(object):
+    """
+    The pages of a request waiting to be consumed
+    """
+
+    def __init__(self, pages):
+        self.pending = pages
+        self.done = threading.Event()
+        if not pages:
+            self.done.set()
+
+
+class PushReceiver(object):
+    """
+    Decodes the subscription deliveries and hands their events to the consumers through the pipeline
+    """
+
+    def __init__(self, consumers, gb, ack_timeout=RECEIVER_ACK_TIMEOUT, dedup=None):
+        """
+        @param consumers: list of consumers of type BaseConsumer
+        @param gb: global manager object to set the checkpoints
+        @param ack_timeout: seconds a request waits for the consumers before it is failed (and retried by the sender)
+        @param dedup: EventDeduplicator dropping the events of the deliveries retried after a partial failure
+        """
+        self.gb = gb
+        self.ack_timeout = ack_timeout
+        self.pipeline = Pipeline(consumers, on_ack=self._ack, dedup=dedup)
+        self.lock = Lock()
+        self.counters = {'requests': 0, 'records': 0, 'events': 0, 'failed': 0}
+
+    def _count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def _ack(self, delivery, checkpoint):
+        log_group_name, timestamp = checkpoint
+        key = push_checkpoint_key(log_group_name)
+        with self.lock:
+            current = self.gb.get_checkpoint().get(key)
+            if current is None or timestamp > current:
+                self.gb.set_checkpoint(key, timestamp)
+            delivery.pending -= 1
+            if not delivery.pending:
+                delivery.done.set()
+
+    def receive(self, records):
+        """
+        Decodes a batch of records and queues their events on the pipeline, one page per stream
+        @param records: list of record data
+        returns: the Delivery, done once every consumer got the events
+        """
+        pages = OrderedDict()  # key = (log group name, log stream name), value = the log events
+        for data in records:
+            delivery = decode_record(data)
+            if delivery.get('messageType') != DATA_MESSAGE:
+                continue
+            log_events = pages.setdefault((delivery['logGroup'], delivery['logStream']), [])
+            for log_event in delivery['logEvents']:
+                # shaped like the FilterLogEvents events
+                log_events.append({'eventId': log_event['id'], 'timestamp': log_event['timestamp'],
+                                   'message': log_event['message'], 'logStreamName': delivery['logStream']})
+        self._count('records', len(records))
+
+        pages = [(key, log_events) for key, log_events in pages.items() if log_events]
+        result = Delivery(len(pages))
+        for (log_group_name, log_stream_name), log_events in pages:
+            log_events.sort(key=lambda log_event: log_event['timestamp'])
+            self._count('events', len(log_events))
+            record_events(log_group_name, log_stream_name, log_events)
+            INGEST_LAG.set(time.time() - log_events[-1]['timestamp'] / 1000,
+                           log_group=log_group_name, log_stream=log_stream_name)
+            self.pipeline.submit(Page(log_group_name, log_stream_name, log_events,
+                                      (result, (log_group_name, log_events[-1]['timestamp']))))
+        return result
+
+    def handle(self, body):
+        """
+        Receives a request body and waits for its events to be consumed and flushed by the consumers
+        returns: whether every event was consumed in time
+        """
+        self._count('requests')
+        deadline = time.monotonic() + self.ack_timeout
+        delivered = self.receive(record_data(body)).done.wait(self.ack_timeout) and flush_consumers(
+            self.pipeline.consumers, max(0, deadline - time.monotonic()))
+        if not delivered:
+            self._count('failed')
+        return delivered
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats.update(self.pipeline.stats())
+        return stats
+
+    def close(self, timeout=None):
+        self.pipeline.close(timeout)
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    receiver = None
+    access_key = None
+
+    def _respond(self, status, request_id, error=None):
+        response = {'requestId': request_id, 'timestamp': int(time.time() * 1000)}
+        if error:
+            response['errorMessage'] = error
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request_id = self.headers.get('X-Amz-Firehose-Request-Id')
+        if self.access_key and self.headers.get('X-Amz-Firehose-Access-Key') != self.access_key:
+            self._respond(401, request_id, "Invalid access key")
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if self.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            body = json.loads(body)
+            request_id = body.get('requestId', request_id)
+            delivered = self.receiver.handle(body)
+        except (ValueError, KeyError, TypeError, OSError) as ex:
+            logging.warning("Rejected a delivery: {}".format(ex))
+            self._respond(400, request_id, str(ex))
+            return
+        if delivered:
+            self._respond(200, request_id)
+        else:
+            self._respond(503, request_id, "The consumers did not get the events in time")
+
+    def log_message(self, format, *args):
+        pass  # every delivery would be logged
+
+
+def start_receiver_server(receiver, host, port, access_key=RECEIVER_ACCESS_KEY):
+    """
+    Serves the subscription deliveries on a daemon thread
+    returns: the server
+    """
+    handler = type('BoundReceiverHandler', (ReceiverHandler,), {'receiver': receiver, 'access_key': access_key})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='receiver-server')
+    thread.daemon = True
+    thread.start()
+    logging.info("Receiving subscription deliveries on http://{}:{}/".format(host, server.server_port))
+    return server
+
+
+def send(url, log_group_name, log_stream_name, messages, access_key=None):
+    """
+    Posts messages as a Firehose HTTP endpoint delivery of one record
+    returns: the HTTP status
+    """
+    now = int(time.time() * 1000)
+    log_events = [{'id': uuid.uuid4().hex, 'timestamp': now, 'message': message} for message in messages]
+    body = json.dumps({'requestId': uuid.uuid4().hex, 'timestamp': now,
+                       'records': [{'data': encode_record(log_group_name, log_stream_name, log_events)}]})
+    request = Request(url, data=body.encode('utf-8'), headers={'Content-Type': 'application/json'})
+    if access_key:
+        request.add_header('X-Amz-Firehose-Access-Key', access_key)
+    try:
+        with urlopen(request) as response:
+            return response.status
+    except HTTPError as ex:
+        return ex.code
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send the lines of stdin to the receiver as a subscription delivery")
+    parser.add_argument('--url', required=True, help="receiver URL")
+    parser.add_argument('--group', required=True, help="log group name")
+    parser.add_argument('--stream', required=True, help="log stream name")
+    parser.add_argument('--access-key', default=RECEIVER_ACCESS_KEY)
+    args = parser.parse_args()
+    messages = [line.rstrip('\n') for line in sys.stdin if line.strip()]
+    print(send(args.url, args.group, args.stream, messages, args.access_key))
+
+
+if __name__ == '__main__':
+    main()
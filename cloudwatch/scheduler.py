@@ -0,0 +1,217 @@
+"""
+Module to schedule the log stream fetches on a fixed pool of worker threads
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+from threading import Condition
+
+from cloudwatch.config import *
+from cloudwatch.metrics import record_events
+from cloudwatch.ratelimit import AdaptivePoller
+from cloudwatch.utils import checkpoint_key
+
+
+class StreamTask(object):
+    """
+    A tracked log stream: when it is due for its next poll and how far behind it is
+    """
+
+    def __init__(self, log_group_name, log_stream_name, poller, token=None):
+        self.log_group_name = log_group_name
+        self.log_stream_name = log_stream_name
+        self.key = checkpoint_key(log_group_name, log_stream_name)
+        self.poller = poller
+        # the token of the next fetch, ahead of the checkpoint until the pages in between are consumed
+        self.token = token
+        self.next_due = time.monotonic()
+        self.last_active = time.monotonic()  # last time a poll returned events
+        self.last_event_timestamp = None  # newest event timestamp (ms) seen
+        self.generation = 0  # times the stream was fetched again from a failed page
+        self.polling = False
+        self.retired = False
+
+    def lag(self):
+        """
+        returns: seconds between now and the newest event seen, 0 if no event was seen yet
+        """
+        if self.last_event_timestamp is None:
+            return 0
+        return max(0, time.time() - self.last_event_timestamp / 1000)
+
+    def __repr__(self):
+        return "StreamTask({}, lag={:.1f}s, next poll in {:.1f}s)".format(
+            self.key, self.lag(), max(0, self.next_due - time.monotonic()))
+
+
+class StreamScheduler(object):
+    """
+    Runs the polls of all the tracked streams on a fixed size pool of worker threads.
+    Streams are picked by when they are next due, and among due streams by how far behind they are.
+    A stream is retired when it has been idle for idle_retire_seconds or when it is removed
+    """
+
+    def __init__(self, client, gb, on_events, workers=FETCH_WORKERS, batch_limit=BATCH_SIZE,
+                 idle_retire_seconds=STREAM_IDLE_RETIRE_SECONDS, on_retire=None):
+        """
+        @param client: the CloudWatchLogs client
+        @param gb: global manager object to get the checkpoints the streams start from
+        @param on_events: called with (log group name, log stream name, events, (checkpoint key, token), generation)
+        for every page that has events or moves the token. The callee saves the checkpoint once the page is consumed
+        @param workers: number of fetch worker threads
+        @param batch_limit: the max number of log events per poll
+        @param idle_retire_seconds: retire a stream once it returned no events for that long
+        @param on_retire: called with (log group name, log stream name) when a stream is retired
+        """
+        self.client = client
+        self.gb = gb
+        self.on_events = on_events
+        self.workers = workers
+        self.batch_limit = batch_limit
+        self.idle_retire_seconds = idle_retire_seconds
+        self.on_retire = on_retire
+        self.condition = Condition()
+        self._heap = []  # entries of (next due, -lag, sequence, task)
+        self._sequence = itertools.count()
+        self._tasks = {}  # key = (log group name, log stream name), value = StreamTask
+        self._threads = []
+        self._busy = 0
+
+    def _push(self, task):
+        heapq.heappush(self._heap, (task.next_due, -task.lag(), next(self._sequence), task))
+        self.condition.notify()
+
+    def add(self, log_group_name, log_stream_name):
+        """
+        Starts tracking a log stream, a stream already tracked is left as is
+        returns: the StreamTask of the stream
+        """
+        with self.condition:
+            task = self._tasks.get((log_group_name, log_stream_name))
+            if task is None:
+                task = StreamTask(
+                    log_group_name, log_stream_name, AdaptivePoller(TIME_LOG_POLL_SLEEP, TIME_LOG_POLL_MAX_SLEEP),
+                    token=self.gb.get_checkpoint().get(checkpoint_key(log_group_name, log_stream_name)))
+                self._tasks[(log_group_name, log_stream_name)] = task
+                self._push(task)
+            return task
+
+    def remove(self, log_group_name, log_stream_name):
+        """
+        Stops tracking a log stream, a poll in progress finishes first
+        """
+        with self.condition:
+            task = self._tasks.pop((log_group_name, log_stream_name), None)
+            if task is not None:
+                task.retired = True
+
+    def rewind(self, log_group_name, log_stream_name, generation):
+        """
+        Fetches the stream again from its checkpoint, the start of the page the consumers failed on.
+        The pages fetched since belong to the older generation and are dropped by the pipeline
+        @param generation: the generation of the failed page
+        """
+        with self.condition:
+            task = self._tasks.get((log_group_name, log_stream_name))
+            if task is None or task.generation > generation:
+                return  # removed, or rewound already
+            task.generation = generation + 1
+            task.token = self.gb.get_checkpoint().get(task.key)
+            logging.warning("Fetching {} again from its checkpoint after a failed page".format(task.key))
+            if not task.polling:
+                # a poll in progress comes back right away, an idle stream is due now
+                task.next_due = time.monotonic()
+                self._push(task)
+
+    def tracked(self):
+        with self.condition:
+            return list(self._tasks)
+
+    def stats(self):
+        with self.condition:
+            return {'workers': self.workers, 'busy': self._busy, 'streams': len(self._tasks)}
+
+    def lags(self):
+        """
+        returns: list of tuples of (labels, ingest lag in seconds) of the tracked streams that have seen events
+        """
+        with self.condition:
+            tasks = list(self._tasks.values())
+        return [({'log_group': task.log_group_name, 'log_stream': task.log_stream_name}, task.lag())
+                for task in tasks if task.last_event_timestamp is not None]
+
+    def start(self):
+        if self._threads:
+            return  # already running
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work, name='stream-worker-{}'.format(i))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def _next_task(self):
+        with self.condition:
+            while True:
+                if self._heap:
+                    next_due, _, _, task = self._heap[0]
+                    if task.retired or next_due != task.next_due:
+                        # removed, or pushed again since with another due time
+                        heapq.heappop(self._heap)
+                        continue
+                    wait = next_due - time.monotonic()
+                    if wait <= 0:
+                        heapq.heappop(self._heap)
+                        self._busy += 1
+                        task.polling = True
+                        return task
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+
+    def _work(self):
+        while True:
+            task = self._next_task()
+            try:
+                delay = self._poll(task)
+            except Exception as ex:
+                logging.exception("Failed polling {}: {}".format(task.key, ex))
+                delay = TIME_LOG_POLL_MAX_SLEEP
+            with self.condition:
+                self._busy -= 1
+                task.polling = False
+                if task.retired:
+                    continue
+                if time.monotonic() - task.last_active > self.idle_retire_seconds:
+                    logging.info("Retiring idle log stream {}".format(task.key))
+                    self._tasks.pop((task.log_group_name, task.log_stream_name), None)
+                    task.retired = True
+                else:
+                    task.next_due = time.monotonic() + delay
+                    self._push(task)
+            if task.retired and self.on_retire:
+                self.on_retire(task.log_group_name, task.log_stream_name)
+
+    def _poll(self, task):
+        """
+        Fetches one page of the stream and hands it out
+        returns: the time (in seconds) to wait before polling the stream again
+        """
+        with self.condition:
+            token, generation = task.token, task.generation
+        response = self.client.fetch_log_events(
+            task.log_group_name, task.log_stream_name, token, self.batch_limit)
+        events = response['events']
+        next_token = response['nextForwardToken']
+        record_events(task.log_group_name, task.log_stream_name, events)
+        if events:
+            task.last_active = time.monotonic()
+            task.last_event_timestamp = max(event['timestamp'] for event in events)
+        if events or next_token != token:
+            self.on_events(task.log_group_name, task.log_stream_name, events, (task.key, next_token), generation)
+        with self.condition:
+            if task.generation != generation:
+                return 0  # rewound while this page was handed out, fetch again from the checkpoint
+            task.token = next_token
+        return task.poller.next_delay(len(events), self.batch_limit)
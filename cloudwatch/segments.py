@@ -0,0 +1,240 @@
+"""
+Module to write log streams as rotating, compressed segments of newline delimited JSON.
+
+Each stream gets a directory holding its segments and a manifest.json. The active segment
+(<first event timestamp>.ndjson) is appended to until it reaches a size or an age, then it is
+sealed: compressed (zstd when installed, else gzip) and recorded in the manifest with its
+time range and event count, so readers can pick the segments they need
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from cloudwatch.decoding import raw_event
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MANIFEST_FILE_NAME = 'manifest.json'
+ACTIVE_SUFFIX = '.ndjson'
+
+
+def get_compression(compression):
+    """
+    @param compression: 'auto' (zstd when installed, else gzip), 'zstd', 'gzip' or 'none'
+    returns: the compression to use
+    """
+    if compression == 'auto':
+        return 'zstd' if zstandard is not None else 'gzip'
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError("Segment compression is zstd but zstandard is not installed")
+    if compression not in ('zstd', 'gzip', 'none'):
+        raise ValueError("Unknown segment compression {}".format(compression))
+    return compression
+
+
+def compress_file(path, compression):
+    """
+    Compresses the file next to itself and removes it
+    returns: the path of the compressed file
+    """
+    if compression == 'none':
+        return path
+    if compression == 'zstd':
+        compressed_path = path + '.zst'
+        with open(path, 'rb') as source, open(compressed_path + '.tmp', 'wb') as target:
+            zstandard.ZstdCompressor(level=3).copy_stream(source, target)
+    else:
+        compressed_path = path + '.gz'
+        with open(path, 'rb') as source, gzip.open(compressed_path + '.tmp', 'wb', compresslevel=6) as target:
+            shutil.copyfileobj(source, target, 1024 * 1024)
+    os.replace(compressed_path + '.tmp', compressed_path)
+    os.unlink(path)
+    return compressed_path
+
+
+class Segment(object):
+    """
+    The active segment of a stream
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.opened_at = time.monotonic()
+        self.size = 0
+        self.count = 0
+        self.start_time = None  # oldest event timestamp (ms)
+        self.end_time = None  # newest event timestamp (ms)
+
+    def add(self, log_events, size):
+        start_time = min(log_event['timestamp'] for log_event in log_events)
+        end_time = max(log_event['timestamp'] for log_event in log_events)
+        if self.start_time is None or start_time < self.start_time:
+            self.start_time = start_time
+        if self.end_time is None or end_time > self.end_time:
+            self.end_time = end_time
+        self.count += len(log_events)
+        self.size += size
+
+    @staticmethod
+    def recover(path):
+        """
+        Rebuilds the stats of a segment left active by a previous run
+        """
+        segment = Segment(path)
+        with open(path, 'r') as fhandle:
+            for line in fhandle:
+                try:
+                    timestamp = json.loads(line)['timestamp']
+                except (ValueError, KeyError):
+                    continue
+                segment.add([{'timestamp': timestamp}], len(line))
+        return segment
+
+
+class SegmentedOutput(object):
+    """
+    Writes pages of log events into the rotating segments of their stream directory
+    """
+
+    def __init__(self, writer, compression='auto', max_bytes=64 * 1024 * 1024, max_seconds=3600):
+        """
+        @param writer: the BufferedFileWriter appending to the active segments
+        @param compression: see get_compression
+        @param max_bytes: seal a segment once it holds that many bytes
+        @param max_seconds: seal a segment once it has been open that long
+        """
+        self.writer = writer
+        self.compression = get_compression(compression)
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.lock = Lock()
+        self._active = {}  # key = stream directory, value = active Segment
+        self._manifest_locks = {}  # key = stream directory, value = Lock
+        # sealing compresses whole segments, off the consumer threads
+        self._sealer = ThreadPoolExecutor(max_workers=1)
+        self._closed = False
+        timer = threading.Thread(target=self._seal_expired_periodically, name='segment-sealer')
+        timer.daemon = True
+        timer.start()
+
+    def write(self, stream_dir, log_events):
+        """
+        Appends the events, as newline delimited JSON, to the active segment of the stream
+        @param stream_dir: the directory of the stream segments
+        @param log_events: list of log events
+        """
+        if not log_events:
+            return
+        data = ''.join(json.dumps(raw_event(log_event)) + '\n' for log_event in log_events)
+        with self.lock:
+            segment = self._active.get(stream_dir)
+            if segment is None:
+                segment = self._open(stream_dir, log_events[0]['timestamp'])
+            self.writer.write(segment.path, data)
+            segment.add(log_events, len(data))
+            if segment.size >= self.max_bytes:
+                self._seal(stream_dir)
+
+    def _open(self, stream_dir, timestamp):
+        if stream_dir not in self._manifest_locks:
+            self._manifest_locks[stream_dir] = Lock()
+            self._recover(stream_dir)
+        path = os.path.join(stream_dir, '{}{}'.format(timestamp, ACTIVE_SUFFIX))
+        # never reuse the name of a segment, sealed or not
+        while any(os.path.exists(path + suffix) for suffix in ('', '.gz', '.zst')):
+            timestamp += 1
+            path = os.path.join(stream_dir, '{}{}'.format(timestamp, ACTIVE_SUFFIX))
+        segment = self._active[stream_dir] = Segment(path)
+        return segment
+
+    def _recover(self, stream_dir):
+        """
+        Seals the segments a previous run left active
+        """
+        if not os.path.isdir(stream_dir):
+            return
+        for file_name in sorted(os.listdir(stream_dir)):
+            if file_name.endswith(ACTIVE_SUFFIX):
+                segment = Segment.recover(os.path.join(stream_dir, file_name))
+                logging.info("Sealing segment {} left by a previous run".format(segment.path))
+                self._sealer.submit(self._compress_and_record, stream_dir, segment)
+
+    def _seal(self, stream_dir):
+        segment = self._active.pop(stream_dir)
+        self.writer.close_file(segment.path)
+        self._sealer.submit(self._compress_and_record, stream_dir, segment)
+
+    def _compress_and_record(self, stream_dir, segment):
+        try:
+            if segment.count:
+                compressed_path = compress_file(segment.path, self.compression)
+                self._record(stream_dir, segment, compressed_path)
+            else:
+                os.unlink(segment.path)
+        except Exception as ex:
+            logging.exception("Failed sealing segment {}: {}".format(segment.path, ex))
+
+    def _record(self, stream_dir, segment, compressed_path):
+        manifest_path = os.path.join(stream_dir, MANIFEST_FILE_NAME)
+        with self._manifest_locks[stream_dir]:
+            manifest = read_manifest(stream_dir)
+            manifest['segments'].append({
+                'file': os.path.basename(compressed_path),
+                'start_time': segment.start_time,
+                'end_time': segment.end_time,
+                'count': segment.count,
+                'bytes': segment.size,
+                'compressed_bytes': os.path.getsize(compressed_path),
+                'compression': self.compression,
+            })
+            with open(manifest_path + '.tmp', 'w') as fhandle:
+                json.dump(manifest, fhandle, indent=1)
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+    def seal_expired(self):
+        """
+        Seals the active segments open for longer than max_seconds
+        """
+        now = time.monotonic()
+        with self.lock:
+            for stream_dir, segment in list(self._active.items()):
+                if now - segment.opened_at >= self.max_seconds:
+                    self._seal(stream_dir)
+
+    def _seal_expired_periodically(self):
+        while not self._closed:
+            time.sleep(min(self.max_seconds, 60))
+            try:
+                self.seal_expired()
+            except Exception as ex:
+                logging.exception("Failed sealing expired segments: {}".format(ex))
+
+    def close(self):
+        """
+        Seals every active segment and waits for the compression to finish
+        """
+        with self.lock:
+            self._closed = True
+            for stream_dir in list(self._active):
+                self._seal(stream_dir)
+        self._sealer.shutdown(wait=True)
+
+
+def read_manifest(stream_dir):
+    """
+    returns: the manifest of the sealed segments of a stream directory
+    """
+    try:
+        with open(os.path.join(stream_dir, MANIFEST_FILE_NAME), 'r') as fhandle:
+            return json.load(fhandle)
+    except (IOError, ValueError):
+        return {'segments': []}
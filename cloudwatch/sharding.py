@@ -0,0 +1,301 @@
+"""
+Module to spread the log streams over several worker processes, so the consumers are not held to one core by the GIL.
+
+The main process (the coordinator) discovers the streams and saves the checkpoint. Every stream is owned by one
+worker process picked on a consistent hash ring, the worker fetches and consumes it with its own client and
+consumers and reports the checkpoints of the pages it consumed back to the coordinator, which merges them.
+A worker that dies is started again and given its streams back from the merged checkpoint
+"""
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from threading import Lock
+
+from cloudwatch.dedup import DEDUP_KEY_PREFIX
+from cloudwatch.metrics import INGEST_LAG, REGISTRY
+from cloudwatch.utils import checkpoint_key
+
+SHARD_REPORT_INTERVAL = 1  # seconds between the checkpoint reports of a worker
+SHARD_METRICS_INTERVAL = 5  # seconds between the metric samples a worker adds to its report
+SHARD_RING_REPLICAS = 64  # points of a worker on the hash ring
+
+
+class HashRing(object):
+    """
+    Consistent hash ring: adding or removing a node only moves the keys of that node
+    """
+
+    def __init__(self, nodes=(), replicas=SHARD_RING_REPLICAS):
+        self.replicas = replicas
+        self._points = []  # sorted hashes of the node replicas
+        self._nodes = {}  # key = point, value = node
+        for node in nodes:
+            self.add_node(node)
+
+    @staticmethod
+    def _hash(value):
+        # stable across processes and runs, unlike hash()
+        return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
+    def add_node(self, node):
+        for replica in range(self.replicas):
+            point = self._hash('{}#{}'.format(node, replica))
+            if point not in self._nodes:
+                bisect.insort(self._points, point)
+                self._nodes[point] = node
+
+    def remove_node(self, node):
+        for point in [point for point, owner in self._nodes.items() if owner == node]:
+            del self._nodes[point]
+            self._points.remove(point)
+
+    def node_for(self, key):
+        """
+        returns: the node owning the key, the first node clockwise of its hash
+        """
+        if not self._points:
+            raise ValueError("The hash ring has no nodes")
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[self._points[index]]
+
+
+def run_worker(worker_id, processes, commands, reports):
+    """
+    Entry point of a worker process: fetches and consumes the streams the coordinator assigns to it
+    @param worker_id: the worker number
+    @param processes: number of worker processes, they split the GetLogEvents quota evenly
+    @param commands: queue of ('add', log group name, log stream name, token, dedup window), ('remove', log group name,
+    log stream name) and ('stop',) from the coordinator
+    @param reports: queue of (worker id, kind, payload) to the coordinator
+    """
+    from cloudwatch import cwl, main as daemon
+    from cloudwatch.config import (
+        AWS_ACCESS_KEY, AWS_REGION, AWS_SECRET_KEY, AWS_SESSION_TOKEN, CHECKPOINT_FLUSH_TIMEOUT, DEDUP,
+        GET_LOG_EVENTS_TPS, METRICS_PORT, METRICS_SNAPSHOT_FILE
+    )
+    from cloudwatch.consumer_abstract import flush_consumers
+    from cloudwatch.dedup import EventDeduplicator
+    from cloudwatch.ratelimit import TokenBucket
+
+    # Ctrl-C reaches the whole process group, the coordinator stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, daemon.handle_sigterm)
+    daemon.configure_logging()
+    cwl.get_log_events_limiter = TokenBucket(GET_LOG_EVENTS_TPS / float(processes))
+    consumers = daemon.build_consumers(worker_id)
+    dedup = EventDeduplicator() if DEDUP else None
+    handler = daemon.LogStreamHandler(
+        cwl.CloudWatchLogs(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, AWS_SESSION_TOKEN), consumers, dedup=dedup)
+    handler.scheduler.on_retire = lambda group, stream: reports.put((worker_id, 'retired', (group, stream)))
+    daemon.register_metrics(consumers, handler.scheduler, handler.pipeline)
+    metrics_reported = 0  # time.monotonic() of the last metric samples reported, when the coordinator exports them
+
+    def report():
+        nonlocal metrics_reported
+        if dedup is not None:
+            dedup.save_to(daemon.gb)
+        dirty = daemon.gb.pop_dirty_checkpoints()
+        if dirty and not flush_consumers(consumers, CHECKPOINT_FLUSH_TIMEOUT):
+            # the coordinator saves what is reported, keep the checkpoints until the consumers flushed them
+            logging.warning("Shard worker {} consumers did not flush within {}s".format(
+                worker_id, CHECKPOINT_FLUSH_TIMEOUT))
+            daemon.gb.restore_dirty_checkpoints(dirty)
+            dirty = {}
+        status = {'checkpoints': dirty, 'lags': handler.scheduler.lags(), 'stats': handler.scheduler.stats()}
+        if (METRICS_PORT or METRICS_SNAPSHOT_FILE) and time.monotonic() - metrics_reported >= SHARD_METRICS_INTERVAL:
+            # the coordinator exports the lags of the status already
+            status['metrics'] = REGISTRY.export(exclude=(INGEST_LAG.name,))
+            metrics_reported = time.monotonic()
+        reports.put((worker_id, 'status', status))
+
+    def report_periodically():
+        while True:
+            time.sleep(SHARD_REPORT_INTERVAL)
+            report()
+
+    reporter = threading.Thread(target=report_periodically, name='shard-reporter')
+    reporter.daemon = True
+    reporter.start()
+    handler.scheduler.start()
+    logging.info("Shard worker {} started".format(worker_id))
+    try:
+        while True:
+            command = commands.get()
+            if command[0] == 'add':
+                _, log_group_name, log_stream_name, token, window = command
+                key = checkpoint_key(log_group_name, log_stream_name)
+                # a stream coming back after being retired here resumes from the newer local checkpoint
+                if token and key not in daemon.gb.get_checkpoint():
+                    daemon.gb.load_checkpoint({key: token})
+                    if window and dedup is not None:
+                        dedup.load({DEDUP_KEY_PREFIX + key: window})
+                handler.scheduler.add(log_group_name, log_stream_name)
+            elif command[0] == 'remove':
+                handler.scheduler.remove(command[1], command[2])
+                if dedup is not None:
+                    dedup.forget(checkpoint_key(command[1], command[2]))
+            elif command[0] == 'stop':
+                break
+    finally:
+        handler.pipeline.close(timeout=daemon.TIME_DAEMON_SLEEP)
+        for consumer in consumers:
+            consumer.close()
+        report()
+        logging.info("Shard worker {} stopped".format(worker_id))
+
+
+class ShardRouter(object):
+    """
+    Stands in for the StreamScheduler of the coordinator: the streams added are handed to the worker
+    process owning them instead of being fetched in this process
+    """
+
+    def __init__(self, processes, gb, on_retire=None):
+        """
+        @param processes: number of worker processes
+        @param gb: global manager object holding the merged checkpoint
+        @param on_retire: called with (log group name, log stream name) when a worker retires an idle stream
+        """
+        self.processes = processes
+        self.gb = gb
+        self.on_retire = on_retire
+        self.ring = HashRing(range(processes))
+        self.lock = Lock()
+        self._context = multiprocessing.get_context('spawn')  # the coordinator is threaded already
+        self._reports = self._context.Queue()
+        self._commands = {}  # key = worker id, value = its command queue
+        self._workers = {}  # key = worker id, value = its Process
+        self._assigned = {}  # key = (log group name, log stream name), value = worker id
+        self._status = {}  # key = worker id, value = last status report
+        self._restarts = 0
+        self._stopping = False
+        self._receiver = None
+
+    def start(self):
+        with self.lock:
+            if self._workers:
+                return  # already running
+            for worker_id in range(self.processes):
+                self._spawn(worker_id)
+        self._receiver = threading.Thread(target=self._receive, name='shard-receiver')
+        watcher = threading.Thread(target=self._watch, name='shard-watcher')
+        for thread in (self._receiver, watcher):
+            thread.daemon = True
+            thread.start()
+
+    def _spawn(self, worker_id):
+        self._commands[worker_id] = self._context.Queue()
+        process = self._context.Process(
+            target=run_worker, args=(worker_id, self.processes, self._commands[worker_id], self._reports),
+            name='shard-worker-{}'.format(worker_id))
+        process.daemon = True
+        process.start()
+        self._workers[worker_id] = process
+
+    def _send_add(self, worker_id, log_group_name, log_stream_name):
+        key = checkpoint_key(log_group_name, log_stream_name)
+        checkpoint = self.gb.get_checkpoint()
+        self._commands[worker_id].put(
+            ('add', log_group_name, log_stream_name, checkpoint.get(key), checkpoint.get(DEDUP_KEY_PREFIX + key)))
+
+    def add(self, log_group_name, log_stream_name):
+        """
+        Hands a log stream to the worker owning it, a stream already assigned is left as is
+        returns: the name of the worker
+        """
+        with self.lock:
+            key = (log_group_name, log_stream_name)
+            worker_id = self._assigned.get(key)
+            if worker_id is None:
+                worker_id = self._assigned[key] = self.ring.node_for(checkpoint_key(log_group_name, log_stream_name))
+                self._send_add(worker_id, log_group_name, log_stream_name)
+            return 'shard-worker-{}'.format(worker_id)
+
+    def remove(self, log_group_name, log_stream_name):
+        with self.lock:
+            worker_id = self._assigned.pop((log_group_name, log_stream_name), None)
+            if worker_id is not None:
+                self._commands[worker_id].put(('remove', log_group_name, log_stream_name))
+
+    def tracked(self):
+        with self.lock:
+            return list(self._assigned)
+
+    def stats(self):
+        with self.lock:
+            busy = sum(status['stats'].get('busy', 0) for status in self._status.values())
+            return {'processes': self.processes, 'restarts': self._restarts, 'busy': busy,
+                    'streams': len(self._assigned)}
+
+    def lags(self):
+        with self.lock:
+            return [lag for status in self._status.values() for lag in status['lags']]
+
+    def _handle(self, worker_id, kind, payload):
+        if kind == 'status':
+            for key, token in payload['checkpoints'].items():
+                if token is None:
+                    self.gb.delete_checkpoint(key)
+                else:
+                    self.gb.set_checkpoint(key, token)
+            if 'metrics' in payload:
+                REGISTRY.merge(str(worker_id), payload.pop('metrics'))
+            with self.lock:
+                self._status[worker_id] = payload
+        elif kind == 'retired':
+            with self.lock:
+                if self._assigned.get(payload) == worker_id:
+                    del self._assigned[payload]
+            if self.on_retire:
+                self.on_retire(*payload)
+
+    def _receive(self):
+        while True:
+            report = self._reports.get()
+            if report is None:
+                return  # queued by close once the workers are gone
+            try:
+                self._handle(*report)
+            except Exception as ex:
+                logging.exception("Failed handling a shard worker report: {}".format(ex))
+
+    def _watch(self):
+        """
+        Starts the workers that died again and hands them back their streams from the merged checkpoint
+        """
+        while not self._stopping:
+            time.sleep(SHARD_REPORT_INTERVAL)
+            with self.lock:
+                if self._stopping:
+                    return
+                for worker_id, process in list(self._workers.items()):
+                    if process.is_alive():
+                        continue
+                    logging.error("Shard worker {} exited with {} - restarting it".format(worker_id, process.exitcode))
+                    self._restarts += 1
+                    self._status.pop(worker_id, None)
+                    self._spawn(worker_id)
+                    for (log_group_name, log_stream_name), owner in self._assigned.items():
+                        if owner == worker_id:
+                            self._send_add(worker_id, log_group_name, log_stream_name)
+
+    def close(self, timeout=None):
+        """
+        Stops the workers, letting them consume the pages fetched and report their last checkpoints
+        """
+        with self.lock:
+            self._stopping = True
+            workers = list(self._workers.items())
+        for worker_id, _ in workers:
+            self._commands[worker_id].put(('stop',))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for _, process in workers:
+            process.join(None if deadline is None else max(0, deadline - time.monotonic()))
+        if self._receiver is not None:
+            # the last reports of the workers are queued ahead of this
+            self._reports.put(None)
+            self._receiver.join(None if deadline is None else max(0, deadline - time.monotonic()))
@@ -0,0 +1,67 @@
+"""
+Follows the log streams of one or more log groups as a single feed on stdout, ordered by event timestamp.
+Starts at the tail of every stream (no checkpoint is read or saved) and picks up new streams as they show up
+
+usage: python -m cloudwatch.tail --group /ecs/api --streams 'api/*' --reorder-window 2
+"""
+import argparse
+import os
+import threading
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tail the log streams of log groups, merged in timestamp order")
+    parser.add_argument('--group', action='append', required=True,
+                        help="log group name or glob (repeatable)")
+    parser.add_argument('--streams', default='*', help="glob of the log stream names (default: all)")
+    parser.add_argument('--stream-count', type=int, default=100, help="most recent streams followed per log group")
+    parser.add_argument('--reorder-window', type=float,
+                        help="seconds events are held back to be ordered with the other streams (default 2)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # the configuration is read on import, so it is set up before importing the daemon.
+    # Polls and discovery run more often than the daemon defaults to keep the feed live
+    os.environ['LOG_GROUP_NAMES'] = ','.join(args.group)
+    os.environ['STREAM_LOOKBACK_COUNT'] = str(args.stream_count)
+    os.environ['TIME_DAEMON_SLEEP'] = os.environ.get('TIME_DAEMON_SLEEP') or '5'
+    os.environ['TIME_LOG_POLL_SLEEP'] = os.environ.get('TIME_LOG_POLL_SLEEP') or '1'
+    os.environ['TIME_LOG_POLL_MAX_SLEEP'] = os.environ.get('TIME_LOG_POLL_MAX_SLEEP') or '5'
+    if args.reorder_window is not None:
+        os.environ['TAIL_REORDER_WINDOW'] = str(args.reorder_window)
+
+    from cloudwatch.config import AWS_ACCESS_KEY, AWS_REGION, AWS_SECRET_KEY, AWS_SESSION_TOKEN
+    from cloudwatch.consumer_console import ConsoleConsumer
+    from cloudwatch.cwl import CloudWatchLogs
+    from cloudwatch.main import LogStreamHandler, configure_logging
+    from cloudwatch.utils import glob_match
+
+    class TailLogStreamHandler(LogStreamHandler):
+
+        def _wanted_log_stream(self, log_stream_name):
+            return glob_match(log_stream_name, args.streams)
+
+    configure_logging()
+    client = CloudWatchLogs(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, AWS_SESSION_TOKEN)
+    console = ConsoleConsumer()
+    handler = TailLogStreamHandler(client, [console])
+    for target in (handler.discover_log_streams, handler.sync_new_logs):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        handler.pipeline.close(timeout=5)
+        console.close()
+
+
+if __name__ == '__main__':
+    main()
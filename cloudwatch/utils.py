@@ -1,6 +1,91 @@
+import fnmatch
+from datetime import datetime, timezone
+
+GLOB_CHARACTERS = '*?['
+
+
 def create_file_if_does_not_exist(file_name):
     try:
         file = open(file_name, 'r')
     except IOError:
         file = open(file_name, 'w')
     file.close()
+
+
+def checkpoint_key(log_group_name, log_stream_name):
+    """
+    The checkpoint key of a log stream. Log group names cannot contain ':' so the
+    key splits back unambiguously on the first ':'
+    """
+    return "{0}:{1}".format(log_group_name, log_stream_name)
+
+
+def split_checkpoint_key(key):
+    """
+    returns: tuple of (log group name, log stream name) for a key made by checkpoint_key
+    """
+    log_group_name, _, log_stream_name = key.partition(':')
+    return log_group_name, log_stream_name
+
+
+def is_glob(pattern):
+    return any(c in pattern for c in GLOB_CHARACTERS)
+
+
+def glob_prefix(pattern):
+    """
+    The literal prefix of a glob pattern, everything before the first wildcard
+    """
+    for i, c in enumerate(pattern):
+        if c in GLOB_CHARACTERS:
+            return pattern[:i]
+    return pattern
+
+
+def glob_match(name, pattern):
+    return fnmatch.fnmatchcase(name, pattern)
+
+
+def parse_log_group_selectors(selectors, default_lookback_count):
+    """
+    Parses a comma separated list of log group selectors. A selector is a log group name,
+    a prefix ending with '*' or any glob, optionally followed by ':<stream lookback count>'
+    e.g. "/ecs/api,/ecs/worker-*:3"
+    returns: list of tuples of (log group pattern, stream lookback count)
+    """
+    parsed = []
+    for selector in selectors.split(','):
+        selector = selector.strip()
+        if not selector:
+            continue
+        pattern, _, lookback_count = selector.partition(':')
+        parsed.append((pattern, int(lookback_count) if lookback_count else default_lookback_count))
+    return parsed
+
+
+def filter_checkpoint_key(log_group_name, filter_pattern):
+    """
+    The checkpoint key of a FilterLogEvents sweep over a log group. Starts with '@' which
+    log group names cannot contain so it never collides with a stream checkpoint key
+    """
+    return "@filter:{0}:{1}".format(log_group_name, filter_pattern)
+
+
+def push_checkpoint_key(log_group_name):
+    """
+    The checkpoint key of the newest event pushed for a log group by a subscription
+    """
+    return "@push:{0}".format(log_group_name)
+
+
+def parse_time(value):
+    """
+    Parses epoch milliseconds or an ISO 8601 date time (UTC unless it has an offset)
+    returns: epoch milliseconds [int]
+    """
+    if value.isdigit():
+        return int(value)
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 1000)
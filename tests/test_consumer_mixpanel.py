@@ -0,0 +1,178 @@
+"""
+MixpanelSender against a local fake Mixpanel HTTP endpoint
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+pytest.importorskip('mixpanel')
+
+from cloudwatch.consumer_mixpanel import MIXPANEL_TRACK_BATCH_SIZE, MixpanelConsumer, MixpanelSender
+
+
+class FakeMixpanel(object):
+    """
+    Records the batches posted to /track and /import, failing the first `failures` requests
+    (or every request when failures is None) with the error body Mixpanel answers with
+    """
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.requests = 0
+        self.batches = []
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+                with fake.lock:
+                    fake.requests += 1
+                    failed = fake.failures is None or fake.requests <= fake.failures
+                    if not failed:
+                        fake.batches.append(json.loads(parse_qs(body)['data'][0]))
+                response = json.dumps({'status': 0, 'error': 'unavailable'} if failed else {'status': 1})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response.encode('utf-8'))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def events(self):
+        with self.lock:
+            return [event for batch in self.batches for event in batch]
+
+
+@pytest.fixture
+def fake_mixpanel():
+    servers = []
+
+    def start(failures=0):
+        server = FakeMixpanel(failures)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.server.shutdown()
+        server.server.server_close()
+
+
+def make_event(i):
+    return {'event': 'API Request', 'properties': {'token': 'token', 'distinct_id': 'app', 'i': i}}
+
+
+def test_sends_every_event_in_batches(fake_mixpanel):
+    server = fake_mixpanel()
+    sender = MixpanelSender('token', api_url=server.url, workers=1)
+    for i in range(120):
+        sender.enqueue(make_event(i))
+    sender.close(timeout=10)
+
+    assert sorted(event['properties']['i'] for event in server.events()) == list(range(120))
+    assert all(len(batch) <= MIXPANEL_TRACK_BATCH_SIZE for batch in server.batches)
+    assert len(server.batches) < 120
+    stats = sender.stats()
+    assert (stats['queued'], stats['sent'], stats['dropped']) == (120, 120, 0)
+
+
+def test_retries_failed_batches(fake_mixpanel):
+    server = fake_mixpanel(failures=2)
+    sender = MixpanelSender('token', api_url=server.url, workers=1, max_retries=3, retry_base=0.01)
+    sender.enqueue(make_event(0))
+    sender.close(timeout=10)
+
+    assert len(server.events()) == 1
+    stats = sender.stats()
+    assert (stats['sent'], stats['retried'], stats['dropped']) == (1, 2, 0)
+
+
+def test_drops_a_batch_out_of_retries(fake_mixpanel):
+    server = fake_mixpanel(failures=None)
+    sender = MixpanelSender('token', api_url=server.url, workers=1, max_retries=1, retry_base=0.01)
+    for i in range(3):
+        sender.enqueue(make_event(i))
+    sender.close(timeout=10)
+
+    assert server.events() == []
+    stats = sender.stats()
+    assert (stats['queued'], stats['sent'], stats['dropped']) == (3, 0, 3)
+
+
+def test_full_queue_blocks_then_drops(fake_mixpanel):
+    server = fake_mixpanel()
+    sender = MixpanelSender('token', api_url=server.url, queue_size=1, workers=0, enqueue_timeout=0.2)
+    sender.enqueue(make_event(0))
+    started = time.monotonic()
+    sender.enqueue(make_event(1))
+
+    assert time.monotonic() - started >= 0.2
+    stats = sender.stats()
+    assert (stats['queued'], stats['dropped'], stats['queue_depth']) == (1, 1, 1)
+
+
+def test_flush_waits_for_the_queued_events(fake_mixpanel):
+    server = fake_mixpanel()
+    sender = MixpanelSender('token', api_url=server.url, workers=2)
+    for i in range(120):
+        sender.enqueue(make_event(i))
+
+    assert sender.flush(timeout=10)
+    assert len(server.events()) == 120
+    sender.close(timeout=10)
+
+
+def test_flush_times_out_while_events_are_queued(fake_mixpanel):
+    server = fake_mixpanel()
+    sender = MixpanelSender('token', api_url=server.url, workers=0)
+    assert sender.flush(timeout=0)
+    sender.enqueue(make_event(0))
+
+    started = time.monotonic()
+    assert not sender.flush(timeout=0.2)
+    assert time.monotonic() - started >= 0.2
+
+
+class RecordingSender(object):
+
+    def __init__(self):
+        self.events = []
+
+    def enqueue(self, event):
+        self.events.append(event)
+
+
+def make_log_line(i, **fields):
+    message = {'message': {'templatized_url': '/apps/{id}', 'request_url': '/apps/{}'.format(i), 'app_id': 'app'}}
+    log_line = {'timestamp': 1000 + i, 'ingestionTime': 2000, 'message': json.dumps(message)}
+    log_line.update(fields)
+    return log_line
+
+
+def test_replayed_events_keep_their_insert_id():
+    consumer = MixpanelConsumer.__new__(MixpanelConsumer)
+    consumer.sender = RecordingSender()
+    log_lines = [make_log_line(0), make_log_line(1), make_log_line(2, eventId='3' * 56)]
+    consumer.process_batch(log_lines, '/ecs/api', 'api/1')
+    consumer.process_batch(log_lines, '/ecs/api', 'api/1')
+    consumer.process_batch(log_lines[:1], '/ecs/api', 'api/2')
+
+    insert_ids = [event['properties']['$insert_id'] for event in consumer.sender.events]
+    assert insert_ids[:3] == insert_ids[3:6]
+    assert len(set(insert_ids)) == 4
+    assert all(len(insert_id) <= 36 for insert_id in insert_ids)
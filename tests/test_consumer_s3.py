@@ -0,0 +1,149 @@
+"""
+S3ArchiveConsumer against an in-process S3 (moto)
+"""
+import base64
+import gzip
+import json
+import os
+
+import pytest
+
+pytest.importorskip('slugify')
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from cloudwatch.consumer_s3 import MANIFEST_FILE_NAME, OPEN_SUFFIX, S3ArchiveConsumer
+
+BUCKET = 'archive-bucket'
+BASE_TIME = 1699999980000  # epoch ms, on a minute boundary
+CHUNK_BYTES = 5 * 1024 * 1024  # the smallest part S3 accepts
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(name, 'testing')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def make_consumer(s3, spill_directory, **kwargs):
+    options = dict(bucket=BUCKET, prefix='archive', window_seconds=60, max_bytes=64 * 1024 * 1024,
+                   spill_directory=str(spill_directory), spill_max_bytes=1024 * 1024 * 1024,
+                   upload_workers=2, multipart_chunk_bytes=CHUNK_BYTES, multipart_concurrency=2, client=s3)
+    options.update(kwargs)
+    return S3ArchiveConsumer(**options)
+
+
+def make_events(start, count, step=100, message='event {}'):
+    return [{'timestamp': BASE_TIME + (start + i) * step, 'ingestionTime': BASE_TIME,
+             'message': message.format(start + i)} for i in range(count)]
+
+
+def list_objects(s3):
+    response = s3.list_objects_v2(Bucket=BUCKET)
+    return dict((entry['Key'], entry) for entry in response.get('Contents', ()))
+
+
+def read_events(s3, key):
+    body = s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+    return [json.loads(line) for line in gzip.decompress(body).splitlines()]
+
+
+def read_manifests(s3):
+    return dict((key, json.loads(s3.get_object(Bucket=BUCKET, Key=key)['Body'].read()))
+                for key in list_objects(s3) if key.endswith('/' + MANIFEST_FILE_NAME))
+
+
+def test_uploads_every_event_with_a_manifest(s3, tmp_path):
+    consumer = make_consumer(s3, tmp_path)
+    # 1200 events 100ms apart span two one minute windows
+    for start in range(0, 1200, 100):
+        consumer.process_batch(make_events(start, 100), '/ecs/api', 'api/1')
+    consumer.process_batch(make_events(0, 10, message='other {}'), '/ecs/api', 'api/2')
+    consumer.close(timeout=30)
+
+    data_keys = [key for key in list_objects(s3) if not key.endswith(MANIFEST_FILE_NAME)]
+    assert len(data_keys) == 3
+    messages = sorted(event['message'] for key in data_keys for event in read_events(s3, key))
+    assert messages == sorted(['event {}'.format(i) for i in range(1200)] + ['other {}'.format(i) for i in range(10)])
+
+    manifests = read_manifests(s3)
+    assert len(manifests) == 2  # one per stream, both streams stay in the same hour
+    entries = [entry for manifest in manifests.values() for entry in manifest['objects']]
+    assert sorted(entry['key'] for entry in entries) == sorted(data_keys)
+    for entry in entries:
+        events = read_events(s3, entry['key'])
+        assert entry['count'] == len(events)
+        assert entry['start_time'] == min(event['timestamp'] for event in events)
+        assert entry['end_time'] == max(event['timestamp'] for event in events)
+        assert entry['compressed_bytes'] == list_objects(s3)[entry['key']]['Size']
+    assert not os.listdir(str(tmp_path))  # nothing left to upload
+    stats = consumer.stats()
+    assert (stats['events'], stats['uploaded'], stats['pending']) == (1210, 3, 0)
+
+
+def test_uploads_big_objects_in_parts(s3, tmp_path):
+    consumer = make_consumer(s3, tmp_path)
+    # random payloads barely compress, about 9MB of gzip
+    events = [{'timestamp': BASE_TIME + i, 'ingestionTime': BASE_TIME,
+               'message': base64.b64encode(os.urandom(9 * 1024)).decode('ascii')} for i in range(1000)]
+    for start in range(0, len(events), 100):
+        consumer.process_batch(events[start:start + 100], '/ecs/api', 'api/1')
+    consumer.close(timeout=60)
+
+    data_objects = [entry for key, entry in list_objects(s3).items() if not key.endswith(MANIFEST_FILE_NAME)]
+    assert len(data_objects) == 1
+    assert data_objects[0]['Size'] > CHUNK_BYTES
+    assert data_objects[0]['ETag'].strip('"').endswith('-2')  # the ETag of a multipart upload counts its parts
+    assert [event['message'] for event in read_events(s3, data_objects[0]['Key'])] == \
+        [event['message'] for event in events]
+
+
+def test_recovers_a_torn_spill_file(s3, tmp_path):
+    crashed = make_consumer(s3, tmp_path, window_seconds=3600)
+    crashed.process_batch(make_events(0, 50), '/ecs/api', 'api/1')
+    crashed.process_batch(make_events(50, 50), '/ecs/api', 'api/1')
+    # the process died while appending the third page
+    open_files = [name for name in os.listdir(str(tmp_path)) if name.endswith(OPEN_SUFFIX)]
+    assert len(open_files) == 1
+    torn = gzip.compress(b''.join(json.dumps(event).encode('utf-8') + b'\n' for event in make_events(100, 50)))
+    with open(os.path.join(str(tmp_path), open_files[0]), 'ab') as fhandle:
+        fhandle.write(torn[:len(torn) // 2])
+
+    consumer = make_consumer(s3, tmp_path, window_seconds=3600)
+    consumer.close(timeout=30)
+
+    data_keys = [key for key in list_objects(s3) if not key.endswith(MANIFEST_FILE_NAME)]
+    assert len(data_keys) == 1
+    assert [event['message'] for event in read_events(s3, data_keys[0])] == \
+        ['event {}'.format(i) for i in range(100)]
+    (manifest,) = read_manifests(s3).values()
+    assert [entry['count'] for entry in manifest['objects']] == [100]
+    assert not os.listdir(str(tmp_path))
+
+
+def test_workers_keep_their_own_spill_directories(s3, tmp_path, monkeypatch):
+    from cloudwatch import consumer_s3, main
+
+    for name, value in (('MIXPANEL_TOKEN', None), ('AWS_LOGS_DIRECTORY', None), ('CONSOLE_OUTPUT', False),
+                        ('S3_ARCHIVE_BUCKET', BUCKET), ('S3_SPILL_DIRECTORY', str(tmp_path))):
+        monkeypatch.setattr(main, name, value)
+    monkeypatch.setattr(consumer_s3, 'S3ArchiveConsumer', lambda spill_directory: make_consumer(
+        s3, spill_directory, window_seconds=3600))
+
+    (first,) = main.build_consumers(worker_id=0)
+    first.process_batch(make_events(0, 50), '/ecs/api', 'api/1')
+    # a worker (re)starting does not upload the open objects of the others
+    (second,) = main.build_consumers(worker_id=1)
+    second.close(timeout=30)
+    assert list_objects(s3) == {}
+
+    first.process_batch(make_events(50, 50), '/ecs/api', 'api/1')
+    first.close(timeout=30)
+    data_keys = [key for key in list_objects(s3) if not key.endswith(MANIFEST_FILE_NAME)]
+    assert len(data_keys) == 1
+    assert [event['message'] for event in read_events(s3, data_keys[0])] == \
+        ['event {}'.format(i) for i in range(100)]
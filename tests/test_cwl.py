@@ -0,0 +1,72 @@
+"""
+CloudWatchLogs fetches against the in-process fake CloudWatch Logs
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('botocore')
+
+from cloudwatch import cwl
+from cloudwatch.cwl import CloudWatchLogs
+from cloudwatch.fake import FakeCloudWatchLogsClient
+from cloudwatch.ratelimit import TokenBucket
+
+
+class InFlightClient(FakeCloudWatchLogsClient):
+    """
+    Records the most GetLogEvents calls in flight at once
+    """
+
+    def __init__(self, **kwargs):
+        super(InFlightClient, self).__init__(**kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+    def get_log_events(self, **kwargs):
+        with self.in_flight_lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return super(InFlightClient, self).get_log_events(**kwargs)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight -= 1
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    monkeypatch.setattr(cwl, 'get_log_events_limiter', TokenBucket(1000))
+    return InFlightClient(groups=1, streams_per_group=1, events_per_second=10, backlog_seconds=600, latency=0.05)
+
+
+def first_stream(fake):
+    return next(iter(fake.streams))
+
+
+def test_fetches_the_ranges_of_a_stream_in_parallel(fake):
+    client = CloudWatchLogs(client=fake, max_concurrent_fetches=8)
+    log_group_name, log_stream_name = first_stream(fake)
+    now = int(time.time() * 1000)
+    shards = [(now - 600000 + i * 60000, now - 600000 + (i + 1) * 60000) for i in range(8)]
+    with ThreadPoolExecutor(8) as executor:
+        pages = list(executor.map(
+            lambda shard: client.get_log_events_range(log_group_name, log_stream_name, *shard), shards))
+
+    assert fake.max_in_flight > 1
+    for (start_time, end_time), log_events in zip(shards, pages):
+        assert log_events
+        assert all(start_time <= log_event['timestamp'] < end_time for log_event in log_events)
+
+
+def test_polls_a_stream_one_request_at_a_time(fake):
+    client = CloudWatchLogs(client=fake, max_concurrent_fetches=8)
+    log_group_name, log_stream_name = first_stream(fake)
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: client.fetch_log_events(log_group_name, log_stream_name), range(8)))
+
+    assert fake.max_in_flight == 1
+    assert client._stream_locks == {}  # dropped once no fetch uses them
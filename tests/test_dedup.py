@@ -0,0 +1,145 @@
+"""
+EventDeduplicator windows: replays, identical events, failed pages and out of order deliveries
+"""
+from cloudwatch.dedup import DEDUP_KEY_PREFIX, EventDeduplicator
+
+KEY = '/ecs/api:api/1'
+
+
+class FakeGlobalManager(object):
+    """
+    Records the checkpoints set and deleted, like the GlobalManager of cloudwatch.main
+    """
+
+    def __init__(self):
+        self.checkpoint = {}
+        self.deleted = []
+
+    def set_checkpoint(self, key, value):
+        self.checkpoint[key] = value
+
+    def delete_checkpoint(self, key):
+        self.checkpoint.pop(key, None)
+        self.deleted.append(key)
+
+
+def make_events(start, count, message='event {}'):
+    return [{'timestamp': 1000 + i, 'ingestionTime': 2000, 'message': message.format(i)}
+            for i in range(start, start + count)]
+
+
+def make_pushed_events(timestamps):
+    return [{'id': str(timestamp), 'eventId': str(timestamp), 'timestamp': timestamp, 'message': str(timestamp)}
+            for timestamp in timestamps]
+
+
+def consume(dedup, log_events, key=KEY):
+    new_events = dedup.filter(key, log_events)
+    dedup.commit(key, len(new_events))
+    return new_events
+
+
+def test_drops_the_events_replayed_after_a_restart():
+    dedup = EventDeduplicator(window_seconds=60, max_events=1000)
+    consume(dedup, make_events(0, 100))
+    gb = FakeGlobalManager()
+    dedup.save_to(gb)
+
+    restarted = EventDeduplicator(window_seconds=60, max_events=1000)
+    restarted.load(gb.checkpoint)
+    # resumed from a checkpoint saved 40 events before the last page consumed
+    assert consume(restarted, make_events(60, 60)) == make_events(100, 20)
+
+
+def test_keeps_identical_events_of_a_batch():
+    dedup = EventDeduplicator()
+    # the closing braces of multi-line JSON messages written in one PutLogEvents batch
+    page = [{'timestamp': 1000, 'ingestionTime': 2000, 'message': '}'} for _ in range(3)]
+    assert len(consume(dedup, page)) == 3
+
+    gb = FakeGlobalManager()
+    dedup.save_to(gb)
+    restarted = EventDeduplicator()
+    restarted.load(gb.checkpoint)
+    assert consume(restarted, page) == []
+
+
+def test_rolls_back_a_failed_page():
+    dedup = EventDeduplicator()
+    consume(dedup, make_events(0, 10))
+    page = make_events(10, 10)
+    assert dedup.filter(KEY, page) == page
+    dedup.rollback(KEY)
+    # read again once the stream is fetched again from the failed page
+    assert consume(dedup, page) == page
+    assert dedup.stats()['fingerprints'] == 20
+
+
+def test_drops_repeated_event_ids():
+    dedup = EventDeduplicator()
+    consume(dedup, make_pushed_events([1000, 1001]))
+    assert consume(dedup, make_pushed_events([1000, 1001, 1002])) == make_pushed_events([1002])
+
+
+def test_keeps_pushed_events_arriving_out_of_order():
+    dedup = EventDeduplicator(window_seconds=1, max_events=10)
+    consume(dedup, make_pushed_events(range(5000, 5020)))
+    # older than the window, still new events
+    late = make_pushed_events(range(1000, 1010))
+    assert consume(dedup, late) == late
+
+
+def test_drops_fetched_events_older_than_the_window():
+    dedup = EventDeduplicator(window_seconds=60, max_events=10)
+    consume(dedup, make_events(0, 100))
+    gb = FakeGlobalManager()
+    dedup.save_to(gb)
+
+    restarted = EventDeduplicator(window_seconds=60, max_events=10)
+    restarted.load(gb.checkpoint)
+    # the window holds the last 10 events, the millisecond of the newest one trimmed (event 89) is kept
+    # as other events of that millisecond may not have been read
+    assert consume(restarted, make_events(50, 60)) == make_events(89, 1) + make_events(100, 10)
+
+
+def test_forget_deletes_the_saved_window():
+    dedup = EventDeduplicator()
+    gb = FakeGlobalManager()
+    consume(dedup, make_events(0, 10))
+    consume(dedup, make_events(0, 10), key='/ecs/api:api/2')
+    dedup.save_to(gb)
+    assert set(gb.checkpoint) == {DEDUP_KEY_PREFIX + KEY, DEDUP_KEY_PREFIX + '/ecs/api:api/2'}
+
+    dedup.forget(KEY)
+    dedup.save_to(gb)
+    assert gb.deleted == [DEDUP_KEY_PREFIX + KEY]
+    assert set(gb.checkpoint) == {DEDUP_KEY_PREFIX + '/ecs/api:api/2'}
+    assert dedup.stats()['streams'] == 1
+    # the stream read again starts with an empty window
+    assert consume(dedup, make_events(0, 10)) == make_events(0, 10)
+
+
+def test_saves_a_window_only_when_it_changed():
+    dedup = EventDeduplicator()
+    gb = FakeGlobalManager()
+    consume(dedup, make_events(0, 10))
+    dedup.save_to(gb)
+    gb.checkpoint.clear()
+    consume(dedup, [])
+    dedup.save_to(gb)
+    assert gb.checkpoint == {}
+
+
+def test_expires_the_windows_not_read_for_a_while():
+    dedup = EventDeduplicator()
+    gb = FakeGlobalManager()
+    consume(dedup, make_pushed_events([1000]), key='@push:/ecs/api:api/1')
+    dedup.save_to(gb)
+    assert dedup.expire(60) == 0
+
+    consume(dedup, make_pushed_events([1000]), key='@push:/ecs/api:api/2')
+    assert dedup.expire(0) == 2
+    dedup.save_to(gb)
+    assert gb.checkpoint == {}
+    assert sorted(gb.deleted) == [DEDUP_KEY_PREFIX + '@push:/ecs/api:api/1', DEDUP_KEY_PREFIX + '@push:/ecs/api:api/2']
+    assert dedup.stats()['streams'] == 0
@@ -0,0 +1,62 @@
+"""
+Checkpoint saves of the daemon
+"""
+import pytest
+
+pytest.importorskip('slugify')
+
+from cloudwatch import main
+from cloudwatch.consumer_abstract import BaseConsumer
+
+KEY = '/ecs/api:api/1'
+
+
+class RecordingStore(object):
+
+    def __init__(self):
+        self.saves = []
+
+    def save(self, checkpoint):
+        self.saves.append(checkpoint)
+
+
+class BufferingConsumer(BaseConsumer):
+    """
+    Holds the events handed to it until a flush gets them out, when `flushes` is True
+    """
+
+    def __init__(self):
+        self.flushes = False
+        self.buffered = 0
+
+    def process(self, log_line, log_group, log_stream):
+        self.buffered += 1
+
+    def flush(self, timeout=None):
+        if self.flushes:
+            self.buffered = 0
+        return self.flushes
+
+
+@pytest.fixture
+def gb(monkeypatch):
+    monkeypatch.setattr(main, 'gb', main.GlobalManager())
+    monkeypatch.setattr(main, 'LOG_STREAM_CHECKPOINT', {})
+    monkeypatch.setattr(main, 'CHECKPOINT_FLUSH_TIMEOUT', 0.1)
+    return main.gb
+
+
+def test_saves_a_checkpoint_once_the_consumers_flushed_it(gb):
+    store = RecordingStore()
+    consumer = BufferingConsumer()
+    consumer.process({'timestamp': 1000, 'message': 'event'}, '/ecs/api', 'api/1')
+    gb.set_checkpoint(KEY, 'token-1')
+
+    with pytest.raises(RuntimeError):
+        main.save_state(store, consumers=[consumer])
+    assert store.saves == []
+
+    consumer.flushes = True
+    main.save_state(store, consumers=[consumer])
+    assert consumer.buffered == 0
+    assert store.saves == [{KEY: 'token-1'}]
@@ -0,0 +1,39 @@
+"""
+Metrics registry: the samples merged from the shard workers
+"""
+from cloudwatch.metrics import Registry
+
+
+def make_registry():
+    registry = Registry()
+    events = registry.counter('cwl_events_total', "Log events fetched", ('log_group', 'log_stream'))
+    latency = registry.histogram('cwl_api_latency_seconds', "API latency", ('api',), buckets=(.1, 1))
+    return registry, events, latency
+
+
+def test_exports_the_merged_worker_samples_with_a_worker_label():
+    coordinator, _, _ = make_registry()
+    worker, events, latency = make_registry()
+    events.inc(10, log_group='/ecs/api', log_stream='api/1')
+    latency.observe(.5, api='GetLogEvents')
+    coordinator.merge('0', worker.export())
+
+    text = coordinator.render_prometheus()
+    assert 'cwl_events_total{log_group="/ecs/api",log_stream="api/1",worker="0"} 10' in text
+    assert 'cwl_api_latency_seconds_bucket{api="GetLogEvents",worker="0",le="1"} 1' in text
+    (sample,) = coordinator.snapshot()['cwl_events_total']['samples']
+    assert sample == {'labels': {'log_group': '/ecs/api', 'log_stream': 'api/1', 'worker': '0'}, 'value': 10}
+
+
+def test_replaces_the_samples_of_a_worker():
+    coordinator, _, _ = make_registry()
+    worker, events, _ = make_registry()
+    events.inc(10, log_group='/ecs/api', log_stream='api/1')
+    coordinator.merge('0', worker.export(exclude=('cwl_api_latency_seconds',)))
+    # the worker restarted, its counters start over
+    restarted, events, _ = make_registry()
+    events.inc(2, log_group='/ecs/api', log_stream='api/1')
+    coordinator.merge('0', restarted.export())
+
+    snapshot = coordinator.snapshot()
+    assert [sample['value'] for sample in snapshot['cwl_events_total']['samples']] == [2]